@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: python -m pysvg COMMAND ..., the commands are in COMMANDS
+#
+# --------------
+
+__author__ = 'Roberto'
+
+import sys
+
+import batch
+
+COMMANDS = {
+    'batch': batch.run,
+}
+
+
+def run(argv):
+    if not argv or argv[0] not in COMMANDS:
+        sys.stderr.write('usage: python -m pysvg {%s} ...\n' % ','.join(sorted(COMMANDS)))
+        return 2
+    COMMANDS[argv[0]](argv[1:])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv[1:]))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: the attributes of an element, in source order with dict lookups and no OrderedDict overhead
+#
+# --------------
+
+__author__ = 'Roberto'
+
+from copy import deepcopy
+
+
+class AttrMap(object):
+    """
+    The attributes of an element: a plain dict for get/set/delete and the list of the keys for the source order.
+    A repeated key keeps its earlier (k, v) pairs in the key list, so the markup round-trips, while the lookups
+    see the last value as dict(pairs) would. A deleted key stays in the key list until the next read of the order
+    or insert of a key, _dead counts them
+    """
+    __slots__ = ('_keys', '_values', '_dead')
+
+    def __init__(self, pairs=()):
+        self._keys = []
+        self._values = dict()
+        self._dead = 0
+        if isinstance(pairs, (dict, AttrMap)):
+            pairs = pairs.items()
+        for k, v in pairs:
+            self.append(k, v)
+
+    @classmethod
+    def from_lists(cls, keys, values):
+        """
+        The AttrMap of the pairs keys[i], values[i] built at once, keys becomes its key list
+        """
+        ret = cls.__new__(cls)
+        ret._dead = 0
+        ret._values = dict(zip(keys, values))
+        if len(ret._values) == len(keys):
+            ret._keys = keys
+        else:
+            # a repeated key, its earlier pairs stay in the key list
+            ret._keys = []
+            ret._values = dict()
+            for k, v in zip(keys, values):
+                ret.append(k, v)
+        return ret
+
+    def append(self, k, v):
+        """
+        Add k as the last attribute, even when already there (the earlier value stays in the markup)
+        """
+        values = self._values
+        if k in values:
+            keys = self._keys
+            keys[keys.index(k)] = (k, values[k])
+        elif self._dead:
+            self._compact()
+        self._keys.append(k)
+        values[k] = v
+
+    def _compact(self):
+        """
+        Drop the deleted keys (and their earlier pairs) from the key list
+        """
+        values = self._values
+        self._keys = [x for x in self._keys if (x[0] if type(x) is tuple else x) in values]
+        self._dead = 0
+
+    def _order(self):
+        if self._dead:
+            self._compact()
+        return self._keys
+
+    def __getitem__(self, k):
+        return self._values[k]
+
+    def __setitem__(self, k, v):
+        if k not in self._values:
+            if self._dead:
+                self._compact()
+            self._keys.append(k)
+        self._values[k] = v
+
+    def __delitem__(self, k):
+        del self._values[k]
+        self._dead += 1
+
+    def __contains__(self, k):
+        return k in self._values
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, k, default=None):
+        return self._values.get(k, default)
+
+    def pop(self, k, *default):
+        if k not in self._values:
+            if default:
+                return default[0]
+            raise KeyError(k)
+        ret = self._values[k]
+        del self[k]
+        return ret
+
+    def setdefault(self, k, default=None):
+        if k not in self._values:
+            self[k] = default
+        return self._values[k]
+
+    def update(self, other=(), **kwargs):
+        for k, v in (other.items() if isinstance(other, (dict, AttrMap)) else other):
+            self[k] = v
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def keys(self):
+        return [k for k in self._order() if type(k) is not tuple]
+
+    def values(self):
+        values = self._values
+        return [values[k] for k in self._order() if type(k) is not tuple]
+
+    def items(self):
+        """
+        The (k, v) pairs in source order, the repeated keys with each of their values
+        """
+        values = self._values
+        return [k if type(k) is tuple else (k, values[k]) for k in self._order()]
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def copy(self):
+        ret = AttrMap()
+        ret._keys = list(self._order())
+        ret._values = self._values.copy()
+        return ret
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return AttrMap(deepcopy(self.items(), memo))
+
+    def __reduce__(self):
+        return AttrMap, (self.items(),)
+
+    def __eq__(self, other):
+        if isinstance(other, AttrMap):
+            return self.items() == other.items()
+        if isinstance(other, dict):
+            return self._values == other
+        if isinstance(other, list):
+            return self.items() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'AttrMap(%r)' % self.items()
+
+
+def attr_items(attrs):
+    """
+    The (k, v) pairs of attrs, an AttrMap, a dict or a list of pairs for nodes built by hand
+    """
+    return attrs.items() if isinstance(attrs, (AttrMap, dict)) else attrs
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    import copy
+    import pickle
+
+    attrs = AttrMap([('x', '1'), ('id', 'a'), ('x', '2')])
+    assert attrs['x'] == '2' and attrs.keys() == ['id', 'x'] and len(attrs) == 2
+    assert attrs.items() == [('x', '1'), ('id', 'a'), ('x', '2')]
+    attrs['y'] = '3'
+    attrs['id'] = 'b'
+    assert attrs.items() == [('x', '1'), ('id', 'b'), ('x', '2'), ('y', '3')]
+    del attrs['x']
+    assert attrs.items() == [('id', 'b'), ('y', '3')] and 'x' not in attrs and attrs.get('x') is None
+    assert attrs == {'id': 'b', 'y': '3'} and attrs == [('id', 'b'), ('y', '3')] and attrs != AttrMap([('y', '3')])
+    assert attrs.pop('y') == '3' and attrs.pop('y', None) is None
+    for other in (copy.copy(attrs), copy.deepcopy(attrs), pickle.loads(pickle.dumps(attrs, 2)), AttrMap(attrs)):
+        assert other == attrs and other is not attrs
+    other['id'] = 'c'
+    assert attrs['id'] == 'b' and list(attrs) == ['id'] and dict(attrs) == {'id': 'b'}
+    assert AttrMap.from_lists(['x', 'id'], ['1', 'a']) == AttrMap([('x', '1'), ('id', 'a')])
+    attrs = AttrMap([('x', '1'), ('id', 'a'), ('x', '2'), ('y', '3')])
+    del attrs['x']
+    del attrs['y']
+    assert len(attrs) == 1 and attrs._keys == [('x', '1'), 'id', 'x', 'y']
+    attrs['x'] = '4'
+    attrs.append('z', '5')
+    assert attrs.items() == [('id', 'a'), ('x', '4'), ('z', '5')] and attrs._dead == 0
+    del attrs['id']
+    assert attrs.copy().items() == attrs.items() == [('x', '4'), ('z', '5')] and attrs == {'x': '4', 'z': '5'}
+    attrs = AttrMap.from_lists(['x', 'id', 'x'], ['1', 'a', '2'])
+    assert attrs.items() == [('x', '1'), ('id', 'a'), ('x', '2')] and attrs['x'] == '2'
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: render many documents from one template and a stream of substitutions, over a process pool
+#
+# --------------
+
+__author__ = 'Roberto'
+
+from xml.sax.saxutils import escape
+from itertools import islice
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from generic_parser import GenericParser, VALUE, ATTRS, DATA
+
+OUTPUT = 'out%(n)05i.svg'
+CHUNK_RECORDS = 16
+# chunks per worker in a window of records handed to the pool, the next window is submitted while one drains:
+# the records past two windows are not read yet
+WINDOW_CHUNKS = 4
+
+# the template parsed by the parent, shared by the workers of the pool (pickled when they do not fork, its
+# indexes are rebuilt by GenericParser.__setstate__)
+_parser = None
+
+
+def read_records(fileobj, fmt='csv'):
+    """
+    Yield the substitutions of fileobj one dict at a time: keys are "id" (the text of the element) or
+    "id@attr" (one of its attributes), fmt is csv (with a header line) or jsonl (an object per line)
+    """
+    if fmt == 'csv':
+        for record in csv.DictReader(fileobj):
+            yield record
+    elif fmt == 'jsonl':
+        for line in fileobj:
+            if line.strip():
+                yield dict((k.encode('utf-8'), v.encode('utf-8') if isinstance(v, unicode) else v)
+                           for k, v in json.loads(line).items())
+    else:
+        raise ValueError('unknown format %r' % fmt)
+
+
+def substitute(parser, record):
+    """
+    Apply record to the dom of parser, return the undo list for restore
+    """
+    undo = []
+    for key, value in record.items():
+        if value is None:
+            continue
+        _id, _, k = key.partition('@')
+        found = parser._id_lookup(_id)
+        if not found:
+            raise KeyError(_id)
+        for elem in found:
+            if k:
+                undo.append((parser, elem, k, elem[ATTRS].get(k)))
+                parser.set_attr(elem, k, escape(str(value), {'"': '&quot;'}))
+            else:
+                old = _set_children(parser, elem, [parser._node(DATA, escape(str(value)))])
+                undo.append((parser, elem, VALUE, old))
+    return undo
+
+
+def _set_children(parser, elem, children):
+    """
+    Replace the children of elem (the list itself stays), return the old ones
+    """
+    old = elem[VALUE][:]
+    parser._unlink(old)
+    elem[VALUE][:] = children
+    parser._link(children, elem)
+    return old
+
+
+def restore(undo):
+    for parser, elem, k, old in reversed(undo):
+        if k == VALUE:
+            _set_children(parser, elem, old)
+        elif old is None:
+            parser.del_attr(elem, k)
+        else:
+            parser.set_attr(elem, k, old)
+
+
+def _path_value(value):
+    """
+    A record value made safe for a file name: no directory separators, no '.' or '..' component
+    """
+    if not isinstance(value, basestring):
+        return value
+    for sep in (os.sep, os.altsep, '/', '\\', '\0'):
+        if sep:
+            value = value.replace(sep, '_')
+    if value in ('.', '..'):
+        value = value.replace('.', '_')
+    return value
+
+
+def output_path(output, record, n):
+    return output % dict(((k, _path_value(v)) for k, v in record.items()), n=n)
+
+
+def _slices(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _windows(pool, tasks, window, chunksize):
+    """
+    The results of tasks rendered by pool, window at a time: the next window is queued before the results of the
+    current one are waited for, so the workers are not left idle between them
+    """
+    current = None
+    for tasks in _slices(tasks, window):
+        queued = pool.imap_unordered(_render, tasks, chunksize)
+        if current is not None:
+            for result in current:
+                yield result
+        current = queued
+    if current is not None:
+        for result in current:
+            yield result
+
+
+def _init(parser):
+    global _parser
+    _parser = parser
+
+
+def _render(task):
+    n, record, output = task
+    start = time.time()
+    path = output_path(output, record, n)
+    undo = substitute(_parser, record)
+    try:
+        with open(path, 'wb') as fileobj:
+            _parser.write(fileobj)
+            size = fileobj.tell()
+    finally:
+        restore(undo)
+    return multiprocessing.current_process().name, path, size, time.time() - start
+
+
+def render_batch(template, records, output=OUTPUT, processes=None, chunksize=CHUNK_RECORDS):
+    """
+    Render template (a GenericParser, or a file name parsed here once) with each of records, writing the
+    n-th document to output % dict(record, n=n) (see output_path) while the records are still being read.
+    Return the statistics of each worker: {name: {'files': .., 'bytes': .., 'seconds': ..}}
+    """
+    if not isinstance(template, GenericParser):
+        parser = GenericParser()
+        parser.load(template)
+        template = parser
+    tasks = ((n, record, output) for n, record in enumerate(records))
+    stats = dict()
+    if processes == 1:
+        _init(template)
+        results = (_render(x) for x in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, _init, (template,))
+        # imap_unordered reads its whole input up front (python 2): it gets bounded slices of the records
+        window = chunksize * WINDOW_CHUNKS * (processes or multiprocessing.cpu_count())
+        results = _windows(pool, tasks, window, chunksize)
+    try:
+        for name, path, size, seconds in results:
+            worker = stats.setdefault(name, {'files': 0, 'bytes': 0, 'seconds': 0.0})
+            worker['files'] += 1
+            worker['bytes'] += size
+            worker['seconds'] += seconds
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return stats
+
+
+def report(stats, elapsed, out):
+    files = 0
+    for name in sorted(stats):
+        worker = stats[name]
+        files += worker['files']
+        out.write('%s: %i files, %i bytes, %.1f files/s\n' % (
+            name, worker['files'], worker['bytes'], worker['files'] / max(worker['seconds'], 1e-9)))
+    out.write('total: %i files in %.2f s, %.1f files/s\n' % (files, elapsed, files / max(elapsed, 1e-9)))
+
+
+def run(argv, out=None):
+    """
+    The batch command: batch TEMPLATE SUBSTITUTIONS [-o OUTPUT] [-j PROCESSES] [-f csv|jsonl]
+    """
+    import argparse
+    import sys
+
+    arg_parser = argparse.ArgumentParser(prog='batch', description='render one document per substitution record')
+    arg_parser.add_argument('template')
+    arg_parser.add_argument('substitutions', help='csv or jsonl file, - for the standard input')
+    arg_parser.add_argument('-o', '--output', default=OUTPUT, help='file name pattern, default %(default)s')
+    arg_parser.add_argument('-j', '--processes', type=int, default=None, help='default one per cpu')
+    arg_parser.add_argument('-f', '--format', choices=('csv', 'jsonl'), default=None,
+                            help='default from the extension of substitutions')
+    arg_parser.add_argument('--chunksize', type=int, default=CHUNK_RECORDS)
+    args = arg_parser.parse_args(argv)
+    fmt = args.format or ('jsonl' if args.substitutions.endswith('.jsonl') else 'csv')
+    fileobj = sys.stdin if args.substitutions == '-' else open(args.substitutions, 'rb')
+    start = time.time()
+    try:
+        stats = render_batch(args.template, read_records(fileobj, fmt), args.output, args.processes, args.chunksize)
+    finally:
+        if fileobj is not sys.stdin:
+            fileobj.close()
+    report(stats, time.time() - start, out or sys.stdout)
+    return stats
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    from StringIO import StringIO
+
+    csv_records = list(read_records(StringIO('tspan3902,spaziatura@width\n5,10\n"<8>",\n'), 'csv'))
+    assert csv_records == [{'tspan3902': '5', 'spaziatura@width': '10'}, {'tspan3902': '<8>', 'spaziatura@width': ''}]
+    jsonl_records = list(read_records(StringIO('{"tspan3902": 5}\n\n{"spaziatura@width": "10"}\n'), 'jsonl'))
+    assert jsonl_records == [{'tspan3902': 5}, {'spaziatura@width': '10'}]
+
+
+def test2():
+    import shutil
+    import tempfile
+
+    parser = GenericParser()
+    parser.load('test/test.svg')
+    original = str(parser)
+    folder = tempfile.mkdtemp()
+    try:
+        records = [{'tspan3902': str(x), 'spaziatura@class': 'c%i' % x, 'poker': None} for x in xrange(5)]
+        records.append({'tspan3902': '<8>'})
+        stats = render_batch(parser, iter(records), os.path.join(folder, 'card%(n)i_%(tspan3902)s.svg'), 1)
+        assert stats.values()[0]['files'] == 6
+        assert str(parser) == original
+        data = open(os.path.join(folder, 'card3_3.svg'), 'rb').read()
+        assert 'id="tspan3902" sodipodi:role="line">3</tspan>' in data and 'class="c3"' in data
+        assert '>&lt;8&gt;</tspan>' in open(os.path.join(folder, 'card5_<8>.svg'), 'rb').read()
+        render_batch(parser, [{'tspan3902': '../up'}, {'tspan3902': '..'}], os.path.join(folder, '%(tspan3902)s.x'), 1)
+        assert sorted(x for x in os.listdir(folder) if x.endswith('.x')) == ['.._up.x', '__.x']
+        assert output_path('%(n)03i_%(a)s', {'a': 'b/c', 'n': 'ignored'}, 7) == '007_b_c'
+        try:
+            render_batch(parser, [{'missing': '1'}], os.path.join(folder, 'x.svg'), 1)
+            assert False
+        except KeyError:
+            pass
+        assert str(parser) == original
+        undo = substitute(parser, {'spaziatura@id': 'renamed', 'tspan3902': 'x'})
+        assert parser._id_lookup('renamed') and not parser._id_lookup('spaziatura')
+        assert parser.parent(parser._id_lookup('tspan3902')[0][VALUE][0]) is parser._id_lookup('tspan3902')[0]
+        restore(undo)
+        assert parser._id_lookup('spaziatura') and not parser._id_lookup('renamed') and str(parser) == original
+    finally:
+        shutil.rmtree(folder)
+
+
+def test3():
+    from StringIO import StringIO
+    import shutil
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    try:
+        substitutions = os.path.join(folder, 'values.jsonl')
+        with open(substitutions, 'wb') as fileobj:
+            for x in xrange(40):
+                fileobj.write(json.dumps({'tspan3902': x, 'spaziatura@width': x * 2}) + '\n')
+        out = StringIO()
+        stats = run(['test/test.svg', substitutions, '-o', os.path.join(folder, 'out%(n)i.svg'), '-j', '2',
+                     '--chunksize', '4'], out)
+        assert sum(x['files'] for x in stats.values()) == 40
+        assert 'total: 40 files' in out.getvalue()
+        assert 'width="78"' in open(os.path.join(folder, 'out39.svg'), 'rb').read()
+
+        def records():
+            for n in xrange(40):
+                # the records are read at most two windows (of 2 * WINDOW_CHUNKS) ahead of the written files
+                assert n - len(os.listdir(folder)) <= 4 * WINDOW_CHUNKS, n
+                yield {'tspan3902': str(n)}
+
+        shutil.rmtree(folder)
+        os.mkdir(folder)
+        render_batch('test/test.svg', records(), os.path.join(folder, 'out%(n)i.svg'), 2, 1)
+        assert len(os.listdir(folder)) == 40
+        assert list(_slices(xrange(5), 2)) == [[0, 1], [2, 3], [4]]
+        events = []
+
+        class Pool(object):
+            def imap_unordered(self, function, tasks, chunksize):
+                events.append(('queued', tasks[0]))
+                return (events.append(('done', x)) or x for x in tasks)
+
+        assert list(_windows(Pool(), xrange(5), 2, 1)) == range(5)
+        assert events == [('queued', 0), ('queued', 2), ('done', 0), ('done', 1), ('queued', 4), ('done', 2),
+                          ('done', 3), ('done', 4)]
+    finally:
+        shutil.rmtree(folder)
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
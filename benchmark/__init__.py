@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+__author__ = 'Roberto'
+
+from generator import iter_svg, generate, write_svg
+from runner import BACKENDS, OPERATIONS, run_case, run_suite
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: python -m benchmark [--sizes 1000,10000] [-o results.json] ..., from the root of the repository
+#
+# --------------
+
+__author__ = 'Roberto'
+
+import sys
+
+from runner import run
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: seeded generator of synthetic svg documents for the benchmarks
+#
+# --------------
+
+__author__ = 'Roberto'
+
+import base64
+import math
+import random
+
+HEADER = ('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+          '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+          'width="1000" height="1000" id="svg">\n')
+FOOTER = '</svg>\n'
+SHAPES = ('rect', 'path', 'text', 'circle')
+
+
+def _extra(rng, attrs):
+    return ''.join(' data-a%i="%i"' % (i, rng.randint(0, 99999)) for i in xrange(attrs))
+
+
+def iter_svg(elements=1000, depth=4, attrs=4, blob_size=0, blob_every=100, seed=0):
+    """
+    Yield the markup of a document of about elements elements (ids e1, e2, ...) nested in groups depth levels
+    deep, each one with attrs data-a* attributes besides its geometry. Every blob_every-th leaf is an image
+    embedding blob_size random bytes in base64 when blob_size is given. The same arguments give the same document
+    """
+    rng = random.Random(seed)
+    fanout = max(2, int(math.ceil(elements ** (1.0 / max(depth, 1)))))
+    count = [0]
+
+    def node(level):
+        count[0] += 1
+        n = count[0]
+        if level < depth - 1:
+            yield '<g id="e%i" transform="translate(%i,%i)"%s>\n' % (n, rng.randint(0, 99), rng.randint(0, 99),
+                                                                    _extra(rng, attrs))
+            for _ in xrange(fanout):
+                if count[0] >= elements:
+                    break
+                for x in node(level + 1):
+                    yield x
+            yield '</g>\n'
+            return
+        x, y = rng.randint(0, 999), rng.randint(0, 999)
+        if blob_size and n % blob_every == 0:
+            blob = base64.b64encode(''.join(chr(rng.randint(0, 255)) for _ in xrange(blob_size)))
+            yield '<image id="e%i" x="%i" y="%i" width="10" height="10" xlink:href="data:image/png;base64,%s"%s />\n' % (
+                n, x, y, blob, _extra(rng, attrs))
+            return
+        shape = SHAPES[rng.randint(0, len(SHAPES) - 1)]
+        if shape == 'rect':
+            yield '<rect id="e%i" x="%i" y="%i" width="%i" height="%i"%s />\n' % (
+                n, x, y, rng.randint(1, 99), rng.randint(1, 99), _extra(rng, attrs))
+        elif shape == 'path':
+            yield '<path id="e%i" d="M %i,%i l %i,%i z"%s />\n' % (
+                n, x, y, rng.randint(-99, 99), rng.randint(-99, 99), _extra(rng, attrs))
+        elif shape == 'circle':
+            yield '<circle id="e%i" cx="%i" cy="%i" r="%i"%s />\n' % (n, x, y, rng.randint(1, 99), _extra(rng, attrs))
+        else:
+            yield '<text id="e%i" x="%i" y="%i"%s>label %i</text>\n' % (n, x, y, _extra(rng, attrs), n)
+
+    yield HEADER
+    while count[0] < elements:
+        for x in node(0):
+            yield x
+    yield FOOTER
+
+
+def generate(elements=1000, depth=4, attrs=4, blob_size=0, blob_every=100, seed=0):
+    return ''.join(iter_svg(elements, depth, attrs, blob_size, blob_every, seed))
+
+
+def write_svg(path, elements=1000, depth=4, attrs=4, blob_size=0, blob_every=100, seed=0):
+    with open(path, 'wb') as fileobj:
+        for chunk in iter_svg(elements, depth, attrs, blob_size, blob_every, seed):
+            fileobj.write(chunk)
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    import re
+
+    data = generate(1000, depth=3, attrs=2, seed=7)
+    assert data == generate(1000, depth=3, attrs=2, seed=7) and data != generate(1000, depth=3, attrs=2, seed=8)
+    assert len(re.findall(r'<\w+ id="e\d+"', data)) == 1000
+    assert 'id="e1000"' in data and 'id="e1001"' not in data
+    assert 'data-a1=' in data and 'data-a2=' not in data
+
+
+def test2():
+    from generic_parser import GenericParser
+
+    data = generate(300, depth=5, blob_size=30, blob_every=10)
+    assert data.count('base64,') == len([x for x in xrange(1, 301) if x % 10 == 0 and 'id="e%i"' % x in data
+                                         and '<image id="e%i"' % x in data]) > 0
+    parser = GenericParser()
+    parser.loads(data)
+    assert len(parser.select('*')) == 301
+    assert len(parser.select('svg > g > g > g > g > *')) > 0 and parser.select('svg > g > g > g > g > g') == []
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: time the same operations on every parser over synthetic documents, results in json
+#
+# --------------
+
+__author__ = 'Roberto'
+
+import json
+import multiprocessing
+import os
+import platform
+import sqlite3
+import tempfile
+import time
+
+from generator import generate
+
+OPERATIONS = ('parse', 'tag', 'id', 'attr', 'serialize', 'mutate', 'clone', 'save_snapshot', 'load_snapshot')
+SIZES = (1000, 10000)
+
+
+class _Sink(object):
+    """
+    A file counting the bytes written to it
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def _snapshot(parser, cls, ops):
+    """
+    The snapshot operations: save the parser, then load the file into a new one (and remove it)
+    """
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    def load():
+        try:
+            ret = cls()
+            ret.load_snapshot(path)
+            return ret
+        finally:
+            os.remove(path)
+
+    ops['save_snapshot'] = lambda: parser.save_snapshot(path)
+    ops['load_snapshot'] = load
+
+
+def speedup(result):
+    """
+    How many times load_snapshot is faster than parsing the document, None without snapshots
+    """
+    seconds = result['seconds']
+    if seconds['load_snapshot'] is None:
+        return None
+    return seconds['parse'] / max(seconds['load_snapshot'], 1e-6)
+
+
+def _generic(data, elements):
+    from generic_parser import GenericParser
+    from node import Node
+
+    parser = GenericParser()
+    ops = dict()
+    ops['parse'] = lambda: parser.loads(data)
+    ops['tag'] = lambda: Node(parser).tag('rect')
+    ops['id'] = lambda: Node(parser).id('e%i' % (elements // 2))
+    ops['attr'] = lambda: parser.select('[data-a0^="1"]')
+    ops['serialize'] = lambda: parser.write(_Sink())
+    ops['mutate'] = lambda: Node(parser).tag('rect').translate(1, 1)
+    ops['clone'] = lambda: parser.replicate(parser._id_lookup('e2')[0], 1, 2, 10, 0)
+    _snapshot(parser, GenericParser, ops)
+    return ops
+
+
+def _records(cls):
+    def build(data, elements):
+        parser = cls()
+        ops = dict()
+        ops['parse'] = lambda: parser.loads(data)
+        ops['tag'] = lambda: parser.tag('rect')
+        ops['id'] = lambda: parser.id('e%i' % (elements // 2))
+        ops['attr'] = lambda: parser.attr(**{'data-a0': '1%'})
+        ops['serialize'] = lambda: parser.write(_Sink())
+        ops['mutate'] = lambda: parser.translate(parser.tag('rect'), 1, 1)
+        ops['clone'] = lambda: parser.replicate(parser.id('e2'), 1, 2, 10, 0)
+        if hasattr(parser, 'save_snapshot'):
+            _snapshot(parser, cls, ops)
+        return ops
+
+    return build
+
+
+def _dict(data, elements):
+    from dict_parser import DictParser
+
+    return _records(DictParser)(data, elements)
+
+
+def _db(data, elements):
+    from db_parser import DbParser
+
+    return _records(DbParser)(data, elements)
+
+
+BACKENDS = (('generic', _generic), ('dict', _dict), ('db', _db))
+
+
+def _memory():
+    """
+    The method name and the (start, peak) functions measuring the memory: tracemalloc bytes when available, else the
+    resident set high-water mark of the process from resource (kilobytes on linux)
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        import resource
+
+        def rss():
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        base = []
+        return 'ru_maxrss', lambda: base.append(rss()), lambda: rss() - base[0]
+    return ('tracemalloc', lambda: tracemalloc.start(),
+            lambda: tracemalloc.get_traced_memory()[1])
+
+
+def run_case(backend, elements, depth=4, attrs=4, blob_size=0, blob_every=100, seed=0, repeat=1):
+    """
+    Time OPERATIONS (in this order, the best of repeat runs of the queries) on backend over the generated document,
+    None for the ones the backend does not have
+    """
+    data = generate(elements, depth, attrs, blob_size, blob_every, seed)
+    build = dict(BACKENDS)[backend]
+    method, start, peak = _memory()
+    start()
+    ops = build(data, elements)
+    timings = dict()
+    found = dict()
+    for name in OPERATIONS:
+        if name not in ops:
+            timings[name] = None
+            continue
+        best = None
+        for _ in xrange(repeat if name in ('tag', 'id', 'attr', 'serialize') else 1):
+            t0 = time.time()
+            ret = ops[name]()
+            elapsed = time.time() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        if name in ('tag', 'id', 'attr'):
+            found[name] = len(ret)
+    return {'backend': backend, 'elements': elements, 'bytes': len(data), 'seconds': timings, 'found': found,
+            'peak_memory': peak(), 'memory_method': method}
+
+
+def _run_case(kwargs):
+    return run_case(**kwargs)
+
+
+def run_suite(sizes=SIZES, backends=None, depth=4, attrs=4, blob_size=0, blob_every=100, seed=0, repeat=1,
+              isolate=True):
+    """
+    run_case for each backend and size, each one in a fresh process when isolate so that the memory peaks
+    do not mix. Return the whole report
+    """
+    results = []
+    for elements in sizes:
+        for backend in backends or [x for x, _ in BACKENDS]:
+            kwargs = dict(backend=backend, elements=elements, depth=depth, attrs=attrs, blob_size=blob_size,
+                          blob_every=blob_every, seed=seed, repeat=repeat)
+            if isolate:
+                pool = multiprocessing.Pool(1)
+                try:
+                    results.append(pool.apply(_run_case, (kwargs,)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results.append(run_case(**kwargs))
+    return {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+            'time': time.time(), 'params': {'depth': depth, 'attrs': attrs, 'blob_size': blob_size,
+                                            'blob_every': blob_every, 'seed': seed, 'repeat': repeat},
+            'results': results}
+
+
+def run(argv, out=None):
+    """
+    python -m benchmark [--sizes 1000,10000] [--backends generic,dict,db] [-o results.json] ...
+    """
+    import argparse
+    import sys
+
+    arg_parser = argparse.ArgumentParser(prog='benchmark')
+    arg_parser.add_argument('--sizes', default=','.join(str(x) for x in SIZES), help='default %(default)s')
+    arg_parser.add_argument('--backends', default=','.join(x for x, _ in BACKENDS), help='default %(default)s')
+    arg_parser.add_argument('--depth', type=int, default=4)
+    arg_parser.add_argument('--attrs', type=int, default=4)
+    arg_parser.add_argument('--blob-size', type=int, default=0)
+    arg_parser.add_argument('--blob-every', type=int, default=100)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('-o', '--output', default='benchmark.json')
+    args = arg_parser.parse_args(argv)
+    report = run_suite([int(x) for x in args.sizes.split(',')], args.backends.split(','), args.depth, args.attrs,
+                       args.blob_size, args.blob_every, args.seed, args.repeat)
+    with open(args.output, 'wb') as fileobj:
+        json.dump(report, fileobj, indent=1, sort_keys=True)
+    out = out or sys.stdout
+    for result in report['results']:
+        ratio = speedup(result)
+        out.write('%-8s %8i %s speedup=%s\n' % (result['backend'], result['elements'], ' '.join(
+            '%s=%s' % (x, '-' if result['seconds'][x] is None else '%.4f' % result['seconds'][x]) for x in OPERATIONS),
+            '-' if ratio is None else '%.1fx' % ratio))
+    return report
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    results = run_suite((300,), blob_size=20, isolate=False)['results']
+    assert [x['backend'] for x in results] == [x for x, _ in BACKENDS]
+    for result in results:
+        assert sorted(result['seconds']) == sorted(OPERATIONS)
+        assert result['found'] == results[0]['found'] and result['found']['id'] == 1, result
+        assert result['peak_memory'] >= 0
+    assert [x['seconds']['load_snapshot'] is None for x in results] == [False, False, True]
+
+
+def test2():
+    from StringIO import StringIO
+    import os
+    import tempfile
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        out = StringIO()
+        run(['--sizes', '200', '--backends', 'dict', '--repeat', '1', '-o', path], out)
+        report = json.load(open(path, 'rb'))
+        assert out.getvalue().startswith('dict') and ' speedup=' in out.getvalue()
+        assert report['params']['seed'] == 0 and len(report['results']) == 1
+        assert report['results'][0]['backend'] == 'dict' and report['results'][0]['elements'] == 200
+    finally:
+        os.remove(path)
+
+
+def test3():
+    # parsing again is what the snapshots save
+    for backend in ('generic', 'dict'):
+        ratio = speedup(run_case(backend, 2000))
+        assert ratio > 2, (backend, ratio)
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: compact slotted nodes for GenericParser(compact=True), readable as the usual dict nodes
+#
+# --------------
+
+__author__ = 'Roberto'
+
+import sys
+
+from attr_map import AttrMap, attr_items as _attr_items
+
+ATTRS = 'attrs'
+TAG_NAME = 'tag_name'
+VALUE = 'value'
+TYPE = 'type'
+#element types
+COMMENT = '__comment__'
+DATA = '__data__'
+DECL = '__decl__'
+TAG = '__tag__'
+PI = '__pi__'
+
+# integer kind codes, KINDS[code] is the type of the dict nodes
+TAG_KIND, DATA_KIND, COMMENT_KIND, DECL_KIND, PI_KIND = range(5)
+KINDS = (TAG, DATA, COMMENT, DECL, PI)
+
+def intern_name(name):
+    """
+    The shared copy of a tag or attribute name: the interpreter table of interned strings, that forgets the names
+    no node uses any more (intern takes no unicode, those are kept as they are)
+    """
+    return intern(name) if type(name) is str else name
+
+
+class CompactNode(object):
+    """
+    Base of the compact nodes: node[TYPE], node[VALUE], node.get(...) work as on the dict nodes
+    """
+    __slots__ = ('value',)
+    kind = None
+    _keys = (TYPE, VALUE)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __getitem__(self, key):
+        if key == TYPE:
+            return KINDS[self.kind]
+        if key == VALUE:
+            return self.value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == VALUE:
+            self.value = value
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def items(self):
+        return [(k, self[k]) for k in self._keys]
+
+    def to_dict(self):
+        return {TYPE: self[TYPE], VALUE: self.value}
+
+    def __eq__(self, other):
+        if isinstance(other, CompactNode):
+            return self.kind == other.kind and self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class Data(CompactNode):
+    __slots__ = ()
+    kind = DATA_KIND
+
+
+class Comment(CompactNode):
+    __slots__ = ()
+    kind = COMMENT_KIND
+
+
+class Decl(CompactNode):
+    __slots__ = ()
+    kind = DECL_KIND
+
+
+class Pi(CompactNode):
+    __slots__ = ()
+    kind = PI_KIND
+
+
+class Element(CompactNode):
+    __slots__ = ('tag_name', 'attrs')
+    kind = TAG_KIND
+    _keys = (TYPE, TAG_NAME, ATTRS, VALUE)
+
+    def __init__(self, tag_name, attrs, value):
+        CompactNode.__init__(self, value)
+        self.tag_name = intern_name(tag_name)
+        self.attrs = AttrMap([(intern_name(k), v) for k, v in _attr_items(attrs)])
+
+    def __getitem__(self, key):
+        if key == TAG_NAME:
+            return self.tag_name
+        if key == ATTRS:
+            return self.attrs
+        return CompactNode.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        if key == TAG_NAME:
+            self.tag_name = intern_name(value)
+        elif key == ATTRS:
+            self.attrs = value
+        else:
+            CompactNode.__setitem__(self, key, value)
+
+    def to_dict(self):
+        return {TYPE: TAG, TAG_NAME: self.tag_name, ATTRS: self.attrs, VALUE: self.value}
+
+
+_CLASSES = {DATA: Data, COMMENT: Comment, DECL: Decl, PI: Pi}
+
+
+def make_node(node_type, value, tag_name=None, attrs=None):
+    """
+    The compact node of type node_type, the counterpart of the dict one built by GenericParser
+    """
+    if node_type == TAG:
+        return Element(tag_name, attrs, value)
+    return _CLASSES[node_type](value)
+
+
+def to_compact(lista):
+    """
+    A compact copy of a dom of dict (or compact) nodes
+    """
+    ret = []
+    for x in lista:
+        if x[TYPE] == TAG:
+            ret.append(Element(x[TAG_NAME], x[ATTRS], to_compact(x[VALUE])))
+        else:
+            ret.append(make_node(x[TYPE], x[VALUE]))
+    return ret
+
+
+def to_dicts(lista):
+    """
+    A copy of a dom made of dict nodes
+    """
+    ret = []
+    for x in lista:
+        if x[TYPE] == TAG:
+            ret.append({TYPE: TAG, TAG_NAME: x[TAG_NAME], ATTRS: AttrMap(_attr_items(x[ATTRS])),
+                        VALUE: to_dicts(x[VALUE])})
+        else:
+            ret.append({TYPE: x[TYPE], VALUE: x[VALUE]})
+    return ret
+
+
+def _sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += _sizeof(k, seen) + _sizeof(v, seen)
+    elif isinstance(obj, (list, tuple)):
+        for x in obj:
+            size += _sizeof(x, seen)
+    else:
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                size += _sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def footprint(build):
+    """
+    Bytes allocated by build(), measured with tracemalloc when available, else the sys.getsizeof
+    total of the object graph it returns
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return _sizeof(build(), set())
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        ret = build()
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del ret
+    return size
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    elem = make_node(TAG, [make_node(DATA, 'x')], 'g', [('id', 'a')])
+    assert elem == {TYPE: TAG, TAG_NAME: 'g', ATTRS: AttrMap([('id', 'a')]), VALUE: [{TYPE: DATA, VALUE: 'x'}]}
+    assert elem[TYPE] == TAG and elem.get(ATTRS) == {'id': 'a'} and elem.get('missing') is None
+    assert elem[VALUE][0] != make_node(COMMENT, 'x')
+    assert make_node(TAG, [], 'g', [('id', 'b')]).tag_name is elem.tag_name
+    assert make_node(TAG, [], ''.join(['re', 'ct']), ()).tag_name is intern('rect')
+    assert make_node(TAG, [], u'g', ()).tag_name == u'g'
+    try:
+        elem['missing']
+        assert False
+    except KeyError:
+        pass
+    elem[ATTRS]['id'] = 'b'
+    assert to_dicts([elem]) == [{TYPE: TAG, TAG_NAME: 'g', ATTRS: AttrMap([('id', 'b')]), VALUE: [{TYPE: DATA, VALUE: 'x'}]}]
+    assert to_compact(to_dicts([elem])) == [elem]
+    attrs = elem[ATTRS]
+    parts = (attrs, attrs._keys, attrs._values, attrs._dead, 'id', 'b')
+    assert _sizeof(attrs, set()) == sum(sys.getsizeof(x) for x in parts)
+
+
+def test2():
+    import copy
+    from generic_parser import GenericParser
+
+    parser = GenericParser()
+    parser.load('test/test.svg')
+    compact = GenericParser(compact=True)
+    compact.load('test/test.svg')
+    assert str(compact) == str(parser)
+    assert compact.dom == parser.dom
+    assert compact.dom[-2].kind == TAG_KIND and not isinstance(compact.dom[-2], dict)
+    assert str(GenericParser(compact.dom)) == str(parser)
+    assert str(GenericParser(parser.dom, compact=True)) == str(parser)
+    assert copy.deepcopy(compact.dom) == compact.dom
+    for repeated in (GenericParser(), GenericParser(compact=True)):
+        repeated.loads('<svg><rect x="1" y="0" x="2"/></svg>')
+        assert '<rect x="1" y="0" x="2"/>' in str(repeated) and repeated.dom[0][VALUE][0][ATTRS]['x'] == '2'
+
+
+def test3():
+    from generic_parser import GenericParser
+
+    data = open('test/test.svg', 'rb').read().replace('<svg', '<g').replace('</svg>', '</g>')
+    data = '<svg>%s</svg>' % (data[data.index('<g'):] * 20)
+
+    def build(compact):
+        parser = GenericParser(compact=compact)
+        parser.loads(data)
+        return parser.dom
+
+    dicts = footprint(lambda: build(False))
+    compacts = footprint(lambda: build(True))
+    assert compacts < dicts
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
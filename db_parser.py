@@ -17,11 +17,24 @@
 __author__ = 'Roberto'
 
 from HTMLParser import HTMLParser, HTMLParseError
+from functools import partial
 import sqlite3 as sqlite
-import re
+import threading
+
+from db_pool import ConnectionPool
+from pattern_cache import regexp, register_regexp
+from loader import read_chunks, READ_SIZE
+from serializer import iter_markup, coalesce, CHUNK_SIZE
+from geometry import AttrStamp, move_mode, grid, ID_SUFFIX, MOVE_ROOT
+from geometry import affine_updates, scale_about, numeric_updates, parse_attr, Geometry
+from selector import compile_selector, CHILD
+from ordering import GAP, between, renumber
+from fragment import feed_fragment
 
 #DATABASE = r'c:\temp\temp.sqlite'
 DATABASE = r':memory:'
+# bound parameters per statement, the oldest sqlite builds allow 999
+MAX_VARIABLES = 900
 #element types
 COMMENT = '__comment__'
 DATA = '__data__'
@@ -45,6 +58,10 @@ CREATE TABLE `elem` (
   `sort_order` INTEGER DEFAULT NULL,
   FOREIGN KEY(`parent_id`) REFERENCES elem(`id`)
 );
+|||
+CREATE INDEX `elem_parent_id_sort_order` ON `elem` (`parent_id`, `sort_order`);
+|||
+CREATE INDEX `elem_type_data` ON `elem` (`type`, `data`);
 
 |||
 
@@ -60,8 +77,13 @@ CREATE TABLE `attr` (
   `k` VARCHAR DEFAULT NULL,
   `v` TEXT DEFAULT NULL,
   `elem_id` INTEGER DEFAULT NULL,
-  FOREIGN KEY(`elem_id`) REFERENCES elem(`id`)
+  FOREIGN KEY(`elem_id`) REFERENCES elem(`id`),
+  -- one value per key, the target of the upserts of DbParser
+  UNIQUE(`elem_id`, `k`)
 );
+|||
+-- NOCASE so that the LIKE prefix ranges built by DbParser.attr can use it
+CREATE INDEX `attr_k_v` ON `attr` (`k`, `v` COLLATE NOCASE);
 """
 
 
@@ -69,9 +91,138 @@ class DbParserException(HTMLParseError):
     pass
 
 
-def regexp(expr, item):
-    reg = re.compile(expr)
-    return reg.search(item) is not None
+def _like_prefix(pattern):
+    """
+    The literal part of a LIKE pattern before the first wildcard
+    """
+    for i, c in enumerate(pattern):
+        if c in '%_':
+            return pattern[:i]
+    return pattern
+
+
+def _nocase_range(alias, prefix):
+    """
+    Sql condition (and its values) on the NOCASE attr_k_v index bounding the values starting with prefix
+    (ignoring the case), None when the prefix gives no bound: empty, unicode or not ascii (NOCASE folds
+    only the ascii letters, the byte after the last one may not exist)
+    """
+    if not prefix or isinstance(prefix, unicode) or max(prefix) >= '\x7f':
+        return None
+    low = prefix.lower()
+    return ('%s.v COLLATE NOCASE >= ? AND %s.v COLLATE NOCASE < ?' % (alias, alias),
+            [low, low[:-1] + chr(ord(low[-1]) + 1)])
+
+
+def _attr_condition(alias, function, k, v):
+    """
+    Sql condition (and its values) matching the attribute k against v, written so that sqlite
+    can search the attr_k_v index instead of scanning the table. A key with the LIKE wildcards is matched
+    with function as well: the keyword arguments have no ':', sodipodi_role stands for sodipodi:role
+    """
+    if function == '=' or not (set(k) & set('%_')):
+        sql = ['%s.k = ?' % alias]
+    else:
+        sql = ['%s.k %s ?' % (alias, function)]
+    values = [k]
+    if function.upper() == 'LIKE' and isinstance(v, basestring) and _nocase_range(alias, _like_prefix(v)):
+        # LIKE is case insensitive as the NOCASE index, the range on the lowered prefix is exact
+        condition, bounds = _nocase_range(alias, _like_prefix(v))
+        sql.append(condition)
+        values.extend(bounds)
+    elif function == '=':
+        sql.append('%s.v COLLATE NOCASE = ?' % alias)
+        values.append(v)
+    sql.append('%s.v %s ?' % (alias, function))
+    values.append(v)
+    return ' AND '.join(sql), values
+
+
+# selector attribute operators on a.v, the value bound twice where it appears twice
+_SELECTOR_TESTS = {
+    '^=': 'substr(a.v, 1, length(?)) = ?',
+    '$=': 'substr(a.v, -length(?)) = ?',
+    '*=': 'instr(a.v, ?) > 0',
+    '~=': "instr(' ' || replace(replace(replace(a.v, char(9), ' '), char(10), ' '), char(13), ' ') || ' ', ?) > 0",
+}
+
+
+def _compound_condition(compound):
+    """
+    Sql condition (and its values) on the elem alias e matching a compound of a css selector
+    """
+    sql = ['e.type = ?']
+    values = [TAG]
+    if compound.tag is not None:
+        sql.append('e.data = ?')
+        values.append(compound.tag)
+    for k, op, v in compound.tests:
+        if op is None:
+            sql.append('EXISTS (SELECT 1 FROM attr a WHERE a.elem_id = e.id AND a.k = ?)')
+            values.append(k)
+        elif op == '=':
+            condition, condition_values = _attr_condition('a', '=', k, v)
+            sql.append('e.id IN (SELECT a.elem_id FROM attr a WHERE %s)' % condition)
+            values.extend(condition_values)
+        elif not v or op == '~=' and len(v.split()) != 1:
+            # as in selector.py: nothing matches an empty value, nor a word with spaces inside
+            sql.append('0')
+        else:
+            condition = ['a.k = ?']
+            condition_values = [k]
+            if op == '^=' and _nocase_range('a', v):
+                bound, bounds = _nocase_range('a', v)
+                condition.append(bound)
+                condition_values.extend(bounds)
+            condition.append(_SELECTOR_TESTS[op])
+            if op == '~=':
+                condition_values.append(' %s ' % v)
+            elif op == '*=':
+                condition_values.append(v)
+            else:
+                condition_values.extend((v, v))
+            sql.append('e.id IN (SELECT a.elem_id FROM attr a WHERE %s)' % ' AND '.join(condition))
+            values.extend(condition_values)
+    return ' AND '.join(sql), values
+
+
+def _selector_sql(group, scoped):
+    """
+    The common table expressions (and their values) of a selector group, one table of matching ids
+    for each compound joined to the previous one through parent_id (recursively for the descendants),
+    and the union of the last ones. When scoped the first compounds must be in the table scope
+    """
+    ctes = []
+    values = []
+    lasts = []
+    for i, selector in enumerate(group.selectors):
+        previous = None
+        for j, compound in enumerate(selector.compounds):
+            condition, condition_values = _compound_condition(compound)
+            name = 's%i_%i' % (i, j)
+            if previous is None:
+                if scoped:
+                    condition += ' AND e.id IN scope'
+                ctes.append('%s(id) AS (SELECT e.id FROM elem e WHERE %s)' % (name, condition))
+            elif selector.combinators[j - 1] == CHILD:
+                ctes.append('%s(id) AS (SELECT e.id FROM %s CROSS JOIN elem e ON e.parent_id = %s.id WHERE %s)' % (
+                    name, previous, previous, condition))
+            else:
+                down = 'd%i_%i' % (i, j)
+                ctes.append('%s(id) AS (SELECT elem.id FROM %s CROSS JOIN elem ON elem.parent_id = %s.id '
+                            'UNION SELECT elem.id FROM %s CROSS JOIN elem ON elem.parent_id = %s.id)' % (
+                                down, previous, previous, down, down))
+                ctes.append('%s(id) AS (SELECT e.id FROM %s CROSS JOIN elem e ON e.id = %s.id WHERE %s)' % (
+                    name, down, down, condition))
+            values.extend(condition_values)
+            previous = name
+        lasts.append('SELECT id FROM %s' % previous)
+    return ctes, values, ' UNION '.join(lasts)
+
+
+# the later value of a key wins, a repeated attribute of the source as well
+UPSERT_ATTR = ('INSERT INTO attr (`k`,`v`,`elem_id`) VALUES (?,?,?) '
+               'ON CONFLICT(`elem_id`, `k`) DO UPDATE SET `v`=excluded.`v`;')
 
 
 def render_attrs(attrs, prefix=''):
@@ -81,37 +232,127 @@ def render_attrs(attrs, prefix=''):
     return prefix + ' '.join(ret)
 
 
-def make_db_connection():
-    out_conn = sqlite.connect(DATABASE, detect_types=sqlite.PARSE_DECLTYPES, check_same_thread=False)
+def make_db_connection(database=DATABASE, reset=True):
+    """
+    Connect to database, recreating the schema when reset (an existing database keeps its rows otherwise)
+    """
+    out_conn = ConnectionPool(database, register_regexp)
     out_conn.text_factory = str
-    out_conn.create_function("REGEXP", 2, regexp)
-    for sql in SCHEMA.split('|||'):
-        out_conn.execute(sql)
-    out_conn.commit()
+    if reset:
+        for sql in SCHEMA.split('|||'):
+            out_conn.execute(sql)
+        out_conn.commit()
     return out_conn
 
 
 class DbParser(HTMLParser):
-    def __init__(self, html=None):
-        self._conn = make_db_connection()
+    def __init__(self, html=None, database=DATABASE, reset=True):
+        self._conn = make_db_connection(database, reset)
         self._sort_order = 0
+        # parent of the top level nodes (the fragments of insert_after have their own, see fragment.py)
+        self._root_id = 0
         HTMLParser.__init__(self)
         self._tag_tree = []
+        self._elem_buffer = None
+        self._attr_buffer = None
+        # (elem id, k) -> parsed attribute, the edited ones waiting to be written back (by the first query of any
+        # thread, one at a time)
+        self._geometry = dict()
+        self._geometry_dirty = dict()
+        # held by every write: the bulk buffers, the ids read before the first insert, the sort_order and the
+        # geometry write-back are one thread's at a time
+        self._write_lock = threading.RLock()
+        self._readonly = False
+        if not reset:
+            self._restore_order()
         if html is not None:
-            self.feed(html)
+            self.loads(html)
+
+    def set_readonly(self):
+        """
+        Refuse the writes from now on (PRAGMA query_only): the values of geometry() can be read, not edited
+        """
+        self._conn.execute('PRAGMA query_only = ON;')
+        self._readonly = True
+
+    def _restore_order(self):
+        """
+        Continue the sort_order of the rows already in the database
+        """
+        self._sort_order = self._query('SELECT COALESCE(MAX(sort_order), 0) FROM elem;')[0][0]
 
     def loads(self, data):
-        self.feed(data)
+        with self._write_lock:
+            self._begin_bulk()
+            try:
+                self.feed(data)
+            finally:
+                self._flush()
 
-    def load(self, filename):
-        self.loads(open(filename, 'rb').read())
+    def load(self, source, chunk_size=READ_SIZE, progress=None):
+        with self._write_lock:
+            self._begin_bulk()
+            try:
+                for chunk, loaded, total in read_chunks(source, chunk_size):
+                    self.feed(chunk)
+                    if progress is not None:
+                        progress(loaded, total)
+            finally:
+                self._flush()
+
+    def feed(self, data):
+        # the handle_* callbacks insert the nodes
+        with self._write_lock:
+            HTMLParser.feed(self, data)
+
+    def close(self):
+        with self._write_lock:
+            HTMLParser.close(self)
+
+    def iter_load(self, source, chunk_size=READ_SIZE, progress=None):
+        """
+        Feed source (a file name or a file-like object) chunk by chunk, committing and yielding (loaded,
+        total) after each one: the part of the document already read can be queried in the meantime
+        """
+        for chunk, loaded, total in read_chunks(source, chunk_size):
+            self.loads(chunk)
+            if progress is not None:
+                progress(loaded, total)
+            yield loaded, total
 
-    def _shift_order(self):
-        self._conn.execute('UPDATE elem SET sort_order = sort_order*10')
+    def _begin_bulk(self):
+        """
+        Buffer the rows produced by the handle_* callbacks instead of inserting them one by one,
+        ids are assigned here and not by sqlite
+        """
+        cursor = self._conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM elem;')
+        self._last_elem_id = cursor.fetchone()[0]
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM attr;')
+        self._last_attr_id = cursor.fetchone()[0]
+        self._elem_buffer = []
+        self._attr_buffer = []
+
+    def _flush(self):
+        """
+        Write the buffered rows with a single transaction
+        """
+        if self._elem_buffer:
+            self._conn.executemany('INSERT INTO elem (`id`,`type`,`data`,`parent_id`,`sort_order`) VALUES (?,?,?,?,?);',
+                                   self._elem_buffer)
+        if self._attr_buffer:
+            self._conn.executemany('INSERT INTO attr (`id`,`k`,`v`,`elem_id`) VALUES (?,?,?,?) '
+                                   'ON CONFLICT(`elem_id`, `k`) DO UPDATE SET `v`=excluded.`v`;', self._attr_buffer)
         self._conn.commit()
+        self._elem_buffer = None
+        self._attr_buffer = None
 
     def _insert_elem(self, elem_type, data, parent_id=0):
-        self._sort_order += 1
+        self._sort_order += GAP
+        if self._elem_buffer is not None:
+            self._last_elem_id += 1
+            self._elem_buffer.append((self._last_elem_id, elem_type, data, parent_id, self._sort_order))
+            return self._last_elem_id
         cursor = self._conn.cursor()
         cursor.execute('INSERT INTO elem (`type`,`data`,`parent_id`,`sort_order`) VALUES (?,?,?,?);',
                        (elem_type, data, parent_id, self._sort_order))
@@ -122,6 +363,16 @@ class DbParser(HTMLParser):
     def set_elem_value(self, _id, value):
         return self._update_elem(_id, data=value)
 
+    def set_elem_values(self, values):
+        """
+        Set the data of many elements, values is a dict or (id, value) pairs, with a single transaction
+        """
+        if isinstance(values, dict):
+            values = values.items()
+        with self._write_lock:
+            self._conn.executemany('UPDATE elem SET data=? WHERE id=?;', [(v, _id) for _id, v in values])
+            self._conn.commit()
+
     def _update_elem(self, _id, **vals_to_update):
         cursor = self._conn.cursor()
         sql = []
@@ -131,32 +382,37 @@ class DbParser(HTMLParser):
             vals.append(v)
         vals.append(_id)
         sql = ','.join(sql)
-        cursor.execute('UPDATE elem SET ' + sql + '  WHERE id=?', vals)
-        self._conn.commit()
-        cursor.execute('SELECT last_insert_rowid()')
-        return cursor.fetchone()[0]
+        with self._write_lock:
+            cursor.execute('UPDATE elem SET ' + sql + '  WHERE id=?', vals)
+            self._conn.commit()
+            cursor.execute('SELECT last_insert_rowid()')
+            return cursor.fetchone()[0]
 
     def _insert_attr(self, k, v, elem_id=0):
+        if self._attr_buffer is not None:
+            self._last_attr_id += 1
+            self._attr_buffer.append((self._last_attr_id, k, v, elem_id))
+            return self._last_attr_id
         cursor = self._conn.cursor()
-        cursor.execute('INSERT INTO attr (`k`,`v`,`elem_id`) VALUES (?,?,?);', (k, v, elem_id))
+        cursor.execute(UPSERT_ATTR, (k, v, elem_id))
         self._conn.commit()
         cursor.execute('SELECT last_insert_rowid()')
         return cursor.fetchone()[0]
 
     def handle_decl(self, decl):
-        self._insert_elem(DECL, decl, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        self._insert_elem(DECL, decl, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
 
     def handle_pi(self, data):
-        self._insert_elem(PI, data, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        self._insert_elem(PI, data, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
 
     def handle_comment(self, data):
-        self._insert_elem(COMMENT, data, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        self._insert_elem(COMMENT, data, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
 
     def handle_data(self, data):
-        self._insert_elem(DATA, data, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        self._insert_elem(DATA, data, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
 
     def handle_starttag(self, tag, attrs):
-        last_id = self._insert_elem(TAG, tag, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        last_id = self._insert_elem(TAG, tag, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
         self._tag_tree.append({'tag': tag, 'id': last_id})
         for k, v in attrs:
             self._insert_attr(k, v, last_id)
@@ -167,38 +423,81 @@ class DbParser(HTMLParser):
         else:
             raise DbParserException('x')
 
+    def _query(self, sql, vals=()):
+        if self._geometry_dirty:
+            self._write_geometry()
+        cursor = self._conn.cursor()
+        cursor.execute(sql, vals)
+        return cursor.fetchall()
+
     def _select_elem(self, **where):
         if not where:
             where = {'parent_id': 0}
-        cursor = self._conn.cursor()
         sql = []
         vals = []
         for k, v in where.items():
             sql.append(k + '=?')
             vals.append(v)
         sql = ' AND '.join(sql)
-        cursor.execute('SELECT * FROM elem WHERE ' + sql + ' ORDER BY sort_order;', vals)
-        ret = cursor.fetchall()
-        return ret
+        return self._query('SELECT * FROM elem WHERE ' + sql + ' ORDER BY sort_order;', vals)
 
     def _select_attr(self, i=0):
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT k,v FROM attr WHERE elem_id=?;', (i,))
-        ret = cursor.fetchall()
-        return ret
+        return self._query('SELECT k,v FROM attr WHERE elem_id=? ORDER BY id;', (i,))
 
-    def _update_attr(self, key, value, elem_id=0):
-        self._conn.execute('UPDATE attr SET v=? WHERE elem_id=? AND k=?;', (value, elem_id, key))
-        self._conn.commit()
+    def geometry(self, rec, k):
+        """
+        The attribute k of rec parsed in a Geometry (see geometry.py), cached until the attribute is set again.
+        Its edits are written back, with one transaction, before the next query
+        """
+        key = (rec[0], k)
+        try:
+            return self._geometry[key]
+        except KeyError:
+            pass
+        rows = self._query('SELECT v FROM attr WHERE elem_id=? AND k=? ORDER BY id;', key)
+        if not rows:
+            raise KeyError(k)
+        value = self._geometry[key] = parse_attr(k, rows[0][0])
+        if self._readonly:
+            value.listener = partial(self._refuse_geometry, key)
+        else:
+            value.listener = partial(self._geometry_dirty.__setitem__, key)
+        return value
+
+    def _refuse_geometry(self, key, value):
+        # the edited value leaves the cache, the next geometry() parses the stored text again
+        self._forget_geometry(*key)
+        raise sqlite.OperationalError('attempt to write a readonly database: %s of element %i' % (key[1], key[0]))
+
+    def _write_geometry(self):
+        with self._write_lock:
+            # taken one by one, a value edited meanwhile by another thread stays for the next write
+            rows = []
+            while self._geometry_dirty:
+                (elem_id, k), value = self._geometry_dirty.popitem()
+                rows.append((str(value), elem_id, k))
+            if rows:
+                self._conn.executemany('UPDATE attr SET v=? WHERE elem_id=? AND k=?;', rows)
+                self._conn.commit()
+
+    def _forget_geometry(self, elem_id, k):
+        with self._write_lock:
+            self._geometry.pop((elem_id, k), None)
+            self._geometry_dirty.pop((elem_id, k), None)
 
     def set_attr(self, recs, **params):
+        """
+        Set the attributes params on each of recs, updating or adding them with a single upsert transaction
+        """
+        rows = []
         for rec in recs:
-            attr = self._select_attr(rec[0])
             for k, v in params.items():
-                if k in (x[0] for x in attr):
-                    self._update_attr(k, v, rec[0])
-                else:
-                    self._insert_attr(k, v, rec[0])
+                self._forget_geometry(rec[0], k)
+                rows.append((k, str(v) if isinstance(v, Geometry) else v, rec[0]))
+        if rows:
+            with self._write_lock:
+                self._conn.executemany(UPSERT_ATTR, rows)
+                self._conn.commit()
 
     def get_attr(self, recs, wrapper=list):
         ret = []
@@ -206,14 +505,71 @@ class DbParser(HTMLParser):
             ret.append(wrapper(self._select_attr(rec[0])))
         return ret
 
+    def _tag_recs(self, recs):
+        ret = []
+        seen = set()
+        for rec in recs:
+            if rec[1] == TAG and rec[0] not in seen:
+                ret.append(rec)
+                seen.add(rec[0])
+        return ret
+
+    def _select_attrs(self, recs):
+        """
+        The attributes of each of recs, a list of (k, v) for each one, read with one query every MAX_VARIABLES
+        """
+        ids = [rec[0] for rec in recs]
+        attrs = dict((x, []) for x in ids)
+        for start in xrange(0, len(ids), MAX_VARIABLES):
+            chunk = ids[start:start + MAX_VARIABLES]
+            for elem_id, k, v in self._query('SELECT elem_id,k,v FROM attr WHERE elem_id IN (%s) ORDER BY elem_id, id;' %
+                                             ','.join('?' * len(chunk)), chunk):
+                attrs[elem_id].append((k, v))
+        return [attrs[x] for x in ids]
+
+    def _apply_updates(self, recs, updates):
+        """
+        Write the changed attributes of recs with a single upsert transaction
+        """
+        rows = []
+        for rec, changes in zip(recs, updates):
+            for k, v in changes.items():
+                self._forget_geometry(rec[0], k)
+                rows.append((k, str(v), rec[0]))
+        with self._write_lock:
+            if rows:
+                self._conn.executemany(UPSERT_ATTR, rows)
+            self._conn.commit()
+
+    def translate(self, recs, dx, dy):
+        """
+        Move the elements of recs by dx, dy, the whole selection in one vectorized step
+        """
+        recs = self._tag_recs(recs)
+        attrs = self._select_attrs(recs)
+        self._apply_updates(recs, affine_updates(attrs, tx=dx, ty=dy))
+
+    def scale(self, recs, sx, sy=None, origin=(0, 0)):
+        """
+        Scale the positions and sizes of the elements of recs around origin
+        """
+        recs = self._tag_recs(recs)
+        attrs = self._select_attrs(recs)
+        self._apply_updates(recs, affine_updates(attrs, *scale_about(sx, sy, origin)))
+
+    def set_numeric(self, recs, name, values):
+        """
+        Set the attribute name of the i-th element of recs to values[i], values can be a numpy array
+        """
+        recs = self._tag_recs(recs)
+        self._apply_updates(recs, numeric_updates(len(recs), name, values))
+
     def __str__(self):
         ret = self._select_elem()
         return self.to_string(ret)
 
     def __len__(self):
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT count(*) FROM elem WHERE parent_id=0;')
-        return cursor.fetchone()[0]
+        return self._query('SELECT count(*) FROM elem WHERE parent_id=0;')[0][0]
 
     def yield_childs(self, recs, t=None):
         for rec in recs:
@@ -232,42 +588,178 @@ class DbParser(HTMLParser):
                 ret.append(x)
         return ret
 
+    def _select_subtree(self, recs):
+        """
+        Fetch every descendant of recs and their attributes with a recursive query,
+        return the children grouped by parent_id (in sort_order) and the attributes grouped by elem_id
+        """
+        childs = {}
+        attrs = {}
+        # the elements fetched by the earlier chunks, a subtree reached again (nested recs) is skipped
+        seen = set()
+        ids = [rec[0] for rec in recs if rec[1] == TAG]
+        for start in xrange(0, len(ids), MAX_VARIABLES):
+            chunk = ids[start:start + MAX_VARIABLES]
+            subtree = ('WITH RECURSIVE subtree(id) AS (SELECT id FROM elem WHERE id IN (%s) '
+                       'UNION SELECT elem.id FROM elem JOIN subtree ON elem.parent_id = subtree.id) ' %
+                       ','.join('?' * len(chunk)))
+            fetched = set()
+            for row in self._query(subtree + 'SELECT elem.* FROM subtree CROSS JOIN elem ON elem.id = subtree.id '
+                                             'ORDER BY elem.parent_id, elem.sort_order;', chunk):
+                if row[0] not in seen:
+                    fetched.add(row[0])
+                    childs.setdefault(row[3], []).append(row)
+            for elem_id, k, v in self._query(subtree + 'SELECT attr.elem_id, attr.k, attr.v FROM subtree '
+                                                       'CROSS JOIN attr ON attr.elem_id = subtree.id '
+                                                       'ORDER BY attr.elem_id, attr.id;', chunk):
+                if elem_id in fetched:
+                    attrs.setdefault(elem_id, []).append((k, v))
+            seen.update(fetched)
+        if len(ids) > MAX_VARIABLES:
+            # the children of a parent can come from different chunks
+            for rows in childs.values():
+                rows.sort(key=lambda x: x[4])
+        return childs, attrs
+
+    def _iter_markup(self, recs, before=None, after=None, html=None):
+        childs, attrs = self._select_subtree(recs)
+
+        def describe(l):
+            return l[1], l[2], render_attrs(attrs.get(l[0], ()), ' '), childs.get(l[0], ())
+
+        return iter_markup(recs, describe, before, after, html)
+
     def to_string(self, recs, before=None, after=None, html=None):
-        ret = []
-        for l in recs:
-            if before:
-                if l in before:
-                    ret.append(html)
-            if l[1] == DECL:
-                ret.append('<!' + l[2] + '>')
-            elif l[1] == PI:
-                ret.append('<?' + l[2] + '>')
-            elif l[1] == COMMENT:
-                ret.append('<!--' + l[2] + '-->')
-            elif l[1] == DATA:
-                ret.append(l[2])
-            elif l[1] == TAG:
-                content = self.to_string(self._select_elem(parent_id=l[0]), after=after, html=html)
-                attributes = render_attrs(self._select_attr(l[0]), ' ')
-                tagname = l[2]
-                if content:
-                    ret.append('<%s%s>%s</%s>' % (tagname, attributes, content, tagname))
-                else:
-                    ret.append('<%s%s/>' % (tagname, attributes))
-            if after:
-                if l in after:
-                    ret.append(html)
-        return ''.join(ret)
+        return ''.join(self._iter_markup(recs, before, after, html))
+
+    def iter_chunks(self, recs=None, size=CHUNK_SIZE):
+        """
+        Yield the markup of recs (the whole document by default) in chunks of about size characters
+        """
+        return coalesce(self._iter_markup(self._select_elem() if recs is None else recs), size)
+
+    def write(self, fileobj, recs=None, size=CHUNK_SIZE):
+        for chunk in self.iter_chunks(recs, size):
+            fileobj.write(chunk)
 
     def tag(self, tag_name):
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT * FROM elem WHERE `type`=? AND `data`=?;', (TAG, tag_name))
-        ret = cursor.fetchall()
-        return ret
+        return self._query('SELECT * FROM elem WHERE `type`=? AND `data`=? ORDER BY id;', (TAG, tag_name))
 
     def id(self, _id):
         return self.attr(id=_id)
 
+    def select(self, selector, recs=None):
+        """
+        The elements matching the css selector (see selector.py) ordered by id as tag() and attr(),
+        only the ones in the subtrees of recs if given. The selector is translated once in a single
+        recursive query
+        """
+        group = compile_selector(selector)
+        scoped = recs is not None
+        try:
+            ctes, values, last = group.compiled[('sqlite', scoped)]
+        except KeyError:
+            ctes, values, last = group.compiled[('sqlite', scoped)] = _selector_sql(group, scoped)
+        if not scoped:
+            return self._query('WITH RECURSIVE %s SELECT * FROM elem WHERE id IN (%s) ORDER BY id;' % (
+                ', '.join(ctes), last), values)
+        ret = dict()
+        ids = [rec[0] for rec in recs if rec[1] == TAG]
+        for start in xrange(0, len(ids), MAX_VARIABLES):
+            chunk = ids[start:start + MAX_VARIABLES]
+            scope = ('scope(id) AS (SELECT id FROM elem WHERE id IN (%s) '
+                     'UNION SELECT elem.id FROM scope CROSS JOIN elem ON elem.parent_id = scope.id)' %
+                     ','.join('?' * len(chunk)))
+            for row in self._query('WITH RECURSIVE %s SELECT * FROM elem WHERE id IN (%s);' % (
+                    ', '.join([scope] + ctes), last), chunk + values):
+                ret[row[0]] = row
+        return [ret[x] for x in sorted(ret)]
+
+    def insert_after(self, recs, html):
+        """
+        Parse html and insert its nodes right after each of recs, under the same parent.
+        Return the inserted top level records
+        """
+        ret = []
+        for rec in recs:
+            ret.extend(self._splice(self._select_elem(id=rec[0])[0], html))
+        return ret
+
+    def _splice(self, rec, html):
+        with self._write_lock:
+            self._begin_bulk()
+            try:
+                feed_fragment(self, rec[3], html)
+                inserted = self._place_after(rec)
+            finally:
+                self._flush()
+        return inserted
+
+    def _place_after(self, rec):
+        """
+        Move the buffered siblings of rec right after it, return their rows.
+        They take sort orders in the gap before the next sibling, the siblings are renumbered only when it is full
+        """
+        top = [i for i, row in enumerate(self._elem_buffer) if row[3] == rec[3]]
+        nxt = self._query('SELECT MIN(sort_order) FROM elem WHERE parent_id = ? AND sort_order > ?;',
+                          (rec[3], rec[4]))[0][0]
+        orders = between(rec[4], nxt, len(top))
+        if orders is None:
+            siblings = self._query('SELECT id, sort_order FROM elem WHERE parent_id = ? ORDER BY sort_order;',
+                                   (rec[3],))
+            pos = [x[0] for x in siblings].index(rec[0]) + 1
+            merged = siblings[:pos] + [None] * len(top) + siblings[pos:]
+            numbers = renumber(len(merged))
+            self._conn.executemany('UPDATE elem SET sort_order = ? WHERE id = ?;', [
+                (order, x[0]) for x, order in zip(merged, numbers) if x is not None and x[1] != order])
+            orders = numbers[pos:pos + len(top)]
+            self._sort_order = max(self._sort_order, numbers[-1])
+        inserted = []
+        for i, order in zip(top, orders):
+            self._elem_buffer[i] = self._elem_buffer[i][:4] + (order,)
+            inserted.append(self._elem_buffer[i])
+        if orders:
+            self._sort_order = max(self._sort_order, orders[-1])
+        return inserted
+
+    def replicate(self, recs, rows, cols, dx, dy, id_suffix=ID_SUFFIX):
+        """
+        Fill a rows x cols grid with copies of each of recs, the one in row, col moved by dx * col, dy * row and
+        with id_suffix % {'row': row, 'col': col} appended to its ids and labels.
+        The template is read with one query and each grid written with one transaction,
+        return the inserted top level records
+        """
+        ret = []
+        for rec in recs:
+            rec = self._select_elem(id=rec[0])[0]
+            childs, attrs = self._select_subtree([rec])
+            template = self._stamp(rec, childs, attrs, MOVE_ROOT)
+            with self._write_lock:
+                self._begin_bulk()
+                try:
+                    for x, y, suffix in grid(rows, cols, dx, dy, id_suffix):
+                        self._instance(template, rec[3], x, y, suffix)
+                    ret.extend(self._place_after(rec))
+                finally:
+                    self._flush()
+        return ret
+
+    def _stamp(self, rec, childs, attrs, parent_mode):
+        if rec[1] != TAG:
+            return rec, None, None
+        mode = move_mode(attrs.get(rec[0], ()), parent_mode)
+        return rec, AttrStamp(attrs.get(rec[0], ()), mode), [self._stamp(x, childs, attrs, mode)
+                                                              for x in childs.get(rec[0], ())]
+
+    def _instance(self, template, parent_id, dx, dy, suffix):
+        rec, stamp, children = template
+        elem_id = self._insert_elem(rec[1], rec[2], parent_id)
+        if stamp is not None:
+            for k, v in stamp(dx, dy, suffix):
+                self._insert_attr(k, v, elem_id)
+            for x in children:
+                self._instance(x, elem_id, dx, dy, suffix)
+
     def insert_html_after(self, recs, html):
         """
         Return a new parser instance
@@ -289,22 +781,22 @@ class DbParser(HTMLParser):
             )
 
         """
-        values = []
         join = []
+        join_values = []
         where = []
+        where_values = []
         i = 0
         for k, v in params.items():
             i += 1
-            values.append(k)
-            values.append(v)
-            where.append("a%i.k %s ? AND a%i.v %s ?" % (i, function, i, function))
+            condition, values = _attr_condition('a%i' % i, function, k, v)
             if i > 1:
-                join.append('JOIN attr a%i ON a1.elem_id = a%i.elem_id' % (i, i))
-        cursor = self._conn.cursor()
-        cursor.execute("select * from elem where id in (SELECT a1.elem_id FROM attr a1 %s WHERE %s);" % (
-            ' '.join(join), ' AND '.join(where)), values)
-        ret = cursor.fetchall()
-        return ret
+                join.append('JOIN attr a%i ON a%i.elem_id = a1.elem_id AND %s' % (i, i, condition))
+                join_values.extend(values)
+            else:
+                where.append(condition)
+                where_values.extend(values)
+        return self._query("SELECT * FROM elem WHERE id IN (SELECT a1.elem_id FROM attr a1 %s WHERE %s) ORDER BY id;" % (
+            ' '.join(join), ' AND '.join(where)), join_values + where_values)
 
 
 #  _____ ___ ___ _____
@@ -379,8 +871,7 @@ def test8(parser):
     parser2 = parser
     for i in xrange(8):
         this_id = 'template%i' % i
-        parser2 = parser2.insert_html_after(template, html)
-        template = parser2.id('template')[-1:]
+        template = parser2.insert_after(template, html)
         parser2.set_attr(template, id=this_id)
 
         for rec in parser2.yield_childs(parser2.id(this_id), TAG):
@@ -391,13 +882,8 @@ def test8(parser):
                 parser2.set_attr((rec,), x=new_x, y=new_y)
             except KeyError:
                 pass
-            try:
-                transform = attrs['transform']
-                for pre, _x, mid, _y, post in re.findall(r'(.*?)([0-9.]+)(\D+)([0-9.]+)(\D+)', transform, re.I):
-                    parser2.set_attr((rec,), transform="%s%s%s%s%s" % (
-                        pre, float(_x) + width * ((i + 1) % 3), mid, float(_y) - height * ((i + 1) / 3), post))
-            except KeyError:
-                pass
+            if 'transform' in attrs:
+                parser2.geometry(rec, 'transform').translate(width * ((i + 1) % 3), -height * ((i + 1) / 3))
 
     for j, rec in enumerate(parser2.childs(parser2.id('poker'), DATA)):
         parser2.set_elem_value(rec[0], poker_values[j])
@@ -424,6 +910,350 @@ def test9(parser):
     assert all((x[1] == TAG for x in childs))
 
 
+def test10(parser):
+    html = open('test/test.svg', 'rb').read()
+    unbuffered = DbParser()
+    unbuffered.feed(html)
+    assert str(unbuffered) == str(parser)
+    assert unbuffered._select_elem(parent_id=0) == parser._select_elem(parent_id=0)
+    assert parser._elem_buffer is None and parser._attr_buffer is None
+    cursor = parser._conn.cursor()
+    cursor.execute('SELECT count(*), max(id) FROM elem;')
+    count, max_id = cursor.fetchone()
+    assert count == max_id
+    parser.loads('<g id="appended"/>')
+    assert parser.id('appended')[0][0] == max_id + 1
+
+
+def test11(parser):
+    queries = []
+    query = parser._query
+
+    def recording_query(sql, vals=()):
+        queries.append((sql, vals))
+        return query(sql, vals)
+
+    parser._query = recording_query
+    str(parser)
+    len(parser)
+    parser.tag('g')
+    parser.id('tspan%')
+    parser.attr(x='85%', y='728%')
+    parser.attr(x=r'\b191\b', function='REGEXP')
+    parser.attr(id='tspan3902', function='=')
+    parser.childs(parser.id('template'))
+    list(parser.yield_childs(parser.id('template'), TAG))
+    parser.parent(parser.id('tspan3902'))
+    assert queries
+    cursor = parser._conn.cursor()
+    for sql, vals in queries:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, vals)
+        for row in cursor.fetchall():
+            # the recursive step always reads back its own queue
+            assert not row[-1].startswith('SCAN') or row[-1] == 'SCAN subtree', (sql, row[-1])
+
+
+def test12(parser):
+    queries = []
+    query = parser._query
+
+    def recording_query(sql, vals=()):
+        queries.append(sql)
+        return query(sql, vals)
+
+    parser._query = recording_query
+    html = str(parser)
+    assert len(queries) == 3
+    assert html.strip('\n\r ') == open('test/test_regen.svg', 'r').read().strip('\n\r ')
+    template = parser.id('template')
+    del queries[:]
+    assert parser.to_string(template).startswith('<g id="template" inkscape:label="#g4008">')
+    assert len(queries) == 2
+
+
+def test13(parser):
+    inserted = parser.insert_after(parser.id('carta'), '<rect id="a"/><rect id="b"><title id="t">t</title></rect>')
+    assert [x[2] for x in inserted] == ['rect', 'rect']
+    assert parser.get_attr(inserted, wrapper=dict) == [{'id': 'a'}, {'id': 'b'}]
+    ids = [parser.get_attr((x,), wrapper=dict)[0].get('id') for x in parser.childs(parser.id('template'), TAG)]
+    assert ids[:6] == ['spaziatura', 'carta', 'a', 'b', 't', 'poker']
+    assert 'y="681.42566"/><rect id="a"/><rect id="b"><title id="t">t</title></rect>' in str(parser)
+    assert len(parser) == 6
+    parser.loads('<g id="last"/>')
+    assert parser.to_string(parser._select_elem()[-1:]) == '<g id="last"/>'
+
+
+def test14(parser):
+    from StringIO import StringIO
+
+    out = StringIO()
+    parser.write(out)
+    assert out.getvalue() == str(parser)
+    chunks = list(parser.iter_chunks(parser.id('template'), size=1024))
+    assert len(chunks) > 1
+    assert ''.join(chunks) == parser.to_string(parser.id('template'))
+
+
+def test15(parser):
+    from StringIO import StringIO
+
+    data = open('test/test.svg', 'rb').read()
+    incremental = DbParser()
+    loading = incremental.iter_load(StringIO(data), 1000)
+    assert loading.next()[0] < len(data)
+    assert len(incremental.tag('svg')) == 1
+    assert len(incremental.tag('g')) == 0
+    for _ in loading:
+        pass
+    assert len(incremental.tag('g')) == 2
+    assert str(incremental) == str(parser)
+    progress = []
+    chunked = DbParser()
+    chunked.load('test/test.svg', 100, lambda loaded, total: progress.append((loaded, total)))
+    assert str(chunked) == str(parser)
+    assert len(progress) > 10
+    assert progress[-1] == (len(data), len(data))
+
+
+def test16(parser):
+    from generic_parser import GenericParser
+
+    attrs = parser.get_attr(parser.id('spaziatura'), wrapper=dict)[0]
+    width, height = float(attrs['width']), float(attrs['height'])
+    queries = []
+    query = parser._query
+
+    def recording_query(sql, vals=()):
+        queries.append(sql)
+        return query(sql, vals)
+
+    template = parser.id('template')
+    parser._query = recording_query
+    copies = parser.replicate(template, 3, 3, width, -height)
+    assert len(queries) == 4
+    del parser._query
+    orders = [x[4] for x in copies]
+    assert orders == sorted(set(orders)) and orders[0] > template[0][4]
+    siblings = [x[0] for x in parser.childs(parser.parent(template)) if x[3] == template[0][3]]
+    start = siblings.index(template[0][0]) + 1
+    assert siblings[start:start + len(copies)] == [x[0] for x in copies]
+    assert [x[0] for x in parser.attr(function='=', id='template22')] == [copies[-1][0]]
+    assert parser.get_attr(parser.id('template12'), wrapper=dict)[0]['transform'] == 'translate(%.12g,%.12g)' % (
+        width, -2 * height)
+    rect = parser.get_attr(parser.id('spaziatura12'), wrapper=dict)[0]
+    assert rect['x'] == attrs['x']
+    generic = GenericParser()
+    generic.load('test/test.svg')
+    node = generic._id_lookup('template')[0]
+    assert len(generic.replicate(node, 3, 3, width, -height)) == 8
+    assert str(parser) == str(generic)
+
+
+def test17(parser):
+    from dict_parser import DictParser
+
+    other = DictParser()
+    other.load('test/test.svg')
+    for p in (parser, other):
+        p.translate(p.tag('rect') + p.tag('path'), 10, -5)
+        p.scale(p.tag('text'), 2, origin=(100, 100))
+        p.set_numeric(p.tag('tspan'), 'dx', [1, 2, 3])
+    assert str(parser) == str(other)
+    assert parser.get_attr(parser.tag('path'), wrapper=dict)[0]['transform'] == 'translate(534.22275,704.95482)'
+    assert [x[0] for x in parser.attr(function='=', dx='3')] == [parser.tag('tspan')[2][0]]
+
+
+def test18(parser):
+    path = parser.tag('path')
+    transform = parser.geometry(path[0], 'transform')
+    assert parser.geometry(path[0], 'transform') is transform
+    transform.translate(1, -1)
+    transform.translate(1, -1)
+    assert 'transform="translate(526.22275,707.95482)"' in str(parser)
+    assert parser.attr(function='=', transform='translate(526.22275,707.95482)') == path
+    transform.translate(1, -1)
+    assert 'transform="translate(527.22275,706.95482)"' in str(parser)
+    parser.set_attr(path, transform='scale(2)')
+    assert str(parser.geometry(path[0], 'transform')) == 'scale(2)'
+    try:
+        parser.geometry(path[0], 'x')
+        assert False
+    except KeyError:
+        pass
+
+
+def test19(parser):
+    from dict_parser import DictParser
+
+    other = DictParser()
+    other.load('test/test.svg')
+    queries = []
+
+    def recording_query(sql, vals=()):
+        queries.append(sql)
+        return query(sql, vals)
+
+    query = parser._query
+    parser._query = recording_query
+    for selector in ('g#template > text tspan[id^=tspan]', 'rect', 'g g, #spaziatura', '*[x]', 'text > [y$="239"]',
+                     'svg > g > *', '[sodipodi:role~=line]', 'g[id*=empl] tspan', '[id^=TSPAN]', '[id^=""]'):
+        del queries[:]
+        found = [x[0] for x in parser.select(selector)]
+        assert len(queries) == 1
+        assert found == [x['id'] for x in other.select(selector)], selector
+    assert len(parser.select('g#template > text tspan[id^=tspan]')) == 3
+    template = parser.select('#template')
+    assert [x[0] for x in parser.select('text tspan', template)] == [x['id'] for x in other.select('#template tspan')]
+    assert parser.select('svg tspan', template) == []
+
+
+def test20(parser):
+    class Counting(object):
+        def __init__(self, conn):
+            self.conn = conn
+            self.commits = 0
+
+        def commit(self):
+            self.commits += 1
+            self.conn.commit()
+
+        def __getattr__(self, name):
+            return getattr(self.conn, name)
+
+    tspans = parser.tag('tspan')
+    parser._conn = conn = Counting(parser._conn)
+    parser.set_attr(tspans + parser.tag('rect'), x='1', dy='2')
+    assert conn.commits == 1
+    assert [dict(x)['x'] for x in parser.get_attr(tspans)] == ['1'] * 3
+    assert [dict(x)['dy'] for x in parser.get_attr(tspans)] == ['2'] * 3
+    assert [k for k, v in parser.get_attr(tspans)[0]].count('x') == 1
+    parser.set_elem_values([(x[0], 'v%i' % i) for i, x in enumerate(parser.childs(tspans, DATA))])
+    assert conn.commits == 2
+    assert [x[2] for x in parser.childs(tspans, DATA)] == ['v0', 'v1']
+    parser.set_attr([], x='1')
+    assert conn.commits == 2
+    repeated = DbParser('<svg><rect x="1" y="0" x="2"/></svg>')
+    assert repeated.get_attr(repeated.tag('rect')) == [[('x', '2'), ('y', '0')]]
+
+
+def test21(parser):
+    from dict_parser import DictParser
+
+    other = DictParser()
+    other.load('test/test.svg')
+    for n in xrange(15):
+        html = '<rect id="r%i"/>' % n
+        parser.insert_after(parser.id('spaziatura'), html)
+        other.insert_after(other.id('spaziatura'), html)
+    assert str(parser) == str(other)
+    changes = parser._conn.total_changes
+    inserted = parser.insert_after(parser.id('r3'), '<rect id="one"><title>t</title></rect>')
+    # rect, title, text and the id attribute, no sibling is moved
+    assert parser._conn.total_changes - changes == 4
+    assert inserted[0][4] < parser.id('r2')[0][4]
+
+
+def test22(parser):
+    import threading
+
+    expected = [x[0] for x in parser.select('text tspan')]
+    found = []
+    connections = []
+
+    def read():
+        connections.append(parser._conn.connection())
+        for _ in xrange(20):
+            found.append([x[0] for x in parser.select('text tspan')])
+
+    threads = [threading.Thread(target=read) for _ in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for n in xrange(10):
+        parser.insert_after(parser.id('spaziatura'), '<rect id="r%i"/>' % n)
+    for thread in threads:
+        thread.join()
+    assert found == [expected] * 80
+    assert len(set(id(x) for x in connections + [parser._conn.connection()])) == 5
+    assert not parser._conn._lock.locked()
+    try:
+        parser.set_attr(parser.tag('rect'), x=[1])
+        assert False
+    except Exception:
+        pass
+    assert not parser._conn._lock.locked()
+    data = str(parser)
+    assert [data.index('id="r%i"' % n) for n in xrange(9, -1, -1)] == sorted(
+        data.index('id="r%i"' % n) for n in xrange(10))
+
+
+def test23(parser):
+    assert [x[2] for x in parser.attr(sodipodi_role='line')] == ['tspan'] * 3
+    assert parser.attr(function='=', sodipodi_role='line') == []
+    assert parser.attr(id=u'tspan%') == parser.attr(id='tspan%') != []
+    parser.set_attr(parser.id('spaziatura'), label='\xc3\xa8 uno')
+    assert parser.attr(label=u'\xe8%') == parser.attr(label='\xc3\xa8%') == parser.id('spaziatura')
+    assert parser.select(u'[label^="\xe8"]') == parser.id('spaziatura')
+
+
+def test24(parser):
+    path = parser.tag('path')
+    transform = parser.geometry(path[0], 'transform')
+    errors = []
+
+    def read():
+        try:
+            for _ in xrange(50):
+                parser.tag('rect')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for _ in xrange(200):
+        transform.translate(1, 0)
+        parser.tag('g')
+    for thread in threads:
+        thread.join()
+    assert errors == [] and not parser._conn._lock.locked()
+    assert parser.get_attr(path, wrapper=dict)[0]['transform'] == 'translate(724.22275,709.95482)'
+
+
+def test25(parser):
+    global MAX_VARIABLES
+
+    nested = DbParser('<g><rect id="a"/><rect id="b"/></g>')
+    expected = parser.to_string(parser.select('*')), nested.to_string(nested.select('*'))
+    assert len(parser.select('*')) > 2 and expected[1].count('id="a"') == 2
+    old, MAX_VARIABLES = MAX_VARIABLES, 1
+    try:
+        # the nested recs fall in different chunks
+        assert (parser.to_string(parser.select('*')), nested.to_string(nested.select('*'))) == expected
+    finally:
+        MAX_VARIABLES = old
+
+
+def test26(parser):
+    errors = []
+
+    def write(n):
+        try:
+            for i in xrange(20):
+                parser.insert_after(parser.id('spaziatura'), '<rect id="w%i-%i"/>' % (n, i))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == [] and not parser._conn._lock.locked()
+    assert len(parser.attr(id='w%')) == 80
+    siblings = parser._query('SELECT sort_order FROM elem WHERE parent_id = ?;', (parser.id('spaziatura')[0][3],))
+    assert len(set(siblings)) == len(siblings)
+
+
 def main(argv):
     import inspect
 
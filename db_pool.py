@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: a sqlite connection per thread on one database, reads run concurrently and writes one at a time
+#
+# --------------
+
+__author__ = 'Roberto'
+
+from functools import partial
+import itertools
+import os
+import sqlite3 as sqlite
+import threading
+import time
+import urllib
+
+MEMORY = ':memory:'
+# seconds a connection waits for the locks of the others (e.g. a commit waiting for the readers to finish)
+TIMEOUT = 30.0
+# the statements after which the sqlite module keeps a transaction open until the commit
+DML = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+READ, WRITE, OTHER = range(3)
+# the vfs sqlite opens the files with by default
+FILE_VFS = 'win32' if os.name == 'nt' else 'unix'
+
+_names = itertools.count(1)
+# database file -> the write lock shared by every pool on it
+_write_locks = dict()
+_write_locks_guard = threading.Lock()
+
+
+def _uri_filenames():
+    """
+    True when sqlite opens "file:" names as URIs (the python 2 module cannot ask for it)
+    """
+    conn = sqlite.connect('file:pysvg-uri-check?mode=memory')
+    try:
+        return not [x for x in conn.execute('PRAGMA database_list;') if x[2]]
+    finally:
+        conn.close()
+        if os.path.exists('file:pysvg-uri-check?mode=memory'):
+            os.remove('file:pysvg-uri-check?mode=memory')
+
+
+URI_FILENAMES = _uri_filenames()
+
+
+def memory_database():
+    """
+    A new in-memory database every connection of the process can open, None when sqlite has no URI filenames.
+    The memdb vfs lets the readers run in parallel, the older shared cache serializes them on one btree
+    """
+    if not URI_FILENAMES:
+        return None
+    name = 'pysvg-%i-%i' % (os.getpid(), next(_names))
+    if sqlite.sqlite_version_info >= (3, 36):
+        return 'file:/%s?vfs=memdb' % name
+    return 'file:%s?mode=memory&cache=shared' % name
+
+
+def file_uri(path):
+    """
+    The name to ATTACH the database file at path from a pool connection, that would otherwise open it with the
+    vfs of its in-memory database
+    """
+    if not URI_FILENAMES:
+        return path
+    return 'file:%s?vfs=%s' % (urllib.pathname2url(os.path.abspath(path)), FILE_VFS)
+
+
+def statement_kind(sql):
+    """
+    READ for the queries, WRITE for the statements opening a transaction, OTHER for the rest (schema changes,
+    ATTACH, PRAGMA ...) that the sqlite module runs after committing the open transaction
+    """
+    words = sql.lstrip().split(None, 1)
+    word = words[0].upper() if words else ''
+    if word in ('SELECT', 'WITH', 'EXPLAIN', 'VALUES') or (word == 'PRAGMA' and '=' not in sql):
+        return READ
+    if word in DML:
+        return WRITE
+    return OTHER
+
+
+class WriteLock(object):
+    """
+    The lock of the writers of a database, remembering the thread holding it and its connection: when that
+    thread is gone without a commit, the next writer rolls the connection back and takes over
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._guard = threading.Lock()
+        self._holder = None
+
+    def acquire(self, conn, timeout):
+        deadline = time.time() + timeout
+        delay = 0.0005
+        while not self._lock.acquire(False):
+            self._take_over()
+            if time.time() >= deadline:
+                raise sqlite.OperationalError('database is locked by another writer')
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        self._holder = threading.current_thread(), conn
+
+    def _take_over(self):
+        with self._guard:
+            holder = self._holder
+            if holder is None or holder[0].is_alive():
+                return
+            try:
+                holder[1].rollback()
+            except sqlite.Error:
+                # already closed with its thread
+                pass
+            self.release()
+
+    def release(self):
+        self._holder = None
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+
+def write_lock(database):
+    with _write_locks_guard:
+        try:
+            return _write_locks[database]
+        except KeyError:
+            ret = _write_locks[database] = WriteLock()
+            return ret
+
+
+class Cursor(object):
+    """
+    A cursor of the connection of the current thread, taking the write lock of the pool when needed
+    """
+
+    def __init__(self, pool, cursor):
+        self._pool = pool
+        self._cursor = cursor
+
+    def execute(self, sql, vals=()):
+        self._pool._run(sql, self._cursor.execute, vals)
+        return self
+
+    def executemany(self, sql, seq):
+        self._pool._run(sql, self._cursor.executemany, seq)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ConnectionPool(object):
+    """
+    Used as a sqlite connection (cursor, execute, executemany, commit, rollback, close and the attributes), each
+    thread works on a connection of its own to the same database: a file, or a named in-memory database.
+    A thread running INSERT, UPDATE, DELETE or REPLACE holds the write lock of the database until its commit or
+    rollback (or the failure of one of them, rolling back), so the writers go one at a time while the readers do
+    not wait for each other. A writer waits up to timeout seconds for the lock.
+    Attributes set on the pool (text_factory, row_factory ...), setup(conn) and the PRAGMA assignments run on
+    it are applied to every connection opened afterwards
+    """
+
+    def __init__(self, database=MEMORY, setup=None, timeout=TIMEOUT):
+        shared = database
+        if database == MEMORY:
+            shared = memory_database()
+        _set = partial(object.__setattr__, self)
+        _set('database', database if shared is None else shared)
+        _set('_setup', setup)
+        _set('_timeout', timeout)
+        _set('_settings', [])
+        _set('_pragmas', [] if shared is None or 'cache=shared' not in shared else ['PRAGMA read_uncommitted = 1;'])
+        _set('_local', threading.local())
+        # thread -> its connection, to close them all and drop the ones of the ended threads
+        _set('_open', dict())
+        _set('_guard', threading.Lock())
+        # the in-memory databases are private to the pool, the files shared with the pools of other parsers
+        _set('_lock', WriteLock() if database == MEMORY else write_lock(os.path.abspath(database)))
+        # without URI filenames the threads share one connection, as before the pool
+        _set('_single', self._connect() if shared is None else None)
+        # keeps the in-memory database alive when the threads that used it are gone
+        _set('_keeper', self._connect() if shared is not None and shared != database else None)
+
+    def _connect(self):
+        ret = sqlite.connect(self.database, timeout=self._timeout, detect_types=sqlite.PARSE_DECLTYPES,
+                             check_same_thread=False)
+        for name, value in self._settings:
+            setattr(ret, name, value)
+        if self._setup is not None:
+            self._setup(ret)
+        for sql in self._pragmas:
+            ret.execute(sql)
+        return ret
+
+    def connection(self):
+        """
+        The connection of the current thread
+        """
+        if self._single is not None:
+            return self._single
+        try:
+            return self._local.conn
+        except AttributeError:
+            pass
+        conn = self._local.conn = self._connect()
+        with self._guard:
+            for thread in [x for x in self._open if not x.is_alive()]:
+                self._open.pop(thread).close()
+            self._open[threading.current_thread()] = conn
+        return conn
+
+    def _run(self, sql, method, vals):
+        kind = statement_kind(sql)
+        if kind == READ:
+            return method(sql, vals)
+        if not getattr(self._local, 'writing', False):
+            self._lock.acquire(self.connection(), self._timeout)
+            self._local.writing = True
+        try:
+            ret = method(sql, vals)
+        except Exception:
+            # the callers commit after their writes and never roll back: a failed write ends its transaction
+            if kind == WRITE:
+                self.rollback()
+            else:
+                self._release()
+            raise
+        if kind == OTHER:
+            if sql.lstrip()[:6].upper() == 'PRAGMA':
+                self._pragmas.append(sql)
+            self._release()
+        return ret
+
+    def _release(self):
+        if getattr(self._local, 'writing', False):
+            self._local.writing = False
+            self._lock.release()
+
+    def cursor(self):
+        return Cursor(self, self.connection().cursor())
+
+    def execute(self, sql, vals=()):
+        return self.cursor().execute(sql, vals)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        try:
+            self.connection().commit()
+        finally:
+            self._release()
+
+    def rollback(self):
+        try:
+            self.connection().rollback()
+        finally:
+            self._release()
+
+    def close(self):
+        """
+        Close the connections of every thread, an in-memory database is gone afterwards
+        """
+        self._release()
+        with self._guard:
+            for conn in self._open.values() + [self._single, self._keeper]:
+                if conn is not None:
+                    conn.close()
+            self._open.clear()
+            object.__setattr__(self, '_local', threading.local())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.connection(), name)
+
+    def __setattr__(self, name, value):
+        self._settings.append((name, value))
+        with self._guard:
+            for conn in self._open.values() + [self._single, self._keeper]:
+                if conn is not None:
+                    setattr(conn, name, value)
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    assert [statement_kind(x) for x in ('select 1', ' WITH a AS (SELECT 1) SELECT * FROM a', 'PRAGMA query_only;',
+                                        'INSERT INTO t VALUES (1)', 'update t set x=1', 'CREATE TABLE t (x)',
+                                        'PRAGMA query_only = ON;', '')] == [READ] * 3 + [WRITE] * 2 + [OTHER] * 3
+    pool = ConnectionPool()
+    pool.text_factory = str
+    pool.execute('CREATE TABLE t (x INTEGER, y TEXT);')
+    pool.executemany('INSERT INTO t VALUES (?, ?);', [(x, 'v%i' % x) for x in xrange(100)])
+    assert pool._lock.locked()
+    pool.commit()
+    assert not pool._lock.locked()
+    found = []
+    connections = []
+
+    def read():
+        connections.append(pool.connection())
+        found.append(pool.execute('SELECT COUNT(*), MAX(y) FROM t;').fetchall()[0])
+
+    threads = [threading.Thread(target=read) for _ in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert found == [(100, 'v99')] * 4 and type(found[0][1]) is str
+    assert len(set(id(x) for x in connections + [pool.connection()])) == 5
+    pool.close()
+
+
+def test2():
+    pool = ConnectionPool()
+    pool.execute('CREATE TABLE t (x INTEGER);')
+    pool.commit()
+    order = []
+
+    def write(n):
+        for x in xrange(n, n + 50):
+            pool.execute('INSERT INTO t VALUES (?);', (x,))
+            order.append(x)
+            pool.commit()
+
+    pool.execute('INSERT INTO t VALUES (?);', (-1,))
+    threads = [threading.Thread(target=write, args=(x * 100,)) for x in xrange(4)]
+    for thread in threads:
+        thread.start()
+    # the others wait for this transaction
+    assert order == [] and pool.execute('SELECT COUNT(*) FROM t;').fetchone() == (1,)
+    pool.rollback()
+    for thread in threads:
+        thread.join()
+    assert pool.execute('SELECT COUNT(*), MIN(x) FROM t;').fetchone() == (200, 0)
+    pool.execute('PRAGMA query_only = ON;')
+    failed = []
+
+    def insert():
+        try:
+            pool.execute('INSERT INTO t VALUES (1);')
+        except sqlite.OperationalError as e:
+            failed.append(str(e))
+
+    thread = threading.Thread(target=insert)
+    thread.start()
+    thread.join()
+    assert 'readonly' in failed[0] and not pool._lock.locked()
+    pool.close()
+
+
+def test3():
+    pool = ConnectionPool(timeout=0.2)
+    pool.execute('CREATE TABLE t (x INTEGER);')
+    pool.commit()
+    started = threading.Event()
+    done = threading.Event()
+
+    def hold():
+        pool.execute('INSERT INTO t VALUES (1);')
+        started.set()
+        done.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    started.wait()
+    try:
+        pool.execute('INSERT INTO t VALUES (2);')
+        assert False
+    except sqlite.OperationalError as e:
+        assert 'locked' in str(e)
+    done.set()
+    thread.join()
+    # the thread is gone without a commit: its insert is rolled back and the lock taken over
+    pool.execute('INSERT INTO t VALUES (3);')
+    pool.commit()
+    assert pool.execute('SELECT x FROM t;').fetchall() == [(3,)] and not pool._lock.locked()
+    pool.close()
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: persistent DbParser databases keyed by the sha1 of the source, parsed once and reopened afterwards
+#
+# --------------
+
+__author__ = 'Roberto'
+
+import hashlib
+import os
+
+from db_parser import DbParser
+from db_pool import file_uri
+from loader import read_chunks
+
+MAX_BYTES = 256 * 1024 * 1024
+DB_SUFFIX = '.sqlite'
+# written after the database is complete, its mtime is the last use of the entry
+DONE_SUFFIX = '.done'
+SIDE_SUFFIXES = ('', '-wal', '-shm', '-journal')
+
+
+class DbStore(object):
+    """
+    A directory of sqlite databases (WAL mode) named after the sha1 of the svg they hold.
+    Loading a source already stored skips the parsing, the least recently used entries are deleted
+    beyond max_bytes
+    """
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def load(self, source, readonly=False):
+        """
+        The DbParser of source (a file name or a file-like object), see loads
+        """
+        return self.loads(''.join(chunk for chunk, _, _ in read_chunks(source)), readonly)
+
+    def loads(self, data, readonly=False):
+        """
+        The DbParser of data from the store, parsing and storing it the first time. A readonly parser
+        queries the stored database, else a private in-memory copy is made so its edits do not touch the store
+        """
+        key = hashlib.sha1(data).hexdigest()
+        path = self._path(key, DB_SUFFIX)
+        if os.path.exists(self._path(key, DONE_SUFFIX)):
+            os.utime(self._path(key, DONE_SUFFIX), None)
+        else:
+            self._build(key, data)
+            self.evict(keep=key)
+        if readonly:
+            parser = DbParser(database=path, reset=False)
+            parser.set_readonly()
+            return parser
+        parser = DbParser()
+        parser._conn.execute('ATTACH DATABASE ? AS stored;', (file_uri(path),))
+        parser._conn.execute('INSERT INTO elem SELECT * FROM stored.elem;')
+        parser._conn.execute('INSERT INTO attr SELECT * FROM stored.attr;')
+        parser._conn.commit()
+        parser._conn.execute('DETACH DATABASE stored;')
+        parser._restore_order()
+        return parser
+
+    def _build(self, key, data):
+        tmp = self._path(key, '%s.%i.tmp' % (DB_SUFFIX, os.getpid()))
+        try:
+            parser = DbParser(database=tmp)
+            try:
+                parser._conn.execute('PRAGMA journal_mode = WAL;')
+                parser.loads(data)
+            finally:
+                # the last connection checkpoints and removes the wal file
+                parser._conn.close()
+            os.rename(tmp, self._path(key, DB_SUFFIX))
+        except Exception:
+            # a half written database is not left behind
+            for suffix in SIDE_SUFFIXES:
+                if os.path.exists(tmp + suffix):
+                    os.remove(tmp + suffix)
+            raise
+        open(self._path(key, DONE_SUFFIX), 'wb').close()
+
+    def entries(self):
+        """
+        (last use, bytes, key) of the complete entries, the least recently used first
+        """
+        ret = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(DONE_SUFFIX):
+                continue
+            key = name[:-len(DONE_SUFFIX)]
+            size = 0
+            for suffix in SIDE_SUFFIXES:
+                path = self._path(key, DB_SUFFIX + suffix)
+                if os.path.exists(path):
+                    size += os.path.getsize(path)
+            ret.append((os.path.getmtime(self._path(key, DONE_SUFFIX)), size, key))
+        ret.sort()
+        return ret
+
+    def size(self):
+        return sum(x[1] for x in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used entries (but keep) until the store fits in max_bytes
+        """
+        entries = self.entries()
+        total = sum(x[1] for x in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+
+    def remove(self, key):
+        os.remove(self._path(key, DONE_SUFFIX))
+        for suffix in SIDE_SUFFIXES:
+            path = self._path(key, DB_SUFFIX + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1(directory):
+    store = DbStore(directory)
+    parser = store.load('test/test.svg')
+    expected = DbParser()
+    expected.load('test/test.svg')
+    assert str(parser) == str(expected)
+    assert len(store.entries()) == 1
+    calls = []
+    loads = DbParser.loads
+    DbParser.loads = lambda self, data: calls.append(data)
+    try:
+        again = store.load('test/test.svg')
+        readonly = store.load(open('test/test.svg', 'rb'), readonly=True)
+    finally:
+        DbParser.loads = loads
+    assert calls == [] and str(again) == str(readonly) == str(expected)
+    again.set_attr(again.id('spaziatura'), x='1')
+    assert str(store.load('test/test.svg')) == str(expected)
+    try:
+        readonly.set_attr(readonly.id('spaziatura'), x='1')
+        assert False
+    except Exception as e:
+        assert 'readonly' in str(e)
+    inserted = again.insert_after(again.id('spaziatura'), '<rect id="more"/>')
+    assert again.select('#more') == inserted and inserted[0][4] > expected.id('spaziatura')[0][4]
+    width = readonly.geometry(readonly.id('spaziatura')[0], 'width')
+    assert float(width) == float(expected.get_attr(expected.id('spaziatura'), wrapper=dict)[0]['width'])
+    try:
+        width.scale(2)
+        assert False
+    except Exception as e:
+        assert 'readonly' in str(e)
+    assert str(readonly) == str(expected) and readonly.geometry(readonly.id('spaziatura')[0], 'width') is not width
+
+
+def test2(directory):
+    store = DbStore(directory, max_bytes=0)
+    store.loads('<svg><rect id="a"/></svg>')
+    first = store.entries()[0][2]
+    store.loads('<svg><rect id="b"/></svg>')
+    assert [x[2] for x in store.entries()] != [first] and len(store.entries()) == 1
+    store.max_bytes = 10 ** 9
+    store.loads('<svg><rect id="a"/></svg>')
+    assert len(store.entries()) == 2
+    assert not [x for x in os.listdir(directory) if x.endswith('.tmp') or x.endswith('-wal')]
+    assert store.size() == sum(os.path.getsize(os.path.join(directory, x)) for x in os.listdir(directory))
+    before = sorted(os.listdir(directory))
+    try:
+        store.loads('<svg><rect></svg>')
+        assert False
+    except Exception:
+        pass
+    assert sorted(os.listdir(directory)) == before
+
+
+def main(argv):
+    import inspect
+    import shutil
+    import tempfile
+
+    my_name = inspect.stack()[0][3]
+    fs = [globals()[x] for x in argv]
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+    for f in fs:
+        directory = tempfile.mkdtemp()
+        try:
+            print f.__name__
+            f(directory)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -3,16 +3,12 @@
 #
 # (c) Roberto Gambuzzi
 
-import sqlite3 as sqlite
 import __builtin__
-import re
-
-DATABASE = ':memory:'
 
+from db_pool import ConnectionPool
+from pattern_cache import regexp, register_regexp
 
-def regexp(expr, item):
-    reg = re.compile(expr)
-    return reg.search(item) is not None
+DATABASE = ':memory:'
 
 
 def record_factory(cursor, row):
@@ -22,11 +18,10 @@ def record_factory(cursor, row):
     return d
 
 
-def make_db_connection():
-    out_conn = sqlite.connect(DATABASE, detect_types=sqlite.PARSE_DECLTYPES, check_same_thread=False)
+def make_db_connection(database=DATABASE):
+    out_conn = ConnectionPool(database, register_regexp)
     out_conn.text_factory = str
     out_conn.row_factory = record_factory
-    out_conn.create_function("REGEXP", 2, regexp)
     return out_conn
 
 
@@ -106,6 +101,7 @@ class Abstract(object):
         cursor = self._conn.cursor()
         sql, vals = _generate_sql_where_condition(where)
         cursor.execute('DELETE FROM `' + self._tablename + '` WHERE ' + sql, vals)
+        self._conn.commit()
         cursor.execute('SELECT changes() as changes')
         return cursor.fetchone()['changes']
 
@@ -192,7 +188,9 @@ class EavAttr(Abstract):
                `type` VARCHAR DEFAULT NULL,
                `elem_id` INTEGER DEFAULT NULL,
                FOREIGN KEY(`elem_id`) REFERENCES elem(`id`)
-            );"""
+            );""",
+            "CREATE INDEX `attr_elem_id_k` ON `attr` (`elem_id`, `k`);",
+            "CREATE INDEX `attr_k_v` ON `attr` (`k`, `v` COLLATE NOCASE);",
         )
 
 
@@ -208,7 +206,9 @@ class Elem(Abstract):
                `parent_id` INTEGER DEFAULT NULL,
                `sort_order` INTEGER DEFAULT NULL,
                FOREIGN KEY(`parent_id`) REFERENCES elem(`id`)
-            );"""
+            );""",
+            "CREATE INDEX `elem_parent_id_sort_order` ON `elem` (`parent_id`, `sort_order`);",
+            "CREATE INDEX `elem_type_data` ON `elem` (`type`, `data`);",
         )
     _order = 'sort_order'
 
@@ -1,10 +1,22 @@
 __author__ = 'Roberto'
 
 from HTMLParser import HTMLParser, HTMLParseError
-from collections import OrderedDict
+from functools import partial
+import gc
 import sqlite3 as sqlite
 import re
 
+from attr_map import AttrMap
+from pattern_cache import patterns
+from loader import read_chunks, READ_SIZE
+from serializer import iter_markup, coalesce, CHUNK_SIZE
+from geometry import AttrStamp, move_mode, grid, ID_SUFFIX, MOVE_ROOT
+from geometry import affine_updates, scale_about, numeric_updates, parse_attr, Geometry
+from selector import compile_selector
+from ordering import GAP, between, renumber
+from fragment import feed_fragment
+import snapshot
+
 #element types
 COMMENT = '__comment__'
 DATA = '__data__'
@@ -28,6 +40,10 @@ CREATE TABLE `elem` (
   `sort_order` INTEGER DEFAULT NULL,
   FOREIGN KEY(`parent_id`) REFERENCES elem(`id`)
 );
+|||
+CREATE INDEX `elem_parent_id_sort_order` ON `elem` (`parent_id`, `sort_order`);
+|||
+CREATE INDEX `elem_type_data` ON `elem` (`type`, `data`);
 
 |||
 
@@ -43,11 +59,19 @@ CREATE TABLE `attr` (
   `k` VARCHAR DEFAULT NULL,
   `v` TEXT DEFAULT NULL,
   `elem_id` INTEGER DEFAULT NULL,
-  FOREIGN KEY(`elem_id`) REFERENCES elem(`id`)
+  FOREIGN KEY(`elem_id`) REFERENCES elem(`id`),
+  -- one value per key, the target of the upserts of DbParser
+  UNIQUE(`elem_id`, `k`)
 );
+|||
+-- NOCASE so that the LIKE prefix ranges built by DbParser.attr can use it
+CREATE INDEX `attr_k_v` ON `attr` (`k`, `v` COLLATE NOCASE);
 """
 
 
+_MISSING = object()
+
+
 class ParserException(HTMLParseError):
     pass
 
@@ -59,37 +83,121 @@ def render_attrs(attrs, prefix=''):
     return prefix + ' '.join(ret)
 
 
+class RecordTree(object):
+    """
+    The records of a DictParser for SelectorGroup.select, the candidates come from its tag and id indexes
+    (filtered by ancestry when scoped to some subtrees)
+    """
+
+    def __init__(self, parser, scoped=False):
+        self.parser = parser
+        self.scoped = scoped
+
+    def key(self, rec):
+        return rec['id']
+
+    def is_tag(self, rec):
+        return rec['type'] == TAG
+
+    def name(self, rec):
+        return rec['data']
+
+    def attr(self, rec, k):
+        return self.parser._attr.get(rec['id'], {}).get(k)
+
+    def parent(self, rec):
+        return self.parser._elem.get(rec['parent_id'])
+
+    def walk(self, roots):
+        for rec in roots:
+            if rec['type'] == TAG:
+                yield rec
+                for x in self.walk(self.parser._parent_sons.get(rec['id'], [])):
+                    yield x
+
+    def candidates(self, compound, roots):
+        ids = self.parser._attr_index.get('id', {})
+        if compound.id() is not None:
+            found = ids.get(compound.id(), set())
+        elif compound.id('^=') is not None:
+            found = set()
+            for value, elem_ids in ids.items():
+                if str(value).startswith(compound.id('^=')):
+                    found.update(elem_ids)
+        elif compound.tag is not None:
+            found = self.parser._type_data.get((TAG, compound.tag), {})
+        else:
+            return None
+        ret = [self.parser._elem[x] for x in sorted(found)]
+        if not self.scoped:
+            return ret
+        scope = set(x['id'] for x in roots)
+        return [x for x in ret if self._inside(x, scope)]
+
+    def _inside(self, rec, scope):
+        while rec is not None:
+            if rec['id'] in scope:
+                return True
+            rec = self.parent(rec)
+        return False
+
+    def order(self, recs):
+        return sorted(recs, key=self.key)
+
+
 class DictParser(HTMLParser):
     def __init__(self, html=None):
+        # the last element id, the last sort_order handed out (GAP apart, see ordering.py)
+        self._last_id = 0
         self._sort_order = 0
+        # parent of the top level nodes (the fragments of insert_after have their own, see fragment.py)
+        self._root_id = 0
         HTMLParser.__init__(self)
         self._tag_tree = []
-        if html is not None:
-            self.feed(html)
         self._elem = dict()
         self._parent_sons = dict()
         self._attr = dict()
+        # indexes: (type, data) -> {id: elem}, attribute key -> value -> set of elem ids
+        self._type_data = dict()
+        self._attr_index = dict()
+        # (elem id, k) -> parsed attribute, the edited ones waiting to be written back
+        self._geometry = dict()
+        self._geometry_dirty = dict()
+        if html is not None:
+            self.feed(html)
 
     def loads(self, data):
         self.feed(data)
 
-    def load(self, filename):
-        self.loads(open(filename, 'rb').read())
+    def load(self, source, chunk_size=READ_SIZE, progress=None):
+        for _ in self.iter_load(source, chunk_size, progress):
+            pass
+
+    def iter_load(self, source, chunk_size=READ_SIZE, progress=None):
+        """
+        Feed source (a file name or a file-like object) chunk by chunk, yielding (loaded, total) after
+        each one: the part of the document already read can be queried in the meantime
+        """
+        for chunk, loaded, total in read_chunks(source, chunk_size):
+            self.loads(chunk)
+            if progress is not None:
+                progress(loaded, total)
+            yield loaded, total
 
     def handle_decl(self, decl):
-        self._insert_elem(DECL, decl, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        self._insert_elem(DECL, decl, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
 
     def handle_pi(self, data):
-        self._insert_elem(PI, data, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        self._insert_elem(PI, data, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
 
     def handle_comment(self, data):
-        self._insert_elem(COMMENT, data, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        self._insert_elem(COMMENT, data, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
 
     def handle_data(self, data):
-        self._insert_elem(DATA, data, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        self._insert_elem(DATA, data, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
 
     def handle_starttag(self, tag, attrs):
-        last_id = self._insert_elem(TAG, tag, self._tag_tree[-1]['id'] if self._tag_tree else 0)
+        last_id = self._insert_elem(TAG, tag, self._tag_tree[-1]['id'] if self._tag_tree else self._root_id)
         self._tag_tree.append({'tag': tag, 'id': last_id})
         for k, v in attrs:
             self._insert_attr(k, v, last_id)
@@ -100,56 +208,198 @@ class DictParser(HTMLParser):
         else:
             raise ParserException('x')
 
-    def _shift_order(self):
-        self._elem = dict((x * 10, y) for x, y in self._elem.items())
+    def save_snapshot(self, path):
+        """
+        Write the tables to path in the binary format of snapshot.py, load_snapshot reads them back without parsing
+        """
+        if self._geometry_dirty:
+            self._write_geometry()
+        table = snapshot.StringTable()
+        numbers = [len(self._elem)] + snapshot.split64(self._sort_order)
+        for key in sorted(self._elem):
+            elem = self._elem[key]
+            attrs = self._attr.get(elem['id'], {}).items()
+            numbers.extend((key, elem['id'], table.add(elem['type']), table.add(elem['data']), elem['parent_id']))
+            numbers.extend(snapshot.split64(elem['sort_order']))
+            numbers.append(len(attrs))
+            for k, v in attrs:
+                numbers.extend((table.add(k), table.add(v)))
+        snapshot.write(path, snapshot.TABLES_KIND, table, numbers)
+
+    def load_snapshot(self, path):
+        """
+        Replace the tables with the ones saved by save_snapshot
+        """
+        collecting = gc.isenabled()
+        # every row stays referenced, the collector would walk the new tables over and over for nothing
+        gc.disable()
+        try:
+            self._load_tables(*snapshot.read(path, snapshot.TABLES_KIND))
+        finally:
+            if collecting:
+                gc.enable()
+
+    def _load_tables(self, strings, numbers):
+        # None (the value of the attributes without one) gets the last index
+        strings.append(None)
+        numbers = numbers.tolist()
+        if snapshot.NONE in numbers:
+            numbers = [len(strings) - 1 if x == snapshot.NONE else x for x in numbers]
+        self.reset()
+        self._tag_tree = []
+        self._elem = elems = dict()
+        self._parent_sons = dict()
+        self._attr = dict()
+        self._type_data = dict()
+        self._attr_index = index = dict()
+        self._geometry = dict()
+        self._geometry_dirty = dict()
+        self._sort_order = snapshot.join64(numbers[1], numbers[2])
+        self._last_id = 0
+        i = 3
+        for _ in xrange(numbers[0]):
+            key, _id, elem_type, data, parent_id, high, low, count = numbers[i:i + 8]
+            sort_order = snapshot.join64(high, low)
+            i += 8
+            self._last_id = max(self._last_id, _id)
+            elem = elems[key] = {'id': _id, 'type': strings[elem_type], 'data': strings[data], 'parent_id': parent_id,
+                                 'sort_order': sort_order}
+            self._parent_sons.setdefault(parent_id, []).append(elem)
+            self._type_data.setdefault((elem['type'], elem['data']), dict())[_id] = elem
+            if count:
+                end = i + 2 * count
+                keys = [strings[x] for x in numbers[i:end:2]]
+                values = [strings[x] for x in numbers[i + 1:end:2]]
+                self._attr[_id] = AttrMap.from_lists(keys, values)
+                for k, v in zip(keys, values):
+                    index.setdefault(k, dict()).setdefault(v, set()).add(_id)
+                i = end
+        for sons in self._parent_sons.values():
+            sons.sort(key=lambda x: x['sort_order'])
+
+    def _index_elem(self, elem):
+        sons = self._parent_sons.setdefault(elem['parent_id'], [])
+        pos = len(sons)
+        while pos and sons[pos - 1]['sort_order'] > elem['sort_order']:
+            pos -= 1
+        sons.insert(pos, elem)
+        self._type_data.setdefault((elem['type'], elem['data']), dict())[elem['id']] = elem
+
+    def _unindex_elem(self, elem):
+        sons = self._parent_sons[elem['parent_id']]
+        for pos, x in enumerate(sons):
+            if x is elem:
+                del sons[pos]
+                break
+        del self._type_data[(elem['type'], elem['data'])][elem['id']]
 
     def _insert_elem(self, elem_type, data, parent_id=0):
-        self._sort_order += 1
-        self._elem[self._sort_order] = dict(id=self._sort_order, type=elem_type, data=data, parent_id=parent_id,
-                                            sort_order=self._sort_order)
-        try:
-            self._parent_sons[parent_id].append(self._elem[self._sort_order])
-        except KeyError:
-            self._parent_sons[parent_id] = [self._elem[self._sort_order]]
-        return self._sort_order
+        self._last_id += 1
+        self._sort_order += GAP
+        self._elem[self._last_id] = dict(id=self._last_id, type=elem_type, data=data, parent_id=parent_id,
+                                         sort_order=self._sort_order)
+        self._index_elem(self._elem[self._last_id])
+        return self._last_id
 
     def set_elem_value(self, _id, value):
-        self._elem[_id]['data'] = value
+        self._update_elem(_id, data=value)
+
+    def set_elem_values(self, values):
+        """
+        Set the data of many elements, values is a dict or (id, value) pairs
+        """
+        if isinstance(values, dict):
+            values = values.items()
+        for _id, value in values:
+            self._update_elem(_id, data=value)
 
     def _update_elem(self, _id, **vals_to_update):
+        self._unindex_elem(self._elem[_id])
         self._elem[_id].update(vals_to_update)
+        self._index_elem(self._elem[_id])
         return self._sort_order
 
+    def _index_attr(self, k, old_value, new_value, elem_id):
+        values = self._attr_index.setdefault(k, dict())
+        if old_value is not _MISSING:
+            values[old_value].discard(elem_id)
+            if not values[old_value]:
+                del values[old_value]
+        values.setdefault(new_value, set()).add(elem_id)
+
     def _insert_attr(self, k, v, elem_id=0):
         try:
-            self._attr[elem_id][k] = v
+            attrs = self._attr[elem_id]
         except KeyError:
-            self._attr[elem_id] = OrderedDict()
-            self._attr[elem_id][k] = v
+            attrs = self._attr[elem_id] = AttrMap()
+        self._index_attr(k, attrs.get(k, _MISSING), v, elem_id)
+        attrs[k] = v
         return elem_id
 
     def _select_elem(self, **where):
         if not where:
             where = {'parent_id': 0}
+        if 'id' in where:
+            candidates = [self._elem[where['id']]] if where['id'] in self._elem else []
+        elif 'parent_id' in where:
+            candidates = self._parent_sons.get(where['parent_id'], [])
+        elif 'type' in where and 'data' in where:
+            found = self._type_data.get((where['type'], where['data']), {})
+            candidates = [found[x] for x in sorted(found)]
+        else:
+            candidates = [self._elem[x] for x in sorted(self._elem)]
         items_where = where.items()
-        ret = [self._elem[x] for x in self._elem if all((y in self._elem[x].items() for y in items_where))]
+        ret = [x for x in candidates if all((y in x.items() for y in items_where))]
         return ret
 
     def _select_attr(self, i=0):
+        if self._geometry_dirty:
+            self._write_geometry()
         try:
             ret = self._attr[i]
         except KeyError:
-            ret = OrderedDict()
+            ret = AttrMap()
         return ret
 
     def _update_attr(self, key, value, elem_id=0):
+        self._forget_geometry(elem_id, key)
+        self._index_attr(key, self._attr[elem_id][key], value, elem_id)
         self._attr[elem_id][key] = value
 
+    def geometry(self, rec, k):
+        """
+        The attribute k of rec parsed in a Geometry (see geometry.py), cached until the attribute is set again.
+        Its edits are written back before the attributes are read again
+        """
+        key = (rec['id'], k)
+        try:
+            return self._geometry[key]
+        except KeyError:
+            pass
+        value = self._geometry[key] = parse_attr(k, self._select_attr(rec['id'])[k])
+        value.listener = partial(self._geometry_dirty.__setitem__, key)
+        return value
+
+    def _write_geometry(self):
+        # cleared in place, the listeners of the cached values add to this dict
+        dirty = self._geometry_dirty.copy()
+        self._geometry_dirty.clear()
+        for (elem_id, k), value in dirty.items():
+            value = str(value)
+            self._index_attr(k, self._attr[elem_id][k], value, elem_id)
+            self._attr[elem_id][k] = value
+
+    def _forget_geometry(self, elem_id, k):
+        self._geometry.pop((elem_id, k), None)
+        self._geometry_dirty.pop((elem_id, k), None)
+
     def set_attr(self, recs, **params):
         for rec in recs:
             attr = self._select_attr(rec['id'])
             for k, v in params.items():
-                if k in (x[0] for x in attr):
+                if isinstance(v, Geometry):
+                    v = str(v)
+                if k in attr:
                     self._update_attr(k, v, rec['id'])
                 else:
                     self._insert_attr(k, v, rec['id'])
@@ -160,12 +410,51 @@ class DictParser(HTMLParser):
             ret.append(wrapper(self._select_attr(rec['id'])))
         return ret
 
+    def _tag_recs(self, recs):
+        ret = []
+        seen = set()
+        for rec in recs:
+            if rec['type'] == TAG and rec['id'] not in seen:
+                ret.append(rec)
+                seen.add(rec['id'])
+        return ret
+
+    def _apply_updates(self, recs, updates):
+        for rec, changes in zip(recs, updates):
+            for k, v in changes.items():
+                if k in self._attr.get(rec['id'], ()):
+                    self._update_attr(k, str(v), rec['id'])
+                else:
+                    self._insert_attr(k, str(v), rec['id'])
+
+    def translate(self, recs, dx, dy):
+        """
+        Move the elements of recs by dx, dy, the whole selection in one vectorized step
+        """
+        recs = self._tag_recs(recs)
+        self._apply_updates(recs, affine_updates([self._select_attr(x['id']).items() for x in recs], tx=dx, ty=dy))
+
+    def scale(self, recs, sx, sy=None, origin=(0, 0)):
+        """
+        Scale the positions and sizes of the elements of recs around origin
+        """
+        recs = self._tag_recs(recs)
+        self._apply_updates(recs, affine_updates([self._select_attr(x['id']).items() for x in recs],
+                                                 *scale_about(sx, sy, origin)))
+
+    def set_numeric(self, recs, name, values):
+        """
+        Set the attribute name of the i-th element of recs to values[i], values can be a numpy array
+        """
+        recs = self._tag_recs(recs)
+        self._apply_updates(recs, numeric_updates(len(recs), name, values))
+
     def __str__(self):
         ret = self._select_elem()
         return self.to_string(ret)
 
     def __len__(self):
-        return len(self._parent_sons[0])
+        return len(self._parent_sons.get(0, []))
 
     def yield_childs(self, recs, t=None):
         for rec in recs:
@@ -185,32 +474,21 @@ class DictParser(HTMLParser):
                 ret.append(x)
         return ret
 
+    def _describe(self, l):
+        return l['type'], l['data'], render_attrs(self._select_attr(l['id']), ' '), self._select_elem(parent_id=l['id'])
+
     def to_string(self, recs, before=None, after=None, html=None):
-        ret = []
-        for l in recs:
-            if before:
-                if l in before:
-                    ret.append(html)
-            if l['type'] == DECL:
-                ret.append('<!' + l['data'] + '>')
-            elif l['type'] == PI:
-                ret.append('<?' + l['data'] + '>')
-            elif l['type'] == COMMENT:
-                ret.append('<!--' + l['data'] + '-->')
-            elif l['type'] == DATA:
-                ret.append(l['data'])
-            elif l['type'] == TAG:
-                content = self.to_string(self._select_elem(parent_id=l['id']), after=after, html=html)
-                attributes = render_attrs(self._select_attr(l['id']), ' ')
-                tagname = l['data']
-                if content:
-                    ret.append('<%s%s>%s</%s>' % (tagname, attributes, content, tagname))
-                else:
-                    ret.append('<%s%s/>' % (tagname, attributes))
-            if after:
-                if l in after:
-                    ret.append(html)
-        return ''.join((str(x) for x in ret))
+        return ''.join(iter_markup(recs, self._describe, before, after, html))
+
+    def iter_chunks(self, recs=None, size=CHUNK_SIZE):
+        """
+        Yield the markup of recs (the whole document by default) in chunks of about size characters
+        """
+        return coalesce(iter_markup(self._select_elem() if recs is None else recs, self._describe), size)
+
+    def write(self, fileobj, recs=None, size=CHUNK_SIZE):
+        for chunk in self.iter_chunks(recs, size):
+            fileobj.write(chunk)
 
     def tag(self, tag_name):
         return self._select_elem(type=TAG, data=tag_name)
@@ -218,6 +496,86 @@ class DictParser(HTMLParser):
     def id(self, _id):
         return self.attr(id=_id)
 
+    def select(self, selector, recs=None):
+        """
+        The elements matching the css selector (see selector.py) ordered by id as tag() and attr(),
+        only the ones in the subtrees of recs if given
+        """
+        if self._geometry_dirty:
+            self._write_geometry()
+        tree = RecordTree(self, recs is not None)
+        return tree.order(compile_selector(selector).select(tree, self._select_elem() if recs is None else recs))
+
+    def insert_after(self, recs, html):
+        """
+        Parse html and insert its nodes right after each of recs, under the same parent.
+        Return the inserted top level records
+        """
+        ret = []
+        for rec in recs:
+            ret.extend(self._splice(self._elem[rec['id']], html))
+        return ret
+
+    def _splice(self, rec, html):
+        last_id = self._last_id
+        feed_fragment(self, rec['parent_id'], html)
+        return self._place_after(rec, last_id)
+
+    def _place_after(self, rec, last_id):
+        """
+        Move the siblings of rec with an id greater than last_id (the new ones) right after it,
+        the sons list is rebuilt once instead of moving them one by one
+        """
+        sons = self._parent_sons[rec['parent_id']]
+        inserted = [x for x in sons if x['id'] > last_id]
+        old = [x for x in sons if x['id'] <= last_id]
+        pos = [x['id'] for x in old].index(rec['id']) + 1
+        orders = between(rec['sort_order'], old[pos]['sort_order'] if pos < len(old) else None, len(inserted))
+        sons[:] = old[:pos] + inserted + old[pos:]
+        if orders is None:
+            # no room left after rec, renumber its siblings only
+            orders = renumber(len(sons))
+            moved = sons
+        else:
+            moved = inserted
+        for x, order in zip(moved, orders):
+            x['sort_order'] = order
+        if orders:
+            self._sort_order = max(self._sort_order, orders[-1])
+        return inserted
+
+    def replicate(self, recs, rows, cols, dx, dy, id_suffix=ID_SUFFIX):
+        """
+        Fill a rows x cols grid with copies of each of recs, the one in row, col moved by dx * col, dy * row and
+        with id_suffix % {'row': row, 'col': col} appended to its ids and labels.
+        Return the inserted top level records
+        """
+        ret = []
+        for rec in recs:
+            rec = self._elem[rec['id']]
+            template = self._stamp(rec, MOVE_ROOT)
+            last_id = self._last_id
+            for x, y, suffix in grid(rows, cols, dx, dy, id_suffix):
+                self._instance(template, rec['parent_id'], x, y, suffix)
+            ret.extend(self._place_after(rec, last_id))
+        return ret
+
+    def _stamp(self, rec, parent_mode):
+        if rec['type'] != TAG:
+            return rec, None, None
+        attrs = self._select_attr(rec['id']).items()
+        mode = move_mode(attrs, parent_mode)
+        return rec, AttrStamp(attrs, mode), [self._stamp(x, mode) for x in self._select_elem(parent_id=rec['id'])]
+
+    def _instance(self, template, parent_id, dx, dy, suffix):
+        rec, stamp, children = template
+        elem_id = self._insert_elem(rec['type'], rec['data'], parent_id)
+        if stamp is not None:
+            for k, v in stamp(dx, dy, suffix):
+                self._insert_attr(k, v, elem_id)
+            for x in children:
+                self._instance(x, elem_id, dx, dy, suffix)
+
     def insert_html_after(self, recs, html):
         """
         Return a new parser instance
@@ -239,27 +597,30 @@ class DictParser(HTMLParser):
             )
 
         """
+        if self._geometry_dirty:
+            self._write_geometry()
         if function.lower() == 'like':
             for k, v in params.items():
-                params[k] = re.compile(re.escape(v).replace('%%', '%').replace('%', '.*'), re.I)
+                params[k] = patterns.like(v)
         if function.lower() == 'regexp':
             for k, v in params.items():
-                params[k] = re.compile(v, re.I)
-        if function.lower() == 'like' or function.lower() == 'regexp':
-            filtered = []
-            for elem_id, attrs in self._attr.items():
-                ok = True
-                for k, v in params.items():
-                    if k not in attrs or not v.match(attrs[k]):
-                        ok = False
-                        break
-                if ok:
-                    filtered.append(elem_id)
-        else:
-            params_item = params.items()
-            filtered = [elem_id for elem_id in self._attr if
-                        all((y in self._attr[elem_id].items() for y in params_item))]
-        ret = [self._elem[x] for x in filtered]
+                params[k] = patterns.compile(v, re.I)
+        filtered = None
+        for k, v in params.items():
+            values = self._attr_index.get(k, {})
+            if function.lower() == 'like' or function.lower() == 'regexp':
+                found = set()
+                for value, elem_ids in values.items():
+                    if v.match(value if isinstance(value, basestring) else str(value)):
+                        found.update(elem_ids)
+            else:
+                found = values.get(v, set())
+            filtered = found if filtered is None else filtered & found
+            if not filtered:
+                return []
+        if filtered is None:
+            filtered = self._attr
+        ret = [self._elem[x] for x in sorted(filtered)]
         return ret
 
 
@@ -335,8 +696,7 @@ def test8(parser):
     parser2 = parser
     for i in xrange(8):
         this_id = 'template%i' % i
-        parser2 = parser2.insert_html_after(template, html)
-        template = parser2.id('template')[-1:]
+        template = parser2.insert_after(template, html)
         parser2.set_attr(template, id=this_id)
 
         for rec in parser2.yield_childs(parser2.id(this_id), TAG):
@@ -347,13 +707,8 @@ def test8(parser):
                 parser2.set_attr((rec,), x=new_x, y=new_y)
             except KeyError:
                 pass
-            try:
-                transform = attrs['transform']
-                for pre, _x, mid, _y, post in re.findall(r'(.*?)([0-9.]+)(\D+)([0-9.]+)(\D+)', transform, re.I):
-                    parser2.set_attr((rec,), transform="%s%s%s%s%s" % (
-                        pre, float(_x) + width * ((i + 1) % 3), mid, float(_y) - height * ((i + 1) / 3), post))
-            except KeyError:
-                pass
+            if 'transform' in attrs:
+                parser2.geometry(rec, 'transform').translate(width * ((i + 1) % 3), -height * ((i + 1) / 3))
 
     for j, rec in enumerate(parser2.childs(parser2.id('poker'), DATA)):
         parser2.set_elem_value(rec['id'], poker_values[j])
@@ -380,6 +735,178 @@ def test9(parser):
     assert all((x['type'] == TAG for x in childs))
 
 
+def test10(parser):
+    x = parser.id('carta')
+    parser.set_attr(x, id='carta2', x=71)
+    assert parser.attr(id='carta', function='=') == []
+    assert parser.attr(id='carta2', function='=') == x
+    assert parser.attr(x='71%') == [parser.id('spaziatura')[0], x[0]]
+    assert parser.attr(x=71, function='=') == x
+    assert len(parser.tag('rect')) == 2
+    data = parser.childs(parser.id('tspan3902'))
+    assert parser._select_elem(type=DATA, data='4') == data
+    parser.set_elem_value(data[0]['id'], '5')
+    assert parser._select_elem(type=DATA, data='4') == []
+    assert parser._select_elem(type=DATA, data='5') == data
+    assert parser.childs(parser.id('tspan3902')) == data
+    assert len(DictParser(open('test/test.svg', 'rb').read())) == 6
+
+
+def test11(parser):
+    inserted = parser.insert_after(parser.id('carta'), '<rect id="a"/><rect id="b"><title id="t">t</title></rect>')
+    assert [x['data'] for x in inserted] == ['rect', 'rect']
+    assert parser.get_attr(inserted, wrapper=dict) == [{'id': 'a'}, {'id': 'b'}]
+    ids = [parser.get_attr((x,), wrapper=dict)[0].get('id') for x in parser.childs(parser.id('template'), TAG)]
+    assert ids[:6] == ['spaziatura', 'carta', 'a', 'b', 't', 'poker']
+    assert 'y="681.42566"/><rect id="a"/><rect id="b"><title id="t">t</title></rect>' in str(parser)
+    assert len(parser) == 6
+    parser.loads('<g id="last"/>')
+    assert parser.to_string(parser._select_elem()[-1:]) == '<g id="last"/>'
+
+
+def test12(parser):
+    from StringIO import StringIO
+
+    out = StringIO()
+    parser.write(out)
+    assert out.getvalue() == str(parser)
+    chunks = list(parser.iter_chunks(parser.id('template'), size=1024))
+    assert len(chunks) > 1
+    assert ''.join(chunks) == parser.to_string(parser.id('template'))
+
+
+def test13(parser):
+    from StringIO import StringIO
+
+    data = open('test/test.svg', 'rb').read()
+    incremental = DictParser()
+    loading = incremental.iter_load(StringIO(data), 1000)
+    assert loading.next()[0] < len(data)
+    assert len(incremental.tag('svg')) == 1
+    assert len(incremental.tag('g')) == 0
+    for _ in loading:
+        pass
+    assert len(incremental.tag('g')) == 2
+    assert str(incremental) == str(parser)
+    progress = []
+    chunked = DictParser()
+    chunked.load('test/test.svg', 100, lambda loaded, total: progress.append((loaded, total)))
+    assert str(chunked) == str(parser)
+    assert len(progress) > 10
+    assert progress[-1] == (len(data), len(data))
+
+
+def test14(parser):
+    attrs = parser.get_attr(parser.id('spaziatura'), wrapper=dict)[0]
+    width, height = float(attrs['width']), float(attrs['height'])
+    template = parser.id('template')
+    copies = parser.replicate(template, 3, 3, width, -height)
+    assert [parser.get_attr((x,), wrapper=dict)[0]['id'] for x in copies] == [
+        'template10', 'template20', 'template01', 'template11', 'template21', 'template02', 'template12', 'template22']
+    sons = parser._parent_sons[template[0]['parent_id']]
+    assert sons.index(copies[0]) == sons.index(template[0]) + 1
+    # the template <g> has no position attribute: the copies get a translate, their content stays as it is
+    assert parser.get_attr(parser.id('template21'), wrapper=dict)[0]['transform'] == 'translate(%.12g,%.12g)' % (
+        2 * width, -height)
+    rect = parser.get_attr(parser.id('spaziatura21'), wrapper=dict)[0]
+    assert (rect['x'], rect['y']) == (attrs['x'], attrs['y'])
+    assert parser.get_attr(parser.id('tspan390221'), wrapper=dict)[0]['x'] == '191.48788'
+    assert len(parser.childs(parser.id('template22'))) == len(parser.childs(template))
+
+
+def test15(parser):
+    rects = parser.tag('rect')
+    before = parser.get_attr(rects, wrapper=dict)
+    parser.translate(rects + rects, 10, -5)
+    after = parser.get_attr(rects, wrapper=dict)
+    assert [float(x['x']) for x in after] == [float(x['x']) + 10 for x in before]
+    parser.scale(parser.id('spaziatura'), 0.5, 2)
+    assert parser.get_attr(parser.id('spaziatura'), wrapper=dict)[0]['height'] == '%.12g' % (295.33151 * 2)
+    parser.set_numeric(parser.tag('tspan'), 'dx', [1, 2, 3])
+    assert [x['dx'] for x in parser.get_attr(parser.tag('tspan'), wrapper=dict)] == ['1', '2', '3']
+    assert parser.attr(function='=', dx='2') == [parser.tag('tspan')[1]]
+
+
+def test16(parser):
+    path = parser.tag('path')
+    transform = parser.geometry(path[0], 'transform')
+    assert parser.geometry(path[0], 'transform') is transform
+    transform.translate(1, -1)
+    transform.translate(1, -1)
+    assert 'transform="translate(526.22275,707.95482)"' in str(parser)
+    assert parser.attr(function='=', transform='translate(526.22275,707.95482)') == path
+    transform.translate(1, -1)
+    assert 'transform="translate(527.22275,706.95482)"' in str(parser)
+    parser.set_attr(path, transform=transform)
+    assert parser.geometry(path[0], 'transform') is not transform
+    parser.geometry(parser.id('spaziatura')[0], 'width').scale(2)
+    assert parser.get_attr(parser.id('spaziatura'), wrapper=dict)[0]['width'] == '421.93374'
+
+
+def test17(parser):
+    from generic_parser import GenericParser, TAG_NAME, ATTRS
+
+    generic = GenericParser()
+    generic.load('test/test.svg')
+    for query in ('g#template > text tspan[id^=tspan]', 'rect', 'g g, #spaziatura', '*[x]', 'text > [y$="239"]',
+                  'svg > g > *', '[sodipodi:role~=line]'):
+        found = [(x['data'], parser.get_attr([x], dict)[0]) for x in parser.select(query)]
+        assert found == [(x[TAG_NAME], dict(x[ATTRS])) for x in generic.select(query)] and found, query
+        walked = compile_selector(query).select(RecordTree(parser), parser._select_elem())
+        assert parser.select(query) == sorted(walked, key=lambda x: x['id'])
+    template = parser.select('#template')
+    assert len(parser.select('text tspan', template)) == 3 and parser.select('svg tspan', template) == []
+    assert [x['id'] for x in parser.select('tspan', template)] == [x['id'] for x in parser.select('#template tspan')]
+
+
+def test18(parser):
+    import os
+    import tempfile
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        parser.insert_after(parser.id('spaziatura'), '<rect id="more" empty/>')
+        parser.geometry(parser.tag('path')[0], 'transform').translate(1, 1)
+        # past 4194303 appended elements the GAP apart orders no longer fit 32 bits
+        for elem in parser._elem.values():
+            elem['sort_order'] += 2 ** 40
+        parser._sort_order += 2 ** 40
+        parser.save_snapshot(path)
+        loaded = DictParser('<svg id="old"/>')
+        loaded.load_snapshot(path)
+        assert str(loaded) == str(parser) and loaded.get_attr(loaded.id('more'), dict) == [{'id': 'more', 'empty': None}]
+        for name in ('_elem', '_parent_sons', '_attr', '_type_data', '_attr_index', '_sort_order'):
+            assert getattr(loaded, name) == getattr(parser, name), name
+        assert loaded.select('#template > text tspan') == parser.select('#template > text tspan')
+        loaded.insert_after(loaded.id('more'), '<g/>')
+        assert str(loaded).count('<g') == str(parser).count('<g') + 1
+    finally:
+        os.remove(path)
+
+
+def test19(parser):
+    data = parser.childs(parser.tag('tspan'), DATA)
+    parser.set_elem_values(dict((x['id'], 'v%i' % i) for i, x in enumerate(data)))
+    assert [x['data'] for x in parser.childs(parser.tag('tspan'), DATA)] == ['v0', 'v1']
+
+
+def test20(parser):
+    spaziatura = parser.id('spaziatura')[0]
+    for n in xrange(15):
+        parser.insert_after([spaziatura], '<rect id="r%i"/>' % n)
+    siblings = [x['id'] for x in parser._parent_sons[spaziatura['parent_id']] if x['type'] == TAG]
+    start = siblings.index(spaziatura['id']) + 1
+    assert siblings[start:start + 15] == [parser.id('r%i' % n)[0]['id'] for n in reversed(xrange(15))]
+    orders = [x['sort_order'] for x in parser._parent_sons[spaziatura['parent_id']]]
+    assert orders == sorted(set(orders))
+    before = dict((x['id'], x['sort_order']) for x in parser._elem.values())
+    parser.insert_after(parser.id('r3'), '<rect id="one"/>')
+    assert [x for x in before if parser._elem[x]['sort_order'] != before[x]] == []
+    data = str(parser)
+    assert data.index('id="r3"') < data.index('id="one"') < data.index('id="r2"')
+
+
 def main(argv):
     import inspect
 
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: parse an html fragment into the tables of a DictParser or DbParser without touching its own feed state
+#
+# --------------
+
+__author__ = 'Roberto'
+
+from HTMLParser import HTMLParser
+from types import MethodType
+
+HANDLERS = ('handle_decl', 'handle_pi', 'handle_comment', 'handle_data', 'handle_starttag', 'handle_endtag')
+
+
+class FragmentParser(HTMLParser):
+    """
+    Run the handle_* callbacks of parser with a separate HTMLParser state and tag stack: the nodes go in the
+    tables of parser under root_id, while a document parser is still feeding (e.g. between two iter_load
+    chunks) its rawdata and open tags are left as they are
+    """
+
+    def __init__(self, parser, root_id):
+        HTMLParser.__init__(self)
+        self._parser = parser
+        self._tag_tree = []
+        self._root_id = root_id
+        for name in HANDLERS:
+            setattr(self, name, MethodType(getattr(parser.__class__, name).im_func, self))
+
+    def __getattr__(self, name):
+        # _insert_elem, _insert_attr and the tables are the ones of the parser
+        return getattr(self._parser, name)
+
+
+def feed_fragment(parser, root_id, html):
+    fragment = FragmentParser(parser, root_id)
+    fragment.feed(html)
+    fragment.close()
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    from dict_parser import DictParser
+    from db_parser import DbParser
+
+    whole = DictParser()
+    whole.load('test/test.svg')
+    for cls in (DictParser, DbParser):
+        parser = cls()
+        loads = parser.iter_load('test/test.svg', 200)
+        while not parser._tag_tree:
+            next(loads)
+        open_tags = list(parser._tag_tree)
+        top = parser.tag('svg')
+        parser.insert_after(top, '<g id="spliced">x</g>')
+        assert parser._tag_tree == open_tags
+        for _ in loads:
+            pass
+        assert len(parser.id('spliced')) == 1
+        assert str(parser).replace('<g id="spliced">x</g>', '', 1) == str(whole)
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -16,7 +16,18 @@
 __author__ = 'Roberto'
 
 from HTMLParser import HTMLParser, HTMLParseError
+from bisect import bisect_left, bisect_right
+from functools import partial
 import copy
+import gc
+
+from attr_map import AttrMap, attr_items as _attr_items
+from loader import read_chunks, READ_SIZE
+import compact as compact_nodes
+from geometry import AttrStamp, move_mode, grid, parse_attr, Geometry, ID_SUFFIX, MOVE_ROOT
+from serializer import iter_markup, coalesce, CHUNK_SIZE
+from selector import compile_selector, DomTree
+import snapshot
 
 ATTRS = 'attrs'
 TAG_NAME = 'tag_name'
@@ -29,70 +40,559 @@ TAG = '__tag__'
 PI = '__pi__'
 
 
+_MISSING = object()
+# the tables keyed by the id() of the nodes, rebuilt after unpickling
+_INDEXES = ('_parents', '_owners', '_positions', '_ids', '_sorted_ids', '_tags', '_tag_starts', '_span', '_count',
+            '_ordered', '_geometry', '_geometry_dirty')
+
+
 class GenericParserException(HTMLParseError):
     pass
 
 
+def _get_id(elem):
+    attrs = elem[ATTRS]
+    if isinstance(attrs, (AttrMap, dict)):
+        return attrs.get('id')
+    for k, v in attrs:
+        if k == 'id':
+            return v
+    return None
+
+
+def _make_node(node_type, value, tag_name=None, attrs=None):
+    if node_type == TAG:
+        if not isinstance(attrs, AttrMap):
+            attrs = AttrMap(attrs or ())
+        return {TYPE: TAG, TAG_NAME: tag_name, ATTRS: attrs, VALUE: value}
+    return {TYPE: node_type, VALUE: value}
+
+
+def _find_equal(e, lista, parent=None):
+    for pos, x in enumerate(lista):
+        if x == e:
+            return parent, lista, pos
+        if x[TYPE] == TAG:
+            found = _find_equal(e, x[VALUE], x)
+            if found is not None:
+                return found
+    return None
+
+
 def _render_attrs(attrs, prefix=''):
     ret = []
-    for k, v in attrs:
+    for k, v in _attr_items(attrs):
         ret.append('%s="%s"' % (k, v))
     return prefix + ' '.join(ret)
 
 
-class GenericParser(HTMLParser):
-    def __init__(self, dom=None):
+class GenericParser(HTMLParser, object):
+    def __init__(self, dom=None, clone=True, compact=False):
+        """
+        compact: build slotted nodes (see compact.py) instead of dicts, a given dom is copied into them
+        """
         HTMLParser.__init__(self)
+        self._tag_tree = []
+        self._node = compact_nodes.make_node if compact else _make_node
         if dom is None:
             self.dom = list()
-        else:
+        elif compact:
+            self.dom = compact_nodes.to_compact(dom)
+        elif clone:
             self.dom = copy.deepcopy(dom)
-        self._current = [self.dom]
-        self._tag_tree = []
+        else:
+            self.dom = dom
+
+    @property
+    def dom(self):
+        return self._dom
+
+    @dom.setter
+    def dom(self, dom):
+        self._reset(dom)
+        self._index_tree(dom)
+
+    def _reset(self, dom):
+        """
+        Make dom the document, with empty caches and indexes
+        """
+        self._dom = dom
+        self._current = [dom]
+        # (id(element), k) -> (element, parsed attribute), the keys of the edited ones waiting to be written back
+        self._geometry = dict()
+        self._geometry_dirty = dict()
+        self._clear_indexes()
+
+    def reindex(self):
+        """
+        Rebuild the id and tag indexes, needed only after changing ids or moving elements by hand
+        """
+        self._clear_indexes()
+        self._index_tree(self._dom)
+
+    def __getstate__(self):
+        if self._geometry_dirty:
+            self._write_geometry()
+        state = self.__dict__.copy()
+        for name in _INDEXES:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        # the nodes of the copy have other ids
+        self.__dict__.update(state)
+        self._geometry = dict()
+        self._geometry_dirty = dict()
+        self.reindex()
+
+    def _clear_indexes(self):
+        # id -> elements, tag name -> elements (and their start) in document order,
+        # id(element) -> [start, end] numbering the tags in document order, end is the last descendant,
+        # id(node) -> parent element (None at the top level), id(children list) -> its element,
+        # id(node) -> its last known position among its siblings (filled on demand, checked before use)
+        self._parents = dict()
+        self._owners = dict()
+        self._positions = dict()
+        self._ids = dict()
+        self._sorted_ids = None
+        self._tags = dict()
+        self._tag_starts = dict()
+        self._span = dict()
+        self._count = 0
+        self._ordered = True
+
+    def _index_tree(self, lista):
+        # an explicit stack, the depth of the document is not bound by the recursion limit
+        stack = [(iter(lista), None)]
+        while stack:
+            nodes, parent = stack[-1]
+            for x in nodes:
+                self._parents[id(x)] = parent
+                if x[TYPE] == TAG:
+                    self._index(x)
+                    stack.append((iter(x[VALUE]), x))
+                    break
+            else:
+                stack.pop()
+                if parent is not None:
+                    self._span[id(parent)][1] = self._count
+
+    def _index(self, elem):
+        self._owners[id(elem[VALUE])] = elem
+        self._count += 1
+        self._span[id(elem)] = [self._count, self._count]
+        self._tags.setdefault(elem[TAG_NAME], []).append(elem)
+        self._tag_starts.setdefault(elem[TAG_NAME], []).append(self._count)
+        self._index_id(elem)
+
+    def _index_id(self, elem):
+        _id = _get_id(elem)
+        if _id is not None:
+            try:
+                self._ids[_id].append(elem)
+            except KeyError:
+                self._ids[_id] = [elem]
+                self._sorted_ids = None
+
+    def _unindex_id(self, elem):
+        _id = _get_id(elem)
+        if _id in self._ids:
+            self._ids[_id] = [y for y in self._ids[_id] if y is not elem]
+            if not self._ids[_id]:
+                del self._ids[_id]
+                self._sorted_ids = None
+
+    def _link(self, lista, parent):
+        """
+        Add the nodes of lista (just attached under parent) to the parents and ids tables
+        """
+        for x in lista:
+            self._parents[id(x)] = parent
+            if x[TYPE] == TAG:
+                self._owners[id(x[VALUE])] = x
+                self._index_id(x)
+                self._link(x[VALUE], x)
+                # the tag numbering no longer follows the document
+                self._ordered = False
+
+    def _unlink(self, lista):
+        for x in lista:
+            self._parents.pop(id(x), None)
+            self._positions.pop(id(x), None)
+            if x[TYPE] == TAG:
+                self._owners.pop(id(x[VALUE]), None)
+                self._unindex_id(x)
+                self._unlink(x[VALUE])
+                self._ordered = False
+
+    def set_attr(self, elem, k, v):
+        """
+        Set the attribute k of elem, the id index follows a change of id (kept as text)
+        """
+        self._forget_geometry(elem, k)
+        if isinstance(v, Geometry):
+            v = str(v)
+        if k != 'id':
+            elem[ATTRS][k] = v
+            return
+        self._unindex_id(elem)
+        elem[ATTRS][k] = v if isinstance(v, basestring) else str(v)
+        self._reindex_id(elem)
+
+    def del_attr(self, elem, k):
+        self._forget_geometry(elem, k)
+        if k != 'id':
+            del elem[ATTRS][k]
+            return
+        self._unindex_id(elem)
+        del elem[ATTRS][k]
+
+    def _reindex_id(self, elem):
+        self._index_id(elem)
+        if len(self._ids[_get_id(elem)]) > 1:
+            # appended to the elements with the same id, not in document order
+            self._ordered = False
+
+    def parent(self, e):
+        """
+        The element containing e, None for the top level nodes
+        """
+        return self._parents[id(e)]
+
+    def _locate(self, e, lista=None):
+        """
+        The parent of e, the list holding it and its position there: found by identity through the parents
+        table and the positions remembered for the siblings, by equality (the first equal element of lista or
+        the dom) for a node outside this dom
+        """
+        parent = self._parents.get(id(e), _MISSING)
+        if parent is not _MISSING:
+            siblings = self.dom if parent is None else parent[VALUE]
+            pos = self._positions.get(id(e))
+            if pos is None or pos >= len(siblings) or siblings[pos] is not e:
+                # moved by an insertion before it: one pass renumbers all the siblings
+                for i, x in enumerate(siblings):
+                    self._positions[id(x)] = i
+                pos = self._positions.get(id(e))
+            if pos is not None and pos < len(siblings) and siblings[pos] is e:
+                return parent, siblings, pos
+        found = _find_equal(e, self.dom if lista is None else lista)
+        if found is None:
+            raise ValueError('element not found')
+        return found
+
+    def _ensure_order(self):
+        if not self._ordered:
+            self.reindex()
+
+    def _inside(self, elem, within):
+        start = self._span[id(elem)][0]
+        for x in within:
+            if x[TYPE] == TAG and self._span[id(x)][0] <= start <= self._span[id(x)][1]:
+                return True
+        return False
+
+    def _tag_lookup(self, tag_name, within=None):
+        """
+        The tag_name elements in document order, only the ones in the subtrees of within if given
+        """
+        self._ensure_order()
+        elems = self._tags.get(tag_name, [])
+        if within is None:
+            return list(elems)
+        starts = self._tag_starts.get(tag_name, [])
+        ret = []
+        for x in within:
+            if x[TYPE] == TAG:
+                start, end = self._span[id(x)]
+                ret.extend(elems[bisect_left(starts, start):bisect_right(starts, end)])
+        return ret
+
+    def _id_lookup(self, _id=None, startswith=None, within=None):
+        """
+        The elements with id _id or an id starting with startswith in document order,
+        only the ones in the subtrees of within if given
+        """
+        found = self._ids.get(_id, []) if _id is not None else []
+        if startswith is None and within is None and (self._ordered or len(found) < 2):
+            return list(found)
+        self._ensure_order()
+        found = list(found)
+        if startswith is not None:
+            if self._sorted_ids is None:
+                self._sorted_ids = sorted(self._ids)
+            for key in self._sorted_ids[bisect_left(self._sorted_ids, startswith):]:
+                if not key.startswith(startswith):
+                    break
+                if key != _id:
+                    found.extend(self._ids[key])
+            found.sort(key=lambda x: self._span[id(x)][0])
+        if within is not None:
+            found = [x for x in found if self._inside(x, within)]
+        return found
 
     def loads(self, data):
         self.feed(data)
 
-    def load(self, filename):
-        self.loads(open(filename, 'rb').read())
+    def load(self, source, chunk_size=READ_SIZE, progress=None):
+        for _ in self.iter_load(source, chunk_size, progress):
+            pass
+
+    def iter_load(self, source, chunk_size=READ_SIZE, progress=None):
+        """
+        Feed source (a file name or a file-like object) chunk by chunk, yielding (loaded, total) after
+        each one: the part of the document already read can be queried in the meantime
+        """
+        for chunk, loaded, total in read_chunks(source, chunk_size):
+            self.loads(chunk)
+            if progress is not None:
+                progress(loaded, total)
+            yield loaded, total
+
+    def _append(self, node):
+        self._current[-1].append(node)
+        self._parents[id(node)] = self._tag_tree[-1] if self._tag_tree else None
 
     def handle_decl(self, decl):
-        self._current[-1].append({TYPE: DECL, VALUE: decl})
+        self._append(self._node(DECL, decl))
 
     def insert(self, e, after=None, lista=None):
-        if lista is None:
-            lista = self.dom
-        pos = 0
-        for x in lista:
-            if after == x:
-                lista.insert(pos + 1, e)
-                return 1
+        """
+        Insert e right after the element after, at the end of lista (the dom by default) when after is None.
+        Return 1, None if after is not found
+        """
+        return self.insert_many([e], after, lista)
+
+    def insert_many(self, elems, after=None, lista=None):
+        """
+        Insert the elements of elems, in order, right after the element after with a single list operation
+        """
+        if after is None:
+            siblings = self.dom if lista is None else lista
+            parent = self._list_owner(siblings)
+            pos = len(siblings)
+        else:
+            try:
+                parent, siblings, pos = self._locate(after, lista)
+            except ValueError:
+                return None
             pos += 1
-            if x[TYPE] == TAG:
-                if self.insert(e, after, x[VALUE]):
+        siblings[pos:pos] = elems
+        self._link(elems, parent)
+        for i, x in enumerate(elems, pos):
+            self._positions[id(x)] = i
+        return 1
+
+    def remove(self, e):
+        """
+        Remove e and its subtree from the dom, ValueError if it is not there
+        """
+        parent, siblings, pos = self._locate(e)
+        del siblings[pos]
+        self._unlink([e])
+
+    def replace(self, old, new):
+        """
+        Put new in the place of old, ValueError if old is not there
+        """
+        parent, siblings, pos = self._locate(old)
+        siblings[pos] = new
+        self._unlink([old])
+        self._link([new], parent)
+
+    def geometry(self, elem, k):
+        """
+        The attribute k of elem parsed in a Geometry (see geometry.py), cached until the attribute is set again.
+        The element keeps the text, the edits are written back before the dom is rendered, searched or saved
+        """
+        key = (id(elem), k)
+        cached = self._geometry.get(key)
+        if cached is not None and cached[0] is elem:
+            return cached[1]
+        value = parse_attr(k, elem[ATTRS][k])
+        self._geometry[key] = (elem, value)
+        value.listener = partial(self._geometry_dirty.__setitem__, key)
+        return value
+
+    def _write_geometry(self):
+        # cleared in place, the listeners of the cached values add to this dict
+        dirty = self._geometry_dirty.copy()
+        self._geometry_dirty.clear()
+        for key, value in dirty.items():
+            elem, k = self._geometry[key][0], key[1]
+            if k == 'id':
+                self._unindex_id(elem)
+                elem[ATTRS][k] = str(value)
+                self._reindex_id(elem)
+            else:
+                elem[ATTRS][k] = str(value)
+
+    def _forget_geometry(self, elem, k):
+        key = (id(elem), k)
+        self._geometry.pop(key, None)
+        self._geometry_dirty.pop(key, None)
+
+    def select(self, selector, within=None):
+        """
+        The elements matching the css selector (see selector.py) in document order,
+        only the ones in the subtrees of within if given
+        """
+        if self._geometry_dirty:
+            self._write_geometry()
+        return compile_selector(selector).select(DomTree(self), self.dom if within is None else within)
+
+    def replicate(self, node, rows, cols, dx, dy, id_suffix=ID_SUFFIX):
+        """
+        Fill a rows x cols grid with copies of node, the one in row, col moved by dx * col, dy * row and
+        with id_suffix % {'row': row, 'col': col} appended to its ids and labels.
+        The copies are inserted right after node in a single pass, they are returned
+        """
+        if self._geometry_dirty:
+            self._write_geometry()
+        template = self._stamp(node, MOVE_ROOT)
+        copies = [self._instance(template, x, y, suffix) for x, y, suffix in grid(rows, cols, dx, dy, id_suffix)]
+        self.insert_many(copies, after=node)
+        return copies
+
+    def _stamp(self, node, parent_mode):
+        if node[TYPE] != TAG:
+            return node, None, None
+        attrs = _attr_items(node[ATTRS])
+        mode = move_mode(attrs, parent_mode)
+        return node, AttrStamp(attrs, mode), [self._stamp(x, mode) for x in node[VALUE]]
+
+    def _instance(self, template, dx, dy, suffix):
+        node, stamp, children = template
+        if stamp is None:
+            return self._node(node[TYPE], node[VALUE])
+        return self._node(TAG, [self._instance(x, dx, dy, suffix) for x in children], node[TAG_NAME],
+                          stamp(dx, dy, suffix))
+
+    def _list_owner(self, lista):
+        if lista is self.dom:
+            return None
+        return self._owners.get(id(lista))
+
+    def save_snapshot(self, path):
+        """
+        Write the dom to path in the binary format of snapshot.py, load_snapshot reads it back without parsing
+        """
+        if self._geometry_dirty:
+            self._write_geometry()
+        table = snapshot.StringTable()
+        numbers = [len(self.dom)]
+        stack = [iter(self.dom)]
+        while stack:
+            for x in stack[-1]:
+                kind = compact_nodes.KINDS.index(x[TYPE])
+                if x[TYPE] != TAG:
+                    numbers.extend((kind, table.add(x[VALUE])))
+                    continue
+                attrs = _attr_items(x[ATTRS])
+                numbers.extend((kind, table.add(x[TAG_NAME]), len(attrs), len(x[VALUE])))
+                for k, v in attrs:
+                    numbers.extend((table.add(k), table.add(v)))
+                stack.append(iter(x[VALUE]))
+                break
+            else:
+                stack.pop()
+        snapshot.write(path, snapshot.DOM_KIND, table, numbers)
+
+    def load_snapshot(self, path):
+        """
+        Replace the dom with the one saved by save_snapshot
+        """
+        collecting = gc.isenabled()
+        # every node stays referenced, the collector would walk the new dom over and over for nothing
+        gc.disable()
+        try:
+            self._load_dom(*snapshot.read(path, snapshot.DOM_KIND))
+        finally:
+            if collecting:
+                gc.enable()
+
+    def _load_dom(self, strings, numbers):
+        # None (the value of the attributes without one) gets the last index
+        strings.append(None)
+        numbers = numbers.tolist()
+        if snapshot.NONE in numbers:
+            numbers = [len(strings) - 1 if x == snapshot.NONE else x for x in numbers]
+        kinds = compact_nodes.KINDS
+        make = self._node
+        from_lists = AttrMap.from_lists
+        dom = []
+        # indexed while the nodes are built (as _index does) instead of walking the dom again
+        self._reset(dom)
+        parents, owners, span, tags, tag_starts, ids = (self._parents, self._owners, self._span, self._tags,
+                                                        self._tag_starts, self._ids)
+        count = 0
+        # (children list being filled, children still to read, their element), an explicit stack as in the
+        # serializer
+        stack = []
+        lista, left, parent = dom, numbers[0], None
+        i = 1
+        while True:
+            if not left:
+                if parent is not None:
+                    span[id(parent)][1] = count
+                if not stack:
                     break
+                lista, left, parent = stack.pop()
+                continue
+            left -= 1
+            kind = kinds[numbers[i]]
+            if kind != TAG:
+                node = make(kind, strings[numbers[i + 1]])
+                lista.append(node)
+                parents[id(node)] = parent
+                i += 2
+                continue
+            name, end, child_count = strings[numbers[i + 1]], i + 4 + 2 * numbers[i + 2], numbers[i + 3]
+            attrs = from_lists([strings[x] for x in numbers[i + 4:end:2]], [strings[x] for x in numbers[i + 5:end:2]])
+            i = end
+            children = []
+            elem = make(TAG, children, name, attrs)
+            lista.append(elem)
+            parents[id(elem)] = parent
+            owners[id(children)] = elem
+            count += 1
+            span[id(elem)] = [count, count]
+            try:
+                tags[name].append(elem)
+                tag_starts[name].append(count)
+            except KeyError:
+                tags[name] = [elem]
+                tag_starts[name] = [count]
+            _id = attrs.get('id')
+            if _id is not None:
+                ids.setdefault(_id, []).append(elem)
+            stack.append((lista, left, parent))
+            lista, left, parent = children, child_count, elem
+        self._count = count
 
     def handle_pi(self, data):
-        self._current[-1].append({TYPE: PI, VALUE: data})
+        self._append(self._node(PI, data))
 
     def handle_comment(self, data):
-        self._current[-1].append({TYPE: COMMENT, VALUE: data})
+        self._append(self._node(COMMENT, data))
 
     def handle_starttag(self, tag, attrs):
-        self._tag_tree.append(tag)
         lista = list()
-        self._current[-1].append({TYPE: TAG, TAG_NAME: tag, ATTRS: list(attrs), VALUE: lista})
+        elem = self._node(TAG, lista, tag, attrs)
+        self._append(elem)
         self._current.append(lista)
+        self._tag_tree.append(elem)
+        self._index(elem)
 
     def handle_endtag(self, tag):
-        if tag == self._tag_tree[-1]:
-            self._tag_tree.pop()
+        if tag == self._tag_tree[-1][TAG_NAME]:
+            self._span[id(self._tag_tree.pop())][1] = self._count
             self._current.pop()
         else:
             raise GenericParserException('x')
 
     def handle_data(self, data):
-        self._current[-1].append({TYPE: DATA, VALUE: data})
+        self._append(self._node(DATA, data))
 
     def __repr__(self):
         return repr(self.dom)
@@ -100,26 +600,27 @@ class GenericParser(HTMLParser):
     def __str__(self):
         return self._to_string(self.dom)
 
+    def _describe(self, l):
+        if l[TYPE] == TAG:
+            return TAG, l[TAG_NAME], _render_attrs(l[ATTRS], ' '), l[VALUE]
+        return l[TYPE], l[VALUE], None, None
+
     def _to_string(self, node):
-        ret = []
-        for l in node:
-            if l[TYPE] == DECL:
-                ret.append('<!' + l[VALUE] + '>')
-            elif l[TYPE] == PI:
-                ret.append('<?' + l[VALUE] + '>')
-            elif l[TYPE] == COMMENT:
-                ret.append('<!--' + l[VALUE] + '-->')
-            elif l[TYPE] == DATA:
-                ret.append(l[VALUE])
-            elif l[TYPE] == TAG:
-                content = self._to_string(l[VALUE])
-                attributes = _render_attrs(l[ATTRS], ' ')
-                tagname = l[TAG_NAME]
-                if content:
-                    ret.append('<%s%s>%s</%s>' % (tagname, attributes, content, tagname))
-                else:
-                    ret.append('<%s%s/>' % (tagname, attributes))
-        return ''.join(ret)
+        if self._geometry_dirty:
+            self._write_geometry()
+        return ''.join(iter_markup(node, self._describe))
+
+    def iter_chunks(self, node=None, size=CHUNK_SIZE):
+        """
+        Yield the markup of node (the whole dom by default) in chunks of about size characters
+        """
+        if self._geometry_dirty:
+            self._write_geometry()
+        return coalesce(iter_markup(self.dom if node is None else node, self._describe), size)
+
+    def write(self, fileobj, node=None, size=CHUNK_SIZE):
+        for chunk in self.iter_chunks(node, size):
+            fileobj.write(chunk)
 
 
 #  _____ ___ ___ _____
@@ -135,6 +636,198 @@ def test2(parser):
     assert str(parser).strip('\n\r ') == open('test/test_regen.svg', 'r').read().strip('\n\r ')
 
 
+def test3(parser):
+    from StringIO import StringIO
+
+    out = StringIO()
+    parser.write(out)
+    assert out.getvalue() == str(parser)
+    chunks = list(parser.iter_chunks(size=1024))
+    assert len(chunks) > 1
+    assert ''.join(chunks) == str(parser)
+
+
+def test4(parser):
+    from StringIO import StringIO
+
+    data = open('test/test.svg', 'rb').read()
+    progress = []
+    incremental = GenericParser()
+    loading = incremental.iter_load('test/test.svg', 1000, lambda loaded, total: progress.append((loaded, total)))
+    loading.next()
+    assert incremental.dom[0] == parser.dom[0]
+    assert '<g' not in str(incremental)
+    for _ in loading:
+        pass
+    assert str(incremental) == str(parser)
+    assert progress[-1] == (len(data), len(data))
+    streamed = GenericParser()
+    streamed.load(StringIO(data), chunk_size=100)
+    assert str(streamed) == str(parser)
+
+
+def test5(parser):
+    assert [_get_id(x) for x in parser._tag_lookup('g')] == ['layer1', 'template']
+    assert [_get_id(x) for x in parser._id_lookup(startswith='tspan')] == ['tspan3859', 'tspan3902', 'tspan3904']
+    template = parser._id_lookup('template')
+    assert template[0][TAG_NAME] == 'g'
+    assert len(parser._tag_lookup('tspan', template)) == 3
+    assert parser._tag_lookup('tspan', parser._id_lookup('poker')) == parser._id_lookup('tspan3859')
+    assert parser._id_lookup(startswith='tspan39', within=parser._id_lookup('poker')) == []
+    edited = GenericParser(parser.dom)
+    tspan = edited._id_lookup('tspan3904')[0]
+    edited.insert({TYPE: TAG, TAG_NAME: 'tspan', ATTRS: [('id', 'tspan3903')], VALUE: []},
+                  after=edited._id_lookup('tspan3902')[0])
+    assert edited._id_lookup('tspan3903')[0][ATTRS] == [('id', 'tspan3903')]
+    assert [_get_id(x) for x in edited._id_lookup(startswith='tspan39')] == ['tspan3902', 'tspan3903', 'tspan3904']
+    assert edited._tag_lookup('tspan')[-1] is tspan
+    edited.dom = []
+    assert edited._id_lookup('tspan3904') == []
+
+
+def test6(parser):
+    edited = GenericParser()
+    edited.loads('<svg><g id="a"><rect/><rect/></g><g id="b"/></svg>')
+    svg = edited.dom[0]
+    first, second = svg[VALUE][0][VALUE]
+    assert first == second and edited.parent(second) is svg[VALUE][0] and edited.parent(svg) is None
+    circle = {TYPE: TAG, TAG_NAME: 'circle', ATTRS: [('id', 'c')], VALUE: []}
+    assert edited.insert(circle, after=second) == 1
+    assert svg[VALUE][0][VALUE][2] is circle and edited.parent(circle) is svg[VALUE][0]
+    assert edited.insert(dict(circle), after={TYPE: TAG, TAG_NAME: 'line', ATTRS: [], VALUE: []}) is None
+    edited.insert_many([{TYPE: DATA, VALUE: 'x'}, {TYPE: COMMENT, VALUE: 'y'}], after=svg[VALUE][1])
+    assert str(edited) == '<svg ><g id="a"><rect /><rect /><circle id="c"/></g><g id="b"/>x<!--y--></svg>'
+    edited.remove(first)
+    edited.replace(edited._id_lookup('b')[0], {TYPE: TAG, TAG_NAME: 'g', ATTRS: [('id', 'd')], VALUE: []})
+    assert str(edited) == '<svg ><g id="a"><rect /><circle id="c"/></g><g id="d"/>x<!--y--></svg>'
+    assert edited._id_lookup('b') == [] and edited._id_lookup('d')[0][ATTRS] == [('id', 'd')]
+    assert [_get_id(x) for x in edited._tag_lookup('g')] == ['a', 'd']
+    edited.remove(circle)
+    assert edited._id_lookup('c') == []
+    try:
+        edited.remove(circle)
+        assert False
+    except ValueError:
+        pass
+    edited.loads('<svg><g><rect/></g><g></g></svg>')
+    first, empty = edited.dom[1][VALUE]
+    rect = {TYPE: TAG, TAG_NAME: 'rect', ATTRS: [], VALUE: []}
+    edited.insert(rect, lista=empty[VALUE])
+    assert empty[VALUE] == [rect] and edited.parent(rect) is empty
+    for n in xrange(5):
+        edited.insert({TYPE: TAG, TAG_NAME: 'rect', ATTRS: [('id', str(n))], VALUE: []}, after=first[VALUE][0])
+    edited.remove(edited._id_lookup('2')[0])
+    edited.insert({TYPE: TAG, TAG_NAME: 'rect', ATTRS: [('id', '5')], VALUE: []}, after=edited._id_lookup('0')[0])
+    assert [_get_id(x) for x in first[VALUE]] == [None, '4', '3', '1', '0', '5']
+
+
+def test7(parser):
+    edited = GenericParser(parser.dom)
+    template = edited._id_lookup('template')[0]
+    spaziatura = edited._id_lookup('spaziatura')[0][ATTRS]
+    width, height = float(spaziatura['width']), float(spaziatura['height'])
+    copies = edited.replicate(template, 2, 3, width, -height, id_suffix='_%(row)i_%(col)i')
+    siblings = edited.parent(template)[VALUE]
+    assert siblings[siblings.index(template) + 1:][:5] == copies
+    assert [_get_id(x) for x in copies] == ['template_0_1', 'template_0_2', 'template_1_0', 'template_1_1',
+                                            'template_1_2']
+    # the template <g> has no position attribute: the copies get a translate, their content stays as it is
+    assert copies[-1][ATTRS]['transform'] == 'translate(%.12g,%.12g)' % (2 * width, -height)
+    moved = edited._id_lookup('spaziatura_1_2')[0][ATTRS]
+    assert moved['inkscape:label'] == '#rect4002_1_2'
+    assert (moved['x'], moved['y']) == (spaziatura['x'], spaziatura['y'])
+    path = [x for x in edited._tag_lookup('path', [copies[0]])][0][ATTRS]
+    assert path['transform'] == 'translate(524.22275,709.95482)'
+    assert len(edited._tag_lookup('tspan', copies)) == 15
+    assert edited.parent(edited._id_lookup('tspan3859_1_1')[0])[TAG_NAME] == 'text'
+
+
+def test8(parser):
+    edited = GenericParser(parser.dom)
+    path = edited._tag_lookup('path')[0]
+    transform = edited.geometry(path, 'transform')
+    assert edited.geometry(path, 'transform') is transform and path[ATTRS]['transform'] == str(transform)
+    assert str(edited) == str(parser)
+    transform.translate(-1, 1e1)
+    assert 'transform="translate(523.22275,719.95482)"' in str(edited)
+    assert path[ATTRS]['transform'] == 'translate(523.22275,719.95482)'
+    transform.translate(0, 10)
+    assert edited.select('path[transform$="729.95482)"]') == [path]
+    tspan = edited._id_lookup('tspan3902')[0]
+    edited.geometry(tspan, 'y').shift(-33.57239)
+    assert '<tspan y="900" x="191.48788" id="tspan3902"' in str(edited)
+    edited.set_attr(tspan, 'y', edited.geometry(tspan, 'y'))
+    assert tspan[ATTRS]['y'] == '900' and edited.geometry(tspan, 'y') is not edited.geometry(path, 'transform')
+    assert not [v for x in edited._tag_lookup('tspan') for k, v in x[ATTRS].items() if not isinstance(v, str)]
+
+
+def test9(parser):
+    indexed = GenericParser(parser.dom)
+    for query in ('g#template > text tspan[id^=tspan]', 'tspan', '#spaziatura', 'g rect, text', '[id^=tspan]',
+                  'svg > g > g *', 'g[inkscape:label] > rect', 'text > tspan[y$="239"]'):
+        walked = compile_selector(query).select(DomTree(), indexed.dom)
+        assert indexed.select(query) == walked and walked, query
+        assert [id(x) for x in indexed.select(query)] == [id(x) for x in walked]
+    assert len(indexed.select('g#template > text tspan[id^=tspan]')) == 3
+    template = indexed.select('#template')
+    assert len(indexed.select('text tspan', template)) == 3 and indexed.select('svg tspan', template) == []
+
+
+def test10(parser):
+    import os
+    import tempfile
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        parser.save_snapshot(path)
+        loaded = GenericParser(compact=True)
+        loaded.load_snapshot(path)
+        assert str(loaded) == str(parser) and loaded.dom == parser.dom
+        assert loaded.select('#template tspan') == parser.select('#template tspan')
+        edited = GenericParser(parser.dom)
+        edited.replicate(edited._id_lookup('template')[0], 2, 2, 10, 10)
+        edited.geometry(edited._tag_lookup('path')[0], 'transform').translate(1, 1)
+        edited.dom[-2][ATTRS]['empty'] = None
+        edited.save_snapshot(path)
+        loaded.load_snapshot(path)
+        assert loaded.dom == GenericParser(edited.dom).dom and len(loaded._tag_lookup('tspan')) == 12
+        assert loaded.dom[-2][ATTRS]['empty'] is None and loaded.dom[-2][ATTRS].keys()[-1] == 'empty'
+        indexes = lambda: (loaded._parents, loaded._owners, loaded._span, loaded._ids, loaded._tags,
+                           loaded._tag_starts, loaded._count)
+        built = indexes()
+        loaded.reindex()
+        assert built == indexes()
+        deep = GenericParser()
+        deep.loads('<g>' * 1500 + 'x' + '</g>' * 1500)
+        deep.save_snapshot(path)
+        loaded.load_snapshot(path)
+        assert str(loaded) == str(deep) and len(loaded._tag_lookup('g', [loaded.dom[0]])) == 1500
+        uni = GenericParser()
+        uni.loads(u'<svg><text id="t" font="\xe8">caf\xe8 g</text></svg>')
+        uni.save_snapshot(path)
+        loaded.load_snapshot(path)
+        assert loaded.dom == uni.dom and loaded.dom[0][VALUE][0][VALUE][0][VALUE] == u'caf\xe8 g'
+        assert isinstance(loaded.dom[0][VALUE][0][ATTRS]['font'], unicode)
+    finally:
+        os.remove(path)
+
+
+def test11(parser):
+    import pickle
+
+    for compact in (False, True):
+        edited = GenericParser(parser.dom, compact=compact)
+        edited.geometry(edited._id_lookup('spaziatura')[0], 'x').shift(1)
+        copied = pickle.loads(pickle.dumps(edited, 2))
+        assert str(copied) == str(edited) and 'x="72.843056"' in str(copied)
+        assert copied.select('g tspan') == edited.select('g tspan') and copied.select('g tspan')[0] is not None
+        assert copied._id_lookup('spaziatura')[0] is copied.select('#spaziatura')[0]
+        text = copied.parent(copied._id_lookup('tspan3902')[0])
+        assert text == edited.parent(edited._id_lookup('tspan3902')[0])
+        assert any(x is text for x in copied._tag_lookup('text'))
+
+
 def main(argv):
     import inspect
 
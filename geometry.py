@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: coordinates and transforms of the svg elements, the attribute stamps used by replicate()
+#
+# --------------
+
+__author__ = 'Roberto'
+
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# svg numbers: sign, digits with an optional fraction, exponent
+NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+# a number and its unit suffix ('10mm', '100%'), kept when the number is rewritten
+LENGTH = re.compile(r'(%s)(%%|[a-zA-Z]*)' % NUMBER.pattern)
+TRANSFORM = re.compile(r'([a-zA-Z]+)\s*\(([^)]*)\)')
+PATH_TOKEN = re.compile(r'([MmZzLlHhVvCcSsQqTtAa])|(%s)' % NUMBER.pattern)
+
+ID_SUFFIX = '%(col)i%(row)i'
+# attributes renamed in every copy
+RENAMED = ('id', 'inkscape:label')
+
+# how an element of a replicated subtree is moved, MOVE_ROOT is the parent mode of the moved element itself
+MOVE_XY, MOVE_TRANSFORM, FIXED, MOVE_ROOT = range(4)
+
+# numeric attributes following the x axis, the y axis and the sizes scaled along them
+X_ATTRS = ('x', 'cx', 'x1', 'x2')
+Y_ATTRS = ('y', 'cy', 'y1', 'y2')
+WIDTH_ATTRS = ('width', 'rx', 'r')
+HEIGHT_ATTRS = ('height', 'ry')
+# the attributes placing an element, the ones without any of them are moved through a transform
+POSITION_ATTRS = X_ATTRS + Y_ATTRS + ('d', 'points')
+# user units in an absolute length unit, the offsets are in user units
+USER_UNITS = {'': 1.0, 'px': 1.0, 'in': 96.0, 'cm': 96 / 2.54, 'mm': 96 / 25.4, 'pt': 96 / 72.0, 'pc': 16.0}
+
+
+def format_number(n):
+    return '%.12g' % n
+
+
+def parse_numbers(text):
+    return [float(x) for x in NUMBER.findall(text)]
+
+
+def parse_lengths(text):
+    """
+    The numbers of text and the unit suffix of each one ('' for the plain numbers)
+    """
+    pairs = LENGTH.findall(text)
+    return [float(x) for x, unit in pairs], [unit for x, unit in pairs]
+
+
+def format_lengths(values, units):
+    return ' '.join(format_number(x) + (units[i] if i < len(units) else '') for i, x in enumerate(values))
+
+
+def to_user_units(numbers, units):
+    """
+    numbers and units with the absolute lengths (mm, cm, in, pt, pc) converted to user units, None when one of
+    them is relative (%, em, ex) to a size not known here
+    """
+    ret = []
+    ret_units = []
+    for x, unit in zip(numbers, units):
+        factor = USER_UNITS.get(unit.lower())
+        if factor is None:
+            return None
+        ret.append(x * factor)
+        ret_units.append(unit if factor == 1 else '')
+    return ret, ret_units
+
+
+def map_points(values, sx, sy, tx, ty):
+    """
+    The x, y pairs of a points attribute mapped by x * sx + tx, y * sy + ty
+    """
+    return [x * sx + tx if i % 2 == 0 else x * sy + ty for i, x in enumerate(values)]
+
+
+def parse_transform(text):
+    """
+    The list of (name, [numbers]) of a transform attribute
+    """
+    return [(name, parse_numbers(args)) for name, args in TRANSFORM.findall(text)]
+
+
+def format_transform(ops):
+    return ' '.join('%s(%s)' % (name, ','.join(format_number(x) for x in args)) for name, args in ops)
+
+
+def translate_transform(ops, dx, dy):
+    """
+    ops moved by dx, dy in the coordinates of the parent
+    """
+    if ops:
+        name, args = ops[0]
+        if name == 'translate':
+            return [(name, [args[0] + dx, (args[1] if len(args) > 1 else 0) + dy])] + ops[1:]
+        if name == 'matrix' and len(args) == 6:
+            return [(name, args[:4] + [args[4] + dx, args[5] + dy])] + ops[1:]
+    return [('translate', [dx, dy])] + ops
+
+
+def parse_path(text):
+    """
+    The list of (command, [numbers]) of a path d attribute
+    """
+    ret = []
+    for command, number in PATH_TOKEN.findall(text):
+        if command:
+            ret.append((command, []))
+        elif ret:
+            ret[-1][1].append(float(number))
+    return ret
+
+
+def format_path(commands):
+    return ' '.join(' '.join([command] + [format_number(x) for x in args]) for command, args in commands)
+
+
+def map_path(commands, sx, sy, tx, ty):
+    """
+    commands with the points mapped by x * sx + tx, y * sy + ty: the relative coordinates are only scaled
+    """
+    ret = []
+    for n, (command, args) in enumerate(commands):
+        upper = command.upper()
+        if upper == 'H':
+            roles = 'x'
+        elif upper == 'V':
+            roles = 'y'
+        elif upper == 'A':
+            roles = 'XY---xy'
+        else:
+            roles = 'xy'
+        mapped = []
+        for i, x in enumerate(args):
+            role = roles[i % len(roles)]
+            # the first pair of a path is absolute even after a lowercase moveto
+            absolute = command.isupper() or (n == 0 and i < 2)
+            if role == 'x':
+                x = x * sx + (tx if absolute else 0)
+            elif role == 'y':
+                x = x * sy + (ty if absolute else 0)
+            elif role == 'X':
+                x *= abs(sx)
+            elif role == 'Y':
+                x *= abs(sy)
+            mapped.append(x)
+        ret.append((command, mapped))
+    return ret
+
+
+class Geometry(object):
+    """
+    An attribute value parsed on first use: the edits change the numbers and the text is rebuilt only
+    when the value is rendered, an untouched value renders its original text.
+    listener is called with the value when it is first changed after being rendered
+    """
+    __slots__ = ('_text', '_parsed', 'listener')
+
+    def __init__(self, text=None, parsed=None):
+        self._text = text
+        self._parsed = parsed
+        self.listener = None
+
+    def parse(self, text):
+        raise NotImplementedError
+
+    def format(self, parsed):
+        raise NotImplementedError
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = self.parse(self._text)
+        return self._parsed
+
+    def _set(self, parsed):
+        self._parsed = parsed
+        if self._text is not None:
+            self._text = None
+            if self.listener is not None:
+                self.listener(self)
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self.format(self._parsed)
+        return self._text
+
+    def __eq__(self, other):
+        if isinstance(other, (Geometry, basestring)):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self))
+
+
+class Numbers(Geometry):
+    """
+    Coordinates, lengths, lists of numbers, each one rendered back with its unit suffix
+    """
+    __slots__ = ('_units',)
+
+    def __init__(self, text=None, parsed=None, units=()):
+        Geometry.__init__(self, text, parsed)
+        self._units = units
+
+    def parse(self, text):
+        ret, self._units = parse_lengths(text)
+        return ret
+
+    def format(self, parsed):
+        return format_lengths(parsed, self._units)
+
+    @property
+    def units(self):
+        self.parsed
+        return list(self._units)
+
+    @property
+    def values(self):
+        return list(self.parsed)
+
+    def set(self, values):
+        self._set([float(x) for x in values])
+
+    def shift(self, delta):
+        """
+        Add delta (in user units) to the numbers, the absolute lengths are converted to user units first
+        """
+        if not delta:
+            return
+        converted = to_user_units(self.parsed, self._units)
+        if converted is None:
+            raise ValueError('cannot shift the relative length %s by %s' % (self, format_number(delta)))
+        numbers, self._units = converted
+        self._set([x + delta for x in numbers])
+
+    def scale(self, factor):
+        self._set([x * factor for x in self.parsed])
+
+    def __float__(self):
+        return self.parsed[0]
+
+
+class Transform(Geometry):
+    __slots__ = ()
+
+    def parse(self, text):
+        return parse_transform(text)
+
+    def format(self, parsed):
+        return format_transform(parsed)
+
+    @property
+    def ops(self):
+        return [(name, list(args)) for name, args in self.parsed]
+
+    def translate(self, dx, dy):
+        self._set(translate_transform(self.parsed, dx, dy))
+
+    def prepend(self, name, args):
+        self._set([(name, list(args))] + self.parsed)
+
+
+class PathData(Geometry):
+    __slots__ = ()
+
+    def parse(self, text):
+        return parse_path(text)
+
+    def format(self, parsed):
+        return format_path(parsed)
+
+    @property
+    def commands(self):
+        return [(command, list(args)) for command, args in self.parsed]
+
+    def translate(self, dx, dy):
+        self._set(map_path(self.parsed, 1, 1, dx, dy))
+
+    def scale(self, sx, sy=None):
+        self._set(map_path(self.parsed, sx, sx if sy is None else sy, 0, 0))
+
+
+def parse_attr(k, v):
+    """
+    The Geometry of the attribute k with value v: Transform, PathData or Numbers for the other ones
+    """
+    if isinstance(v, Geometry):
+        return v
+    if k == 'transform':
+        return Transform(str(v))
+    if k == 'd':
+        return PathData(str(v))
+    return Numbers(str(v))
+
+
+def linked_attr(attrs, k):
+    """
+    The Geometry of attrs[k] for the elements without a parser to cache it: each edit is written back
+    to attrs[k] as text
+    """
+    value = parse_attr(k, attrs[k])
+
+    def write_back(value):
+        attrs[k] = str(value)
+
+    value.listener = write_back
+    return value
+
+
+def move_mode(attrs, parent_mode=MOVE_XY):
+    """
+    The elements with a transform are moved through it, their descendants are then relative to it
+    and stay where they are. The moved element itself (parent_mode MOVE_ROOT) gets a translate when
+    none of its attributes places it (a <g>, a <use> without x and y...)
+    """
+    if parent_mode not in (MOVE_XY, MOVE_ROOT):
+        return FIXED
+    if any(k == 'transform' for k, v in attrs):
+        return MOVE_TRANSFORM
+    if parent_mode == MOVE_ROOT and not any(k in POSITION_ATTRS for k, v in attrs):
+        return MOVE_TRANSFORM
+    return MOVE_XY
+
+
+class AttrStamp(object):
+    """
+    The attributes of one element of a template, parsed once and stamped out for every copy
+    """
+
+    def __init__(self, attrs, mode):
+        self.attrs = list(attrs)
+        self.mode = mode
+        # k -> (numbers, units) of the coordinates in user units, the relative ones (%, em) are copied as they are
+        self._numbers = dict()
+        self._points = None
+        self._ops = None
+        self._path = None
+        if mode == MOVE_TRANSFORM:
+            # without a transform attribute the copies get a translate
+            self._ops = []
+        for k, v in self.attrs:
+            if mode == MOVE_XY and (k in X_ATTRS or k in Y_ATTRS):
+                converted = to_user_units(*parse_lengths(str(v)))
+                if converted is not None:
+                    self._numbers[k] = converted
+            elif mode == MOVE_XY and k == 'points':
+                self._points = parse_attr(k, v).parsed
+            elif mode == MOVE_XY and k == 'd':
+                self._path = parse_attr(k, v).parsed
+            elif mode == MOVE_TRANSFORM and k == 'transform':
+                self._ops = parse_attr(k, v).parsed
+
+    def __call__(self, dx, dy, suffix):
+        ret = []
+        transform = False
+        for k, v in self.attrs:
+            if k in RENAMED:
+                v = '%s%s' % (v, suffix)
+            elif k in self._numbers and (dx if k in X_ATTRS else dy):
+                numbers, units = self._numbers[k]
+                offset = dx if k in X_ATTRS else dy
+                v = format_lengths([x + offset for x in numbers], units)
+            elif k == 'points' and self._points is not None:
+                v = format_lengths(map_points(self._points, 1, 1, dx, dy), ())
+            elif k == 'transform' and self._ops is not None:
+                v = format_transform(translate_transform(self._ops, dx, dy))
+                transform = True
+            elif k == 'd' and self._path is not None:
+                v = format_path(map_path(self._path, 1, 1, dx, dy))
+            ret.append((k, v))
+        if self._ops is not None and not transform:
+            ret.append(('transform', format_transform(translate_transform(self._ops, dx, dy))))
+        return ret
+
+
+def linear(values, factor, offset):
+    """
+    values * factor + offset, in one vectorized step when numpy is available: for the columns of a whole
+    selection, the few numbers of one attribute are faster in plain python
+    """
+    if numpy is not None:
+        return (numpy.asarray(values, dtype=float) * factor + offset).tolist()
+    return [x * factor + offset for x in values]
+
+
+class Column(object):
+    """
+    The numbers of the attributes gathered from a selection, flattened in a single list
+    """
+
+    def __init__(self):
+        self.owners = []
+        self.counts = []
+        self.units = []
+        self.values = []
+
+    def add(self, owner, k, v, offset=0):
+        """
+        Gather the numbers of the attribute k of owner: with an offset they are converted to user units and
+        the relative lengths (%, em) are left out, unchanged
+        """
+        numbers, units = parse_lengths(str(v))
+        if offset:
+            converted = to_user_units(numbers, units)
+            if converted is None:
+                return
+            numbers, units = converted
+        self.owners.append((owner, k))
+        self.counts.append(len(numbers))
+        self.units.append(units)
+        self.values.extend(numbers)
+
+    def scatter(self, values, updates):
+        pos = 0
+        for (owner, k), count, units in zip(self.owners, self.counts, self.units):
+            updates[owner][k] = Numbers(parsed=values[pos:pos + count], units=units)
+            pos += count
+
+
+def affine_updates(attr_lists, sx=1.0, sy=1.0, tx=0.0, ty=0.0):
+    """
+    The new values of the attributes in attr_lists (one list of (k, v) for each element) mapping the points with
+    x * sx + tx, y * sy + ty: a list of dict {k: new Geometry}, one for each element.
+    The coordinates and sizes of the whole selection are computed together, the elements with a transform
+    or without any position attribute (see move_mode) are moved through a transform
+    """
+    updates = [dict() for _ in attr_lists]
+    columns = [(Column(), X_ATTRS, sx, tx), (Column(), Y_ATTRS, sy, ty)]
+    if sx != 1 or sy != 1:
+        columns += [(Column(), WIDTH_ATTRS, abs(sx), 0), (Column(), HEIGHT_ATTRS, abs(sy), 0)]
+    for i, attrs in enumerate(attr_lists):
+        if move_mode(attrs, MOVE_ROOT) == MOVE_TRANSFORM:
+            ops = []
+            for k, v in attrs:
+                if k == 'transform':
+                    ops = parse_attr(k, v).parsed
+            if sx == 1 and sy == 1:
+                ops = translate_transform(ops, tx, ty)
+            else:
+                ops = [('matrix', [sx, 0, 0, sy, tx, ty])] + ops
+            updates[i]['transform'] = Transform(parsed=ops)
+            continue
+        for k, v in attrs:
+            if k == 'd':
+                updates[i][k] = PathData(parsed=map_path(parse_attr(k, v).parsed, sx, sy, tx, ty))
+            elif k == 'points':
+                updates[i][k] = Numbers(parsed=map_points(parse_attr(k, v).parsed, sx, sy, tx, ty))
+            for column, keys, factor, offset in columns:
+                if k in keys:
+                    column.add(i, k, v, offset)
+    for column, keys, factor, offset in columns:
+        if column.values:
+            column.scatter(linear(column.values, factor, offset), updates)
+    return updates
+
+
+def scale_about(sx, sy=None, origin=(0, 0)):
+    """
+    The sx, sy, tx, ty of affine_updates for a scaling around origin
+    """
+    if sy is None:
+        sy = sx
+    return sx, sy, origin[0] - origin[0] * sx, origin[1] - origin[1] * sy
+
+
+def numeric_updates(count, k, values):
+    """
+    The updates setting k to values (a sequence or a numpy array) on count elements
+    """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        values = values.tolist()
+    if len(values) != count:
+        raise ValueError('%i values for %i elements' % (len(values), count))
+    return [{k: Numbers(parsed=[float(x)])} for x in values]
+
+
+def grid(rows, cols, dx, dy, id_suffix=ID_SUFFIX):
+    """
+    Yield (offset x, offset y, suffix) for the cells of a rows x cols grid but the first one,
+    the place of the template
+    """
+    for row in xrange(rows):
+        for col in xrange(cols):
+            if row or col:
+                yield dx * col, dy * row, id_suffix % {'row': row, 'col': col}
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    assert parse_numbers('1,-2.5e3 .5-1E-2') == [1, -2500, 0.5, -0.01]
+    assert parse_transform('translate(524.22275,709.95482) rotate(-90)') == [
+        ('translate', [524.22275, 709.95482]), ('rotate', [-90])]
+    ops = parse_transform('translate(10)')
+    assert format_transform(translate_transform(ops, 1, -2.5)) == 'translate(11,-2.5)'
+    ops = parse_transform('matrix(1,0,0,1,-1e1,5)')
+    assert format_transform(translate_transform(ops, 1, 1)) == 'matrix(1,0,0,1,-9,6)'
+    assert format_transform(translate_transform(parse_transform('scale(2)'), 1, 1)) == 'translate(1,1) scale(2)'
+
+
+def test2():
+    stamp = AttrStamp([('id', 'a'), ('x', '1.5'), ('y', '-2'), ('inkscape:label', '#a')], MOVE_XY)
+    assert stamp(10, -100, '12') == [('id', 'a12'), ('x', '11.5'), ('y', '-102'), ('inkscape:label', '#a12')]
+    stamp = AttrStamp([('x', '1'), ('transform', 'translate(5,5)')], MOVE_TRANSFORM)
+    assert stamp(1, 1, '') == [('x', '1'), ('transform', 'translate(6,6)')]
+    assert move_mode([('transform', 'scale(2)')]) == MOVE_TRANSFORM
+    assert move_mode([('x', '1')], MOVE_TRANSFORM) == FIXED
+    assert move_mode([('id', 'g')], MOVE_ROOT) == MOVE_TRANSFORM and move_mode([('id', 'g')]) == MOVE_XY
+    stamp = AttrStamp([('id', 'g')], move_mode([('id', 'g')], MOVE_ROOT))
+    assert stamp(1, 2, '') == [('id', 'g'), ('transform', 'translate(1,2)')]
+    stamp = AttrStamp([('cx', '1mm'), ('y1', '2%'), ('points', '0 0 1 1'), ('r', '5mm'), ('x', '3px')], MOVE_XY)
+    assert stamp(1, 2, '') == [('cx', '4.77952755906'), ('y1', '2%'), ('points', '1 2 2 3'), ('r', '5mm'),
+                               ('x', '4px')]
+    assert stamp(0, 2, '')[0] == ('cx', '1mm')
+    assert list(grid(2, 2, 10, 20)) == [(10, 0, '10'), (0, 20, '01'), (10, 20, '11')]
+
+
+def test3():
+    attrs = [[('x', '1'), ('y', '2'), ('width', '10')], [('transform', 'translate(1,1)'), ('x', '5')],
+             [('x', '1 2 -3e0'), ('id', 'a')], [('id', 'b')]]
+    assert affine_updates(attrs, tx=1, ty=-1) == [{'x': '2', 'y': '1'}, {'transform': 'translate(2,0)'},
+                                                  {'x': '2 3 -2'}, {'transform': 'translate(1,-1)'}]
+    assert affine_updates(attrs, *scale_about(2, origin=(1, 1))) == [
+        {'x': '1', 'y': '3', 'width': '20'}, {'transform': 'matrix(2,0,0,2,-1,-1) translate(1,1)'},
+        {'x': '1 3 -7'}, {'transform': 'matrix(2,0,0,2,-1,-1)'}]
+    attrs = [[('cx', '10mm'), ('cy', '5'), ('r', '100%')], [('x1', '1'), ('y2', '2')], [('points', '0,0 10,5')]]
+    assert affine_updates(attrs, tx=1, ty=-1) == [{'cx': '38.7952755906', 'cy': '4'}, {'x1': '2', 'y2': '1'},
+                                                  {'points': '1 -1 11 4'}]
+    assert affine_updates(attrs, 2, 2)[0] == {'cx': '20mm', 'cy': '10', 'r': '200%'}
+    assert affine_updates(attrs, *scale_about(2, origin=(1, 1)))[0] == {'cx': '74.5905511811', 'cy': '9', 'r': '200%'}
+    assert affine_updates([[('x', '10%'), ('y', '1in')]], tx=1, ty=1) == [{'y': '97'}]
+    assert linear([1, 2], 2, 1) == [3, 5]
+    assert numeric_updates(2, 'x', [1, 2.5]) == [{'x': '1'}, {'x': '2.5'}]
+
+
+def test4():
+    calls = []
+    transform = parse_attr('transform', 'translate( 1 , -2e1 )')
+    transform.listener = calls.append
+    assert str(transform) == 'translate( 1 , -2e1 )' and transform == 'translate( 1 , -2e1 )'
+    transform.translate(1, 1)
+    transform.translate(1, 1)
+    assert str(transform) == 'translate(3,-18)' and calls == [transform]
+    transform.prepend('scale', [2])
+    assert str(transform) == 'scale(2) translate(3,-18)' and len(calls) == 2
+    numbers = parse_attr('x', '1.5')
+    numbers.shift(-0.5)
+    assert float(numbers) == 1 and numbers.values == [1] and str(numbers) == '1'
+    numbers = parse_attr('x', '1pc')
+    numbers.shift(1)
+    assert str(numbers) == '17'
+    numbers = parse_attr('x', '50%')
+    try:
+        numbers.shift(1)
+        assert False
+    except ValueError:
+        assert str(numbers) == '50%'
+    path = parse_attr('d', 'm 10,20 5,5 H 30 v 5 A 5 5 0 0 1 40 40 z')
+    assert path.commands[0] == ('m', [10, 20, 5, 5])
+    path.translate(1, 2)
+    assert str(path) == 'm 11 22 5 5 H 31 v 5 A 5 5 0 0 1 41 42 z'
+    path.scale(2)
+    assert str(path) == 'm 22 44 10 10 H 62 v 10 A 10 10 0 0 1 82 84 z'
+    attrs = {'d': 'M0 0'}
+    path = linked_attr(attrs, 'd')
+    path.translate(1, 1)
+    assert attrs['d'] == 'M 1 1'
+    path.translate(1, 1)
+    assert attrs['d'] == 'M 2 2' and isinstance(attrs['d'], str)
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: read documents in chunks for the incremental load of the parsers
+#
+# --------------
+
+__author__ = 'Roberto'
+
+import mmap
+import os
+
+READ_SIZE = 64 * 1024
+
+
+def _file_size(fileobj):
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def _read_mapped(filename, chunk_size):
+    with open(filename, 'rb') as f:
+        size = _file_size(f)
+        if not size:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start in xrange(0, size, chunk_size):
+                yield data[start:start + chunk_size], size
+        finally:
+            data.close()
+
+
+def _read_stream(fileobj, chunk_size):
+    size = _file_size(fileobj)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk, size
+
+
+def read_chunks(source, chunk_size=READ_SIZE):
+    """
+    Yield (chunk, loaded, total) reading source, a file name (memory mapped) or a file-like object.
+
+    Every chunk but the last ends right before a '<', so the text between two tags reaches the parser
+    in one piece. total is None when the size of the stream is unknown.
+    """
+    if isinstance(source, basestring):
+        chunks = _read_mapped(source, chunk_size)
+    else:
+        chunks = _read_stream(source, chunk_size)
+    loaded = 0
+    rest = ''
+    for chunk, total in chunks:
+        loaded += len(chunk)
+        chunk = rest + chunk
+        cut = chunk.rfind('<')
+        if cut > 0:
+            rest = chunk[cut:]
+            yield chunk[:cut], loaded - len(rest), total
+        else:
+            rest = chunk
+    if rest:
+        yield rest, loaded, total
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    data = open('test/test.svg', 'rb').read()
+    chunks = list(read_chunks('test/test.svg', 1000))
+    assert ''.join(x[0] for x in chunks) == data
+    assert len(chunks) > 3
+    assert all(x[0].startswith('<') for x in chunks[1:])
+    assert [x[1] for x in chunks] == sorted(x[1] for x in chunks)
+    assert chunks[-1][1:] == (len(data), len(data))
+
+
+def test2():
+    from StringIO import StringIO
+
+    data = open('test/test.svg', 'rb').read()
+    chunks = list(read_chunks(StringIO(data), 1000))
+    assert ''.join(x[0] for x in chunks) == data
+    assert chunks[-1][1:] == (len(data), None)
+    assert list(read_chunks(StringIO('<svg>' + 'x' * 100 + '</svg>'), 10)) == [
+        ('<svg>' + 'x' * 100, 105, None), ('</svg>', 111, None)]
+    with open('test/test.svg', 'rb') as f:
+        assert list(read_chunks(f, 1000)) == [(x[0], x[1], len(data)) for x in chunks]
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
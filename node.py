@@ -16,26 +16,32 @@
 
 __author__ = 'Roberto'
 
-from generic_parser import GenericParser, TAG_NAME, TYPE, TAG, VALUE, ATTRS
+from generic_parser import GenericParser, TAG_NAME, TYPE, TAG, VALUE, ATTRS, _get_id, _attr_items
+from geometry import affine_updates, scale_about, numeric_updates, linked_attr
+from selector import compile_selector, DomTree
+from attr_map import AttrMap
 import copy
-import re
 
 
 def traverse(lista):
     for x in lista:
         yield x
-        try:
-            if x[TYPE] == TAG:
-                for y in traverse(x[VALUE]):
-                    yield y
-        except KeyError:
-            pass
+        if x[TYPE] == TAG:
+            for y in traverse(x[VALUE]):
+                yield y
 
 
 class EmptyException(Exception):
     pass
 
 
+def _set_attr(parser, elem, k, v):
+    if parser is None:
+        elem[ATTRS][k] = v
+    else:
+        parser.set_attr(elem, k, v)
+
+
 class Nodes(list):
     def __init__(self, iterable=None):
         if iterable:
@@ -50,12 +56,22 @@ class Nodes(list):
 
     def id(self, *plist, **params):
         ret = Nodes()
-        ret_s = list()
+        seen = set()
         for elemento in self:
             for match in elemento.id(*plist, **params):
-                if str(match) not in ret_s:
+                if id(match.get_dom()) not in seen:
                     ret.append(match)
-                    ret_s.append(str(match))
+                    seen.add(id(match.get_dom()))
+        return ret
+
+    def select(self, selector):
+        ret = Nodes()
+        seen = set()
+        for elemento in self:
+            for match in elemento.select(selector):
+                if id(match.get_dom()) not in seen:
+                    ret.append(match)
+                    seen.add(id(match.get_dom()))
         return ret
 
     def attr(self, name):
@@ -63,11 +79,66 @@ class Nodes(list):
             return x.attr(name)
         raise EmptyException
 
+    def set_attr(self, name, value):
+        for x in self:
+            x.set_attr(name, value)
+
+    def geometry(self, name):
+        for x in self:
+            return x.geometry(name)
+        raise EmptyException
+
     def get_dom(self):
         for x in self:
             return x.get_dom()
         raise EmptyException
 
+    def _elements(self):
+        ret = []
+        seen = set()
+        for x in self:
+            for elem in x.dom:
+                if elem[TYPE] == TAG and id(elem) not in seen:
+                    ret.append(elem)
+                    seen.add(id(elem))
+        return ret
+
+    def _write_geometry(self):
+        for parser in set(x.parser for x in self if x.parser is not None):
+            parser._write_geometry()
+
+    def _update(self, elems, updates):
+        parsers = dict((id(elem), x.parser) for x in self for elem in x.dom)
+        for elem, changes in zip(elems, updates):
+            for k, v in changes.items():
+                _set_attr(parsers[id(elem)], elem, k, v)
+
+    def translate(self, dx, dy):
+        """
+        Move the selected elements by dx, dy, the whole selection in one vectorized step
+        """
+        self._write_geometry()
+        elems = self._elements()
+        self._update(elems, affine_updates([_attr_items(x[ATTRS]) for x in elems], tx=dx, ty=dy))
+
+    def scale(self, sx, sy=None, origin=(0, 0)):
+        """
+        Scale the positions and sizes of the selected elements around origin
+        """
+        self._write_geometry()
+        elems = self._elements()
+        self._update(elems, affine_updates([_attr_items(x[ATTRS]) for x in elems], *scale_about(sx, sy, origin)))
+
+    def set_numeric(self, name, values):
+        """
+        Set the attribute name of the i-th selected element to values[i], values can be a numpy array
+        """
+        elems = self._elements()
+        self._update(elems, numeric_updates(len(elems), name, values))
+
+    def clone(self):
+        return Nodes(x.clone() for x in self)
+
     def __str__(self):
         ret = ''
         if len(self) < 2:
@@ -82,40 +153,88 @@ class Nodes(list):
 
 
 class Node(object):
-    def __init__(self, lista):
-        self.dom = copy.deepcopy(lista)
+    """
+    A view over a list of elements of a dom, edits made through it change the dom itself
+    """
+
+    def __init__(self, lista, parser=None):
+        if isinstance(lista, GenericParser):
+            parser = lista
+            lista = parser.dom
+        self.dom = lista
+        # the parser owning the dom, its id and tag indexes replace the traversals
+        self.parser = parser
+
+    def clone(self):
+        return Node(copy.deepcopy(self.dom))
+
+    def _within(self):
+        return None if self.dom is self.parser.dom else self.dom
 
     def tag(self, tag_name):
-        ret = Nodes()
-        for elemento in traverse(self.dom):
+        if self.parser is not None:
             try:
-                if elemento[TYPE] == TAG:
-                    if elemento[TAG_NAME] == tag_name:
-                        ret.append(Node([elemento]))
+                return Nodes(Node([x], self.parser) for x in self.parser._tag_lookup(tag_name, self._within()))
             except KeyError:
+                # not (or no more) in the parser dom
                 pass
-            except TypeError:
-                pass
+        ret = Nodes()
+        for elemento in traverse(self.dom):
+            if elemento[TYPE] == TAG and elemento[TAG_NAME] == tag_name:
+                ret.append(Node([elemento]))
         return ret
 
     def id(self, _id=None, startswith=None):
+        if self.parser is not None:
+            try:
+                return Nodes(Node([x], self.parser) for x in self.parser._id_lookup(_id, startswith, self._within()))
+            except KeyError:
+                pass
         ret = Nodes()
         for elemento in traverse(self.dom):
+            if elemento[TYPE] != TAG:
+                continue
+            value = _get_id(elemento)
+            if value is None:
+                continue
+            if value == _id or (startswith is not None and value.startswith(startswith)):
+                ret.append(Node([elemento]))
+        return ret
+
+    def select(self, selector):
+        """
+        The elements of the subtrees of this node matching the css selector, e.g. 'g#template > text tspan[id^=tspan]'
+        """
+        group = compile_selector(selector)
+        if self.parser is not None:
             try:
-                if elemento[TYPE] == TAG:
-                    if dict(elemento[ATTRS])['id'] == _id:
-                        ret.append(Node([elemento]))
-                    if dict(elemento[ATTRS])['id'].startswith(startswith):
-                        ret.append(Node([elemento]))
+                return Nodes(Node([x], self.parser) for x in group.select(DomTree(self.parser), self.dom))
             except KeyError:
                 pass
-            except TypeError:
-                pass
-        return ret
+        return Nodes(Node([x]) for x in group.select(DomTree(), self.dom))
 
     def attr(self, name):
+        if self.parser is not None:
+            self.parser._write_geometry()
+        for x in self.dom:
+            return x[ATTRS][name]
+        raise EmptyException
+
+    def set_attr(self, name, value):
+        for x in self.dom:
+            _set_attr(self.parser, x, name, value)
+            return
+        raise EmptyException
+
+    def geometry(self, name):
+        """
+        The attribute name parsed in a Geometry, cached by the parser (see GenericParser.geometry),
+        written back at each edit for a node without one
+        """
         for x in self.dom:
-            return dict(x[ATTRS])[name]
+            if self.parser is not None:
+                return self.parser.geometry(x, name)
+            return linked_attr(x[ATTRS], name)
         raise EmptyException
 
     def value(self):
@@ -125,7 +244,7 @@ class Node(object):
         return self.dom[0]
 
     def __str__(self):
-        return str(GenericParser(self.dom))
+        return (self.parser or GenericParser())._to_string(self.dom)
 
 
 #  _____ ___ ___ _____
@@ -163,10 +282,10 @@ def test5(parser):
 def test6(parser):
     node = Node(parser.dom)
     assert node.id('spaziatura').get_dom() == {'tag_name': 'rect', 'type': '__tag__',
-                                               'attrs': [('inkscape:label', '#rect4002'), ('y', '668.4176'),
-                                                         ('x', '71.843056'), ('height', '295.33151'),
-                                                         ('width', '210.96687'), ('id', 'spaziatura'), ('style',
-                                                                                                        'fill:#ffffff;fill-opacity:1;stroke:#000000;stroke-width:0.9941119;stroke-opacity:1')],
+                                               'attrs': AttrMap([('inkscape:label', '#rect4002'), ('y', '668.4176'),
+                                                                 ('x', '71.843056'), ('height', '295.33151'),
+                                                                 ('width', '210.96687'), ('id', 'spaziatura'), ('style',
+                                                                                                                'fill:#ffffff;fill-opacity:1;stroke:#000000;stroke-width:0.9941119;stroke-opacity:1')]),
                                                'value': []}
     assert node.id('spaziatura').attr('x') == '71.843056'
 
@@ -175,16 +294,15 @@ def test7(parser):
     original_dom = copy.deepcopy(parser.dom)
     node = Node(parser.dom)
     spaziatura = node.id('spaziatura').get_dom()
-    width = float(dict(spaziatura[ATTRS])['width'])
-    height = float(dict(spaziatura[ATTRS])['height'])
-    for elem in node.id('template').get_dom()[VALUE]:
+    width = float(spaziatura[ATTRS]['width'])
+    height = float(spaziatura[ATTRS]['height'])
+    for elem in list(node.id('template').get_dom()[VALUE]):
         for x in xrange(3):
             for y in xrange(3):
                 if x == 0 and y == 0:
                     continue
                 new_obj = copy.deepcopy(elem)
                 try:
-                    new_obj[ATTRS] = dict(new_obj[ATTRS])
                     new_obj[ATTRS]['inkscape:label'] = str(new_obj[ATTRS]['inkscape:label'] + str(x) + str(y))
                     new_obj[ATTRS]['id'] = str(new_obj[ATTRS]['id'] + str(x) + str(y))
                     try:
@@ -192,15 +310,9 @@ def test7(parser):
                         new_obj[ATTRS]['y'] = float(new_obj[ATTRS]['y']) - height * y
                     except KeyError:
                         pass
-                    try:
-                        transform = new_obj[ATTRS]['transform']
-                        for pre, _x, mid, _y, post in re.findall(r'(.*?)([0-9.]+)(\D+)([0-9.]+)(\D+)', transform, re.I):
-                            new_obj[ATTRS]['transform'] = "%s%s%s%s%s" % (
-                                pre, float(_x) + width * x, mid, float(_y) - height * y, post)
-                    except KeyError:
-                        pass
-                    new_obj[ATTRS] = list(new_obj[ATTRS].items())
                     parser.insert(new_obj, after=elem)
+                    if 'transform' in new_obj[ATTRS]:
+                        parser.geometry(new_obj, 'transform').translate(width * x, -height * y)
                 except KeyError:
                     pass
     open('out.svg', 'wb').write(str(parser))
@@ -214,6 +326,97 @@ def test7(parser):
     parser.dom = original_dom
 
 
+def test8(parser):
+    node = Node(parser.dom)
+    spaziatura = node.id('spaziatura')
+    assert spaziatura.get_dom() is node.tag('g').id('spaziatura').get_dom()
+    assert len(Nodes([node, node]).id('spaziatura')) == 1
+    clone = spaziatura.clone()
+    assert clone.get_dom() == spaziatura.get_dom()
+    assert clone.get_dom() is not spaziatura.get_dom()
+    spaziatura.set_attr('class', 'view')
+    try:
+        assert 'class="view"' in str(parser)
+        assert 'class="view"' not in str(clone)
+    finally:
+        del spaziatura.get_dom()[ATTRS]['class']
+
+
+def test9(parser):
+    indexed = Node(GenericParser(parser.dom))
+    node = Node(indexed.parser.dom)
+    assert indexed.parser is not None and node.parser is None
+    for query in (lambda n: n.tag('g'), lambda n: n.tag('tspan'), lambda n: n.id('template'),
+                  lambda n: n.id(startswith='tspan'), lambda n: n.tag('g').id('template'),
+                  lambda n: n.id('template').tag('text').tag('tspan'), lambda n: n.id('poker').id(startswith='tspan'),
+                  lambda n: n.tag('rect').id('spaziatura')):
+        assert [x.get_dom() for x in query(indexed)] == [x.get_dom() for x in query(node)]
+    template = indexed.id('template').get_dom()
+    indexed.parser.insert(copy.deepcopy(template), after=template)
+    assert len(indexed.id('template')) == 2
+    assert len(indexed.tag('g')) == 3
+    assert len(indexed.id('template').tag('tspan')) == 6
+    assert len(Node([template], indexed.parser).tag('tspan')) == 3
+    detached = indexed.id('poker')[0].clone()
+    assert len(Node(detached.dom, indexed.parser).tag('tspan')) == 1
+
+
+def test10(parser):
+    node = Node(GenericParser(parser.dom))
+    rects = node.tag('rect')
+    rects.translate(10, -5)
+    assert rects.attr('x') == '%.12g' % (71.843056 + 10) and rects.attr('y') == '%.12g' % (668.4176 - 5)
+    path = node.tag('path')
+    path.translate(1, 1)
+    assert path.attr('transform') == 'translate(525.22275,710.95482)'
+    spaziatura = node.id('spaziatura')
+    spaziatura.scale(2, origin=(float(spaziatura.attr('x')), 0))
+    assert spaziatura.attr('x') == '81.843056' and spaziatura.attr('width') == '421.93374'
+    tspans = node.tag('tspan')
+    tspans.set_numeric('y', [1, 2, 3.5])
+    assert [x.attr('y') for x in tspans] == ['1', '2', '3.5']
+    try:
+        tspans.set_numeric('y', [1])
+        assert False
+    except ValueError:
+        pass
+    assert node.id('spaziatura').attr('x') != Node(parser.dom).id('spaziatura').attr('x')
+
+
+def test11(parser):
+    indexed = Node(GenericParser(parser.dom))
+    node = Node(parser.dom)
+    for query in ('g#template > text tspan[id^=tspan]', 'rect', 'g g, #spaziatura', '*[x]'):
+        assert [x.get_dom() for x in indexed.select(query)] == [x.get_dom() for x in node.select(query)]
+    assert len(node.select('g#template > text tspan[id^=tspan]')) == 3
+    assert [x.attr('id') for x in node.tag('text').select('tspan')] == ['tspan3859', 'tspan3902', 'tspan3904']
+    assert len(node.select('g').select('text')) == 2
+    assert len(indexed.id('poker').select('g#template tspan')) == 0
+
+
+def test12(parser):
+    node = Node(GenericParser(parser.dom))
+    node.id('spaziatura').set_attr('id', 'renamed')
+    assert len(node.id('renamed')) == 1 and len(node.id('spaziatura')) == 0
+    node.tag('tspan').set_numeric('id', [1, 2, 3])
+    assert [x.get_dom() for x in node.id('1') + node.id('2') + node.id('3')] == [x.get_dom() for x in node.tag('tspan')]
+    assert len(node.id(startswith='tspan')) == 0
+
+
+def test13(parser):
+    edited = GenericParser(parser.dom)
+    rect = Node(edited).id('spaziatura')
+    rect.geometry('x').shift(1)
+    assert rect.attr('x') == '72.843056' and rect.get_dom()[ATTRS]['x'] == '72.843056'
+    rect.translate(1, 0)
+    rect.geometry('x').shift(1)
+    assert 'x="74.843056"' in str(rect)
+    loose = Node([copy.deepcopy(rect.get_dom())])
+    loose.geometry('y').shift(1)
+    assert loose.attr('y') == '669.4176'
+    assert not [v for x in traverse(edited.dom) if x[TYPE] == TAG for v in x[ATTRS].values() if not isinstance(v, str)]
+
+
 def main(argv):
     import inspect
 
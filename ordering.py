@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: gapped sort_order keys, inserting between two siblings touches only the new rows
+#
+# --------------
+
+__author__ = 'Roberto'
+
+# distance between the sort orders of consecutive nodes as they are appended
+GAP = 1024
+
+
+def between(low, high, count):
+    """
+    count increasing sort orders strictly between low and high (None when there is no following sibling),
+    None when there is no room left and the siblings must be renumbered
+    """
+    if high is None:
+        return [low + GAP * (i + 1) for i in xrange(count)]
+    step = (high - low) // (count + 1)
+    if step < 1:
+        return None
+    return [low + step * (i + 1) for i in xrange(count)]
+
+
+def renumber(count):
+    """
+    The fresh sort orders of count siblings
+    """
+    return [GAP * (i + 1) for i in xrange(count)]
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    assert between(GAP, 2 * GAP, 1) == [GAP + GAP // 2]
+    assert between(GAP, None, 2) == [2 * GAP, 3 * GAP]
+    orders = between(0, 10, 4)
+    assert orders == sorted(set(orders)) and 0 < orders[0] and orders[-1] < 10
+    assert between(5, 6, 1) is None and between(5, 7, 1) == [6]
+    assert renumber(3) == [GAP, 2 * GAP, 3 * GAP]
+
+
+def test2():
+    low, high = GAP, 2 * GAP
+    inserts = 0
+    while True:
+        orders = between(low, high, 1)
+        if orders is None:
+            break
+        high = orders[0]
+        inserts += 1
+    assert inserts == 10
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: bounded cache of the compiled patterns used by REGEXP and LIKE queries
+#
+# --------------
+
+__author__ = 'Roberto'
+
+from collections import OrderedDict
+import sqlite3 as sqlite
+import re
+import threading
+
+MAX_PATTERNS = 256
+
+
+def like_to_regex(pattern):
+    """
+    Translate a sql LIKE pattern in an anchored regular expression
+    """
+    ret = []
+    for c in pattern:
+        if c == '%':
+            ret.append('.*')
+        elif c == '_':
+            ret.append('.')
+        else:
+            ret.append(re.escape(c))
+    return ''.join(ret) + '$'
+
+
+class PatternCache(object):
+    """
+    The last maxsize compiled patterns, shared by the threads of a connection pool (the lock keeps the pop and
+    set of an entry together)
+    """
+
+    def __init__(self, maxsize=MAX_PATTERNS):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._patterns = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, expr, flags=0):
+        key = (expr, flags)
+        with self._lock:
+            try:
+                reg = self._patterns.pop(key)
+                self.hits += 1
+            except KeyError:
+                reg = re.compile(expr, flags)
+                self.misses += 1
+                if len(self._patterns) >= self.maxsize:
+                    self._patterns.popitem(last=False)
+            self._patterns[key] = reg
+        return reg
+
+    def like(self, pattern, flags=re.I | re.S):
+        return self.compile(like_to_regex(pattern), flags)
+
+    def info(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._patterns), maxsize=self.maxsize)
+
+    def clear(self):
+        with self._lock:
+            self._patterns.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+patterns = PatternCache()
+
+
+def regexp(expr, item):
+    return patterns.compile(expr).search(item) is not None
+
+
+def register_regexp(conn):
+    """
+    Add the REGEXP function to a sqlite connection, deterministic when the sqlite module supports it
+    """
+    try:
+        conn.create_function("REGEXP", 2, regexp, deterministic=True)
+    except (TypeError, sqlite.NotSupportedError):
+        conn.create_function("REGEXP", 2, regexp)
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    cache = PatternCache()
+    reg = cache.compile(r'\b191\b')
+    assert cache.compile(r'\b191\b') is reg
+    assert cache.compile(r'\b191\b', re.I) is not reg
+    assert cache.info() == {'hits': 1, 'misses': 2, 'size': 2, 'maxsize': MAX_PATTERNS}
+    cache.clear()
+    assert cache.info() == {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': MAX_PATTERNS}
+
+
+def test2():
+    cache = PatternCache(maxsize=2)
+    a = cache.compile('a')
+    cache.compile('b')
+    cache.compile('a')
+    cache.compile('c')
+    assert cache.info()['size'] == 2
+    assert cache.compile('a') is a
+    cache.compile('b')
+    assert cache.info() == {'hits': 2, 'misses': 4, 'size': 2, 'maxsize': 2}
+
+
+def test3():
+    cache = PatternCache()
+    assert cache.like('tspan%').match('TSPAN3902')
+    assert not cache.like('tspan%').match('xtspan')
+    assert cache.like('%3902').match('tspan3902')
+    assert cache.like('tsp_n3902').match('tspan3902')
+    assert not cache.like('template').match('template0')
+    assert cache.like('a.b(%').match('a.b(c')
+    assert not cache.like('a.b(%').match('axb(c')
+
+
+def test4():
+    conn = sqlite.connect(':memory:')
+    register_regexp(conn)
+    before = patterns.info()
+    conn.execute('CREATE TABLE t (v TEXT)')
+    conn.executemany('INSERT INTO t (v) VALUES (?)', [('191.48788',), ('85.889389',), ('x191',)] * 10)
+    assert conn.execute(r"SELECT count(*) FROM t WHERE v REGEXP '\b191\b'").fetchone()[0] == 10
+    after = patterns.info()
+    assert after['misses'] - before['misses'] <= 1
+    assert after['hits'] - before['hits'] >= 29
+
+
+def test5():
+    cache = PatternCache(maxsize=8)
+    errors = []
+
+    def work(n):
+        try:
+            for i in xrange(2000):
+                cache.compile('p%i' % ((i * n) % 12))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in xrange(1, 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    info = cache.info()
+    assert errors == [] and info['size'] <= 8 and info['hits'] + info['misses'] == 8000
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: css selectors, compiled once and matched over the trees of the parsers
+#
+# --------------
+
+__author__ = 'Roberto'
+
+from collections import OrderedDict
+import re
+import threading
+
+from attr_map import AttrMap
+
+ATTRS = 'attrs'
+TAG_NAME = 'tag_name'
+VALUE = 'value'
+TYPE = 'type'
+TAG = '__tag__'
+
+MAX_SELECTORS = 256
+
+DESCENDANT = ' '
+CHILD = '>'
+
+_NAME = r'[-\w:]+'
+_SPACE = re.compile(r'\s*')
+_COMBINATOR = re.compile(r'\s*([>,])\s*|\s+')
+_TYPE = re.compile(r'(%s|\*)' % _NAME)
+_ID = re.compile(r'#(%s)' % _NAME)
+_CLASS = re.compile(r'\.(%s)' % _NAME)
+_ATTR = re.compile(r'''\[\s*(%s)\s*(?:([~^$*]?=)\s*(?:"([^"]*)"|'([^']*)'|([^\]\s]+))\s*)?\]''' % _NAME)
+
+
+class SelectorError(ValueError):
+    pass
+
+
+def _test(op, value, expected):
+    if op is None:
+        return True
+    if op == '=':
+        return value == expected
+    if not expected:
+        return False
+    if op == '^=':
+        return value.startswith(expected)
+    if op == '$=':
+        return value.endswith(expected)
+    if op == '*=':
+        return expected in value
+    if op == '~=':
+        return expected in value.split()
+    return False
+
+
+class Compound(object):
+    """
+    A tag name (None for any) and the attribute tests (k, op, value) of one step of a selector,
+    op is None for the presence tests
+    """
+
+    def __init__(self, tag=None, tests=()):
+        self.tag = tag
+        self.tests = list(tests)
+
+    def id(self, op='='):
+        for k, x, v in self.tests:
+            if k == 'id' and x == op and v:
+                return v
+        return None
+
+    def matches(self, tree, elem):
+        if self.tag is not None and tree.name(elem) != self.tag:
+            return False
+        for k, op, expected in self.tests:
+            value = tree.attr(elem, k)
+            if value is None or not _test(op, str(value), expected):
+                return False
+        return True
+
+
+class Selector(object):
+    """
+    compounds[0] combinators[0] compounds[1] ... matched right to left going up the parents
+    """
+
+    def __init__(self, compounds, combinators):
+        self.compounds = compounds
+        self.combinators = combinators
+
+    def matches(self, tree, elem, parent, i=None):
+        if i is None:
+            i = len(self.compounds) - 1
+        if not self.compounds[i].matches(tree, elem):
+            return False
+        if i == 0:
+            return True
+        up = parent(elem)
+        if self.combinators[i - 1] == CHILD:
+            return up is not None and self.matches(tree, up, parent, i - 1)
+        while up is not None:
+            if self.matches(tree, up, parent, i - 1):
+                return True
+            up = parent(up)
+        return False
+
+
+class SelectorGroup(object):
+    """
+    The selectors separated by commas, compiled holds the translations made by the parsers (e.g. the sql)
+    """
+
+    def __init__(self, text, selectors):
+        self.text = text
+        self.selectors = selectors
+        self.compiled = dict()
+
+    def select(self, tree, roots):
+        """
+        The elements in the subtrees of roots (roots included) matching any of the selectors:
+        from the tree indexes when every selector ends with a tag name or an id, else in a single traversal
+        """
+        scope = set(tree.key(x) for x in roots if tree.is_tag(x))
+
+        def parent(elem):
+            return None if tree.key(elem) in scope else tree.parent(elem)
+
+        found = [tree.candidates(x.compounds[-1], roots) for x in self.selectors]
+        if all(x is not None for x in found):
+            ret = []
+            seen = set()
+            for selector, candidates in zip(self.selectors, found):
+                for elem in candidates:
+                    if tree.key(elem) not in seen and selector.matches(tree, elem, parent):
+                        ret.append(elem)
+                        seen.add(tree.key(elem))
+            return tree.order(ret) if len(self.selectors) > 1 else ret
+        return [x for x in tree.walk(roots) if any(y.matches(tree, x, parent) for y in self.selectors)]
+
+
+def parse(text):
+    selectors = []
+    compounds = []
+    combinators = []
+    pos = _SPACE.match(text).end()
+    while True:
+        compound = Compound()
+        start = pos
+        m = _TYPE.match(text, pos)
+        if m:
+            compound.tag = None if m.group(1) == '*' else m.group(1)
+            pos = m.end()
+        while True:
+            m = _ID.match(text, pos)
+            if m:
+                compound.tests.append(('id', '=', m.group(1)))
+                pos = m.end()
+                continue
+            m = _CLASS.match(text, pos)
+            if m:
+                compound.tests.append(('class', '~=', m.group(1)))
+                pos = m.end()
+                continue
+            m = _ATTR.match(text, pos)
+            if m:
+                value = [x for x in m.group(3, 4, 5) if x is not None]
+                compound.tests.append((m.group(1), m.group(2), value[0] if value else None))
+                pos = m.end()
+                continue
+            break
+        if pos == start:
+            raise SelectorError('bad selector %r at %i' % (text, pos))
+        compounds.append(compound)
+        m = _COMBINATOR.match(text, pos)
+        if m is None or m.end() == len(text):
+            if (m.group(1) if m else None) or pos < len(text) and m is None:
+                raise SelectorError('bad selector %r at %i' % (text, pos))
+            selectors.append(Selector(compounds, combinators))
+            return SelectorGroup(text, selectors)
+        pos = m.end()
+        if m.group(1) == ',':
+            selectors.append(Selector(compounds, combinators))
+            compounds = []
+            combinators = []
+        else:
+            combinators.append(m.group(1) or DESCENDANT)
+
+
+_compiled = OrderedDict()
+# the parsers query from several threads, the pop and set of an entry go together (as in PatternCache)
+_compiled_lock = threading.Lock()
+
+
+def compile_selector(text):
+    """
+    The SelectorGroup of text, the last MAX_SELECTORS ones are kept compiled
+    """
+    with _compiled_lock:
+        try:
+            ret = _compiled.pop(text)
+        except KeyError:
+            ret = parse(text)
+            if len(_compiled) >= MAX_SELECTORS:
+                _compiled.popitem(last=False)
+        _compiled[text] = ret
+    return ret
+
+
+class DomTree(object):
+    """
+    The elements of a GenericParser dom for SelectorGroup.select: the parser indexes are used when given,
+    else the parents are collected while walking
+    """
+
+    def __init__(self, parser=None):
+        self.parser = parser
+        self._parents = dict()
+
+    key = id
+
+    def is_tag(self, elem):
+        return elem[TYPE] == TAG
+
+    def name(self, elem):
+        return elem[TAG_NAME]
+
+    def attr(self, elem, k):
+        attrs = elem[ATTRS]
+        if isinstance(attrs, (AttrMap, dict)):
+            return attrs.get(k)
+        for x, v in attrs:
+            if x == k:
+                return v
+        return None
+
+    def parent(self, elem):
+        if id(elem) in self._parents or self.parser is None:
+            return self._parents.get(id(elem))
+        return self.parser.parent(elem)
+
+    def walk(self, roots):
+        stack = [iter(roots)]
+        parents = [None]
+        while stack:
+            for elem in stack[-1]:
+                if elem[TYPE] == TAG:
+                    self._parents[id(elem)] = parents[-1]
+                    yield elem
+                    stack.append(iter(elem[VALUE]))
+                    parents.append(elem)
+                    break
+            else:
+                stack.pop()
+                parents.pop()
+
+    def candidates(self, compound, roots):
+        if self.parser is None:
+            return None
+        within = None if roots is self.parser.dom else roots
+        if compound.id() is not None:
+            return self.parser._id_lookup(compound.id(), within=within)
+        if compound.id('^=') is not None:
+            return self.parser._id_lookup(startswith=compound.id('^='), within=within)
+        if compound.tag is not None:
+            return self.parser._tag_lookup(compound.tag, within)
+        return None
+
+    def order(self, elems):
+        self.parser._ensure_order()
+        return sorted(elems, key=lambda x: self.parser._span[id(x)][0])
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    group = compile_selector('g#template > text tspan[id^=tspan], rect.a[x="1 2"] , *[y]')
+    assert compile_selector('g#template > text tspan[id^=tspan], rect.a[x="1 2"] , *[y]') is group
+    first, second, third = group.selectors
+    assert [x.tag for x in first.compounds] == ['g', 'text', 'tspan'] and first.combinators == [CHILD, DESCENDANT]
+    assert first.compounds[0].tests == [('id', '=', 'template')] and first.compounds[2].tests == [('id', '^=', 'tspan')]
+    assert second.compounds[0].tests == [('class', '~=', 'a'), ('x', '=', '1 2')]
+    assert third.compounds[0].tag is None and third.compounds[0].tests == [('y', None, None)]
+    for bad in ('', 'g >', 'g,', 'g[x', '> g', 'g!'):
+        try:
+            parse(bad)
+            assert False, bad
+        except SelectorError:
+            pass
+
+
+def test2():
+    dom = [{TYPE: TAG, TAG_NAME: 'svg', ATTRS: {}, VALUE: [
+        {TYPE: TAG, TAG_NAME: 'g', ATTRS: {'id': 'a', 'class': 'x y'}, VALUE: [
+            {TYPE: TAG, TAG_NAME: 'rect', ATTRS: [('id', 'r1')], VALUE: []},
+            {TYPE: '__data__', VALUE: 'text'},
+            {TYPE: TAG, TAG_NAME: 'g', ATTRS: {}, VALUE: [
+                {TYPE: TAG, TAG_NAME: 'rect', ATTRS: {'id': 'r2'}, VALUE: []}]}]}]}]
+
+    def ids(text, roots=dom):
+        return [DomTree().attr(x, 'id') for x in compile_selector(text).select(DomTree(), roots)]
+
+    assert ids('rect') == ['r1', 'r2']
+    assert ids('g.y > rect') == ['r1']
+    assert ids('svg rect[id$="2"]') == ['r2']
+    assert ids('g g rect, #r1') == ['r1', 'r2']
+    assert ids('[id*=r]') == ['r1', 'r2']
+    assert ids('svg > g > rect', dom[0][VALUE][0][VALUE]) == []
+    assert ids('g rect', dom[0][VALUE][0][VALUE]) == ['r2']
+
+
+def test3():
+    errors = []
+
+    def work(n):
+        try:
+            for i in xrange(2000):
+                compile_selector('g#a%i > rect' % ((i * n) % (MAX_SELECTORS + 50)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in xrange(1, 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == [] and len(_compiled) <= MAX_SELECTORS
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: streaming markup writer shared by the parsers
+#
+# --------------
+
+__author__ = 'Roberto'
+
+#element types
+COMMENT = '__comment__'
+DATA = '__data__'
+DECL = '__decl__'
+TAG = '__tag__'
+PI = '__pi__'
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_markup(nodes, describe, before=None, after=None, html=None):
+    """
+    Yield the markup of nodes piece by piece, walking the tree with an explicit stack.
+
+    describe(node) returns (type, value, attributes, children): value is the tag name of the TAG nodes,
+    attributes their rendered attributes and children an iterable of nodes.
+    html is written before the top level nodes in before and after every node in after.
+    """
+    # frame: [children iterator, node, start tag, tag name], frames[:opened] have their start tag written
+    frames = [[iter(nodes), None, None, None]]
+    opened = 1
+    while frames:
+        frame = frames[-1]
+        for node in frame[0]:
+            if before and len(frames) == 1 and node in before:
+                yield html
+            elem_type, value, attributes, children = describe(node)
+            if elem_type == TAG:
+                frames.append([iter(children), node, '<%s%s' % (value, attributes), value])
+                break
+            if elem_type == DECL:
+                chunk = '<!' + value + '>'
+            elif elem_type == PI:
+                chunk = '<?' + value + '>'
+            elif elem_type == COMMENT:
+                chunk = '<!--' + value + '-->'
+            elif elem_type == DATA:
+                chunk = '%s' % value
+            else:
+                chunk = ''
+            if chunk:
+                while opened < len(frames):
+                    yield frames[opened][2] + '>'
+                    opened += 1
+                yield chunk
+            if after and node in after:
+                while opened < len(frames):
+                    yield frames[opened][2] + '>'
+                    opened += 1
+                yield html
+        else:
+            frames.pop()
+            if frame[1] is None:
+                continue
+            if len(frames) < opened:
+                opened -= 1
+                yield '</%s>' % frame[3]
+            else:
+                # nothing was written inside it
+                while opened < len(frames):
+                    yield frames[opened][2] + '>'
+                    opened += 1
+                yield frame[2] + '/>'
+            if after and frame[1] in after:
+                yield html
+
+
+def coalesce(pieces, size=CHUNK_SIZE):
+    """
+    Join the small pieces of markup in chunks of about size characters
+    """
+    buf = []
+    length = 0
+    for piece in pieces:
+        buf.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield ''.join(buf)
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def _describe(node):
+    return node[0], node[1], node[2] if len(node) > 2 else '', node[3] if len(node) > 3 else ()
+
+
+def test1():
+    doc = [(DECL, 'DOCTYPE svg'), (TAG, 'svg', ' id="a"', [(TAG, 'g', ' ', []), (DATA, 'x'), (COMMENT, 'c')])]
+    assert ''.join(iter_markup(doc, _describe)) == '<!DOCTYPE svg><svg id="a"><g />x<!--c--></svg>'
+
+
+def test2():
+    empty = (TAG, 'g', ' id="b"', [(TAG, 'g', ' id="c"', [(DATA, '')])])
+    doc = [(TAG, 'svg', ' ', [empty])]
+    assert ''.join(iter_markup(doc, _describe)) == '<svg ><g id="b"><g id="c"/></g></svg>'
+    assert ''.join(iter_markup(doc, _describe, after=[empty], html='<hr/>')) == \
+        '<svg ><g id="b"><g id="c"/></g><hr/></svg>'
+    assert ''.join(iter_markup(doc, _describe, before=doc, html='<hr/>')) == \
+        '<hr/><svg ><g id="b"><g id="c"/></g></svg>'
+
+
+def test3():
+    deep = (DATA, 'leaf')
+    for i in xrange(5000):
+        deep = (TAG, 'g', '', [deep])
+    assert ''.join(iter_markup([deep], _describe)).count('<g>') == 5000
+    chunks = list(coalesce(iter_markup([deep], _describe), size=100))
+    assert all(len(x) < 110 for x in chunks)
+    assert ''.join(chunks) == ''.join(iter_markup([deep], _describe))
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: versioned binary snapshots of parsed documents: a table of distinct strings and a stream of integers
+#
+# --------------
+
+__author__ = 'Roberto'
+
+from array import array
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = 'PYSVGSNP'
+VERSION = 3
+# magic, version, kind, strings, integers
+HEADER = struct.Struct('<8sHHII')
+# the index written for None (e.g. the value of an attribute without one)
+NONE = 0xffffffff
+# what the integers describe, the generic_parser dom or the dict_parser tables
+DOM_KIND, TABLES_KIND = range(2)
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _uint32():
+    for code in ('I', 'L'):
+        if array(code).itemsize == 4:
+            return code
+    raise SnapshotError('no 4 bytes array type')
+
+
+_CODE = _uint32()
+
+
+class StringTable(object):
+    """
+    The distinct strings of a snapshot, each one stored once and referred by its index
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._index = dict()
+
+    def add(self, value):
+        if value is None:
+            return NONE
+        if not isinstance(value, basestring):
+            value = str(value)
+        # 'g' == u'g', the type is part of the key so that each one comes back as it was
+        key = (isinstance(value, unicode), value)
+        try:
+            return self._index[key]
+        except KeyError:
+            ret = self._index[key] = len(self.strings)
+            self.strings.append(value)
+            return ret
+
+
+def _little_endian(numbers):
+    if sys.byteorder == 'big':
+        numbers.byteswap()
+    return numbers
+
+
+def write(path, kind, table, numbers):
+    """
+    Write the snapshot file: header, string offsets, one byte per string (1 for the unicode ones, stored utf-8
+    encoded), string bytes, integers (little endian unsigned 32 bit)
+    """
+    flags = ''.join('\x01' if isinstance(x, unicode) else '\x00' for x in table.strings)
+    strings = [x.encode('utf-8') if isinstance(x, unicode) else x for x in table.strings]
+    offsets = array(_CODE, [0])
+    for x in strings:
+        offsets.append(offsets[-1] + len(x))
+    numbers = array(_CODE, numbers)
+    with open(path, 'wb') as fileobj:
+        fileobj.write(HEADER.pack(MAGIC, VERSION, kind, len(strings), len(numbers)))
+        fileobj.write(_little_endian(offsets).tostring())
+        fileobj.write(flags)
+        fileobj.write(''.join(strings))
+        fileobj.write(_little_endian(numbers).tostring())
+
+
+def read(path, kind):
+    """
+    The strings (None at index NONE excluded, see string) and the integers of the snapshot at path,
+    the file is memory mapped and sliced without an intermediate copy
+    """
+    with open(path, 'rb') as fileobj:
+        if os.fstat(fileobj.fileno()).st_size < HEADER.size:
+            raise SnapshotError('%s is not a snapshot' % path)
+        data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, found, count, length = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise SnapshotError('%s is not a snapshot' % path)
+        if version != VERSION:
+            raise SnapshotError('snapshot version %i, expected %i' % (version, VERSION))
+        if found != kind:
+            raise SnapshotError('snapshot of kind %i, expected %i' % (found, kind))
+        start = HEADER.size
+        offsets = array(_CODE)
+        offsets.fromstring(data[start:start + 4 * (count + 1)])
+        _little_endian(offsets)
+        start += 4 * (count + 1)
+        flags = data[start:start + count]
+        start += count
+        strings = [data[start + offsets[i]:start + offsets[i + 1]] for i in xrange(count)]
+        if '\x01' in flags:
+            strings = [x.decode('utf-8') if flag == '\x01' else x for x, flag in zip(strings, flags)]
+        start += offsets[count]
+        numbers = array(_CODE)
+        numbers.fromstring(data[start:start + 4 * length])
+        if len(numbers) != length:
+            raise SnapshotError('%s is truncated' % path)
+        _little_endian(numbers)
+    finally:
+        data.close()
+    return strings, numbers
+
+
+def string(strings, i):
+    return None if i == NONE else strings[i]
+
+
+def split64(value):
+    """
+    The high and low 32 bits of value, for the integers that can outgrow an unsigned 32 bit one (the sort orders)
+    """
+    return [value >> 32, value & 0xffffffff]
+
+
+def join64(high, low):
+    return (high << 32) | low
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    import tempfile
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        table = StringTable()
+        numbers = [table.add(x) for x in ('g', 'id', 'g', None, 5, u'\xe8', '', u'g', '\xc3\xa8')]
+        assert numbers == [0, 1, 0, NONE, 2, 3, 4, 5, 6]
+        write(path, DOM_KIND, table, numbers + [2 ** 32 - 2])
+        strings, found = read(path, DOM_KIND)
+        assert strings == ['g', 'id', '5', u'\xe8', '', u'g', '\xc3\xa8'] and list(found) == numbers + [2 ** 32 - 2]
+        assert [type(x) for x in strings] == [str, str, str, unicode, str, unicode, str]
+        assert string(strings, found[3]) is None
+        assert split64(2 ** 32 - 1) == [0, 2 ** 32 - 1] and join64(*split64(3 * 2 ** 40 + 7)) == 3 * 2 ** 40 + 7
+        for kind, data in ((TABLES_KIND, None), (DOM_KIND, 'PYSVGSNQ'), (DOM_KIND, 'x'), (DOM_KIND, '')):
+            if data is not None:
+                rest = open(path, 'rb').read()[8:] if len(data) == 8 else ''
+                open(path, 'wb').write(data + rest)
+            try:
+                read(path, kind)
+                assert False
+            except SnapshotError:
+                pass
+    finally:
+        os.remove(path)
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# (c) Roberto Gambuzzi
+#
+# desc: opt-in counters and timers on the hot paths of the parsers, nothing is wrapped until enable()
+#
+# --------------
+
+__author__ = 'Roberto'
+
+from functools import wraps
+import threading
+import time
+
+import dbobj
+import db_parser
+import dict_parser
+import generic_parser
+import pattern_cache
+
+PARSE_CALLBACKS = ('handle_starttag', 'handle_endtag', 'handle_data', 'handle_comment', 'handle_decl', 'handle_pi')
+# the serializing methods of each parser class: the ones returning a string, the ones yielding chunks
+SERIALIZERS = (
+    (generic_parser.GenericParser, '_to_string', 'iter_chunks'),
+    (dict_parser.DictParser, 'to_string', 'iter_chunks'),
+    (db_parser.DbParser, 'to_string', 'iter_chunks'),
+)
+
+_clock = time.time
+_enabled = False
+_hook = None
+# event -> [count, seconds, total], total is the rows fetched by sql.fetch, the bytes written by serialize.*
+_counters = dict()
+# the readers of a DbParser record from their own threads
+_lock = threading.Lock()
+# (owner, name, original or None when inherited) of the attributes replaced by enable
+_patched = []
+
+
+def record(event, seconds, total=0):
+    if not _enabled:
+        return
+    with _lock:
+        try:
+            counter = _counters[event]
+        except KeyError:
+            counter = _counters[event] = [0, 0.0, 0]
+        counter[0] += 1
+        counter[1] += seconds
+        counter[2] += total
+    if _hook is not None:
+        _hook(event, seconds, total)
+
+
+def stats():
+    """
+    Snapshot of the counters: {event: {'count': .., 'seconds': .., 'total': ..}}, the events are
+    parse.<class>.<callback>, serialize.<class>, sql.execute, sql.executemany, sql.fetch, sql.commit,
+    regex.match and regex.search. The times of nested events overlap (a DbParser callback includes its sql)
+    """
+    with _lock:
+        return dict((k, {'count': v[0], 'seconds': v[1], 'total': v[2]}) for k, v in _counters.items())
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+
+
+def set_hook(hook):
+    """
+    Call hook(event, seconds, total) for every event recorded, e.g. to feed a metrics exporter; None to stop
+    """
+    global _hook
+    _hook = hook
+
+
+def enabled():
+    return _enabled
+
+
+def _timed(event, func):
+    @wraps(func)
+    def wrapper(*plist, **params):
+        start = _clock()
+        try:
+            return func(*plist, **params)
+        finally:
+            record(event, _clock() - start)
+
+    return wrapper
+
+
+def _sized(event, func):
+    @wraps(func)
+    def wrapper(*plist, **params):
+        start = _clock()
+        ret = func(*plist, **params)
+        record(event, _clock() - start, len(ret))
+        return ret
+
+    return wrapper
+
+
+def _chunked(event, func):
+    @wraps(func)
+    def wrapper(*plist, **params):
+        chunks = iter(func(*plist, **params))
+        while True:
+            start = _clock()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            record(event, _clock() - start, len(chunk))
+            yield chunk
+
+    return wrapper
+
+
+class Pattern(object):
+    """
+    A compiled regular expression counting its match and search calls
+    """
+    __slots__ = ('_reg',)
+
+    def __init__(self, reg):
+        self._reg = reg
+
+    def match(self, *plist):
+        start = _clock()
+        try:
+            return self._reg.match(*plist)
+        finally:
+            record('regex.match', _clock() - start)
+
+    def search(self, *plist):
+        start = _clock()
+        try:
+            return self._reg.search(*plist)
+        finally:
+            record('regex.search', _clock() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._reg, name)
+
+
+class Cursor(object):
+    """
+    A sqlite cursor counting the statements executed and the rows fetched
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, vals=()):
+        start = _clock()
+        try:
+            self._cursor.execute(sql, vals)
+        finally:
+            record('sql.execute', _clock() - start)
+        return self
+
+    def executemany(self, sql, seq):
+        start = _clock()
+        try:
+            self._cursor.executemany(sql, seq)
+        finally:
+            record('sql.executemany', _clock() - start, max(self._cursor.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        start = _clock()
+        ret = self._cursor.fetchone()
+        record('sql.fetch', _clock() - start, 0 if ret is None else 1)
+        return ret
+
+    def fetchmany(self, *plist):
+        start = _clock()
+        ret = self._cursor.fetchmany(*plist)
+        record('sql.fetch', _clock() - start, len(ret))
+        return ret
+
+    def fetchall(self):
+        start = _clock()
+        ret = self._cursor.fetchall()
+        record('sql.fetch', _clock() - start, len(ret))
+        return ret
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class Connection(object):
+    """
+    A sqlite connection handing out counting cursors and timing the commits
+    """
+
+    def __init__(self, conn):
+        object.__setattr__(self, '_conn', conn)
+
+    def cursor(self):
+        return Cursor(self._conn.cursor())
+
+    def execute(self, sql, vals=()):
+        return self.cursor().execute(sql, vals)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        start = _clock()
+        try:
+            self._conn.commit()
+        finally:
+            record('sql.commit', _clock() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+
+def instrument(conn):
+    return conn if isinstance(conn, Connection) else Connection(conn)
+
+
+def _patch(owner, name, wrapper):
+    original = getattr(owner, name)
+    _patched.append((owner, name, owner.__dict__.get(name)))
+    setattr(owner, name, wrapper(original))
+
+
+def enable(hook=None):
+    """
+    Wrap the parse callbacks, serializers, regular expressions and sql connections made from now on.
+    Until then (and after disable) the parsers run their own methods untouched
+    """
+    global _enabled
+    if hook is not None:
+        set_hook(hook)
+    if _enabled:
+        return
+    for cls in (generic_parser.GenericParser, dict_parser.DictParser, db_parser.DbParser):
+        for name in PARSE_CALLBACKS:
+            _patch(cls, name, lambda func, event='parse.%s.%s' % (cls.__name__, name[7:]): _timed(event, func))
+    for cls, to_string, iter_chunks in SERIALIZERS:
+        _patch(cls, to_string, lambda func, event='serialize.%s' % cls.__name__: _sized(event, func))
+        _patch(cls, iter_chunks, lambda func, event='serialize.%s' % cls.__name__: _chunked(event, func))
+    _patch(pattern_cache.PatternCache, 'compile', lambda func: wraps(func)(lambda *p, **k: Pattern(func(*p, **k))))
+    _patch(db_parser, 'make_db_connection', lambda func: wraps(func)(lambda *p, **k: instrument(func(*p, **k))))
+    _patch(dbobj.Abstract, '__init__',
+           lambda func: wraps(func)(lambda self, conn, *p, **k: func(self, instrument(conn), *p, **k)))
+    _enabled = True
+
+
+def disable():
+    """
+    Put back the original methods, the counters are kept until reset()
+    """
+    global _enabled
+    while _patched:
+        owner, name, original = _patched.pop()
+        if original is None:
+            delattr(owner, name)
+        else:
+            setattr(owner, name, original)
+    _enabled = False
+
+
+#  _____ ___ ___ _____
+# |_   _| __/ __|_   _|
+#   | | | _|\__ \ | |
+#   |_| |___|___/ |_|
+
+def test1():
+    originals = generic_parser.GenericParser.__dict__['handle_starttag'], db_parser.make_db_connection
+    events = []
+    enable(hook=lambda event, seconds, total: events.append(event))
+    try:
+        for cls in (generic_parser.GenericParser, dict_parser.DictParser, db_parser.DbParser):
+            parser = cls()
+            parser.load('test/test.svg')
+            data = str(parser)
+            snapshot = stats()
+            name = cls.__name__
+            assert snapshot['parse.%s.starttag' % name]['count'] == snapshot['parse.GenericParser.starttag']['count']
+            assert snapshot['parse.%s.data' % name]['count'] > 0
+            assert snapshot['serialize.%s' % name]['total'] == len(data)
+        assert snapshot['sql.fetch']['total'] > 0 and snapshot['sql.commit']['count'] > 0
+        assert snapshot['sql.executemany']['total'] > 0
+        dict_parser.DictParser(open('test/test.svg').read()).attr(id='tspan%')
+        assert stats()['regex.match']['count'] > 0
+        assert len(events) == sum(x['count'] for x in stats().values())
+    finally:
+        disable()
+        set_hook(None)
+        reset()
+    assert (generic_parser.GenericParser.__dict__['handle_starttag'], db_parser.make_db_connection) == originals
+    generic_parser.GenericParser(None).loads('<svg></svg>')
+    assert stats() == {}
+
+
+def test2():
+    enable()
+    try:
+        elem = dbobj.Elem(dbobj.make_db_connection())
+        elem.append(type='t', data='d', parent_id=0, sort_order=1)
+        assert len(elem.select_record(parent_id=0)) == 1
+        assert isinstance(elem._conn, Connection)
+        snapshot = stats()
+        assert snapshot['sql.commit']['count'] == 1 and snapshot['sql.fetch']['total'] >= 2
+    finally:
+        disable()
+        reset()
+    assert not isinstance(dbobj.Elem(dbobj.make_db_connection())._conn, Connection)
+
+
+def test3():
+    enable()
+    try:
+        threads = [threading.Thread(target=lambda: [record('threaded', 0.5, 2) for _ in xrange(5000)])
+                   for _ in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert stats()['threaded'] == {'count': 20000, 'seconds': 10000.0, 'total': 40000}
+    finally:
+        disable()
+        reset()
+
+
+def main(argv):
+    import inspect
+
+    my_name = inspect.stack()[0][3]
+    for f in argv:
+        globals()[f]()
+    if not argv:
+        fs = [globals()[x] for x in globals() if
+              inspect.isfunction(globals()[x]) and x.startswith('test') and x != my_name]
+        for f in fs:
+            print f.__name__
+            f()
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv[1:])